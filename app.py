@@ -1,32 +1,54 @@
-from iheartla.la_parser.parser import compile_la_file, compile_la_content, ParserTypeEnum
+from iheartla.la_parser.parser import compile_la_file, compile_la_files, compile_la_content, profile_la_file, ParserTypeEnum
 from iheartla.la_tools.la_helper import DEBUG_MODE
 from iheartla.la_tools.la_logger import LaLogger
 from iheartla.compiler import show_gui
 import logging
 import argparse
+import json
 
 
 if __name__ == '__main__':
     LaLogger.getInstance().set_level(logging.DEBUG if DEBUG_MODE else logging.ERROR)
     arg_parser = argparse.ArgumentParser(description='I Heart LA')
-    arg_parser.add_argument('-o', '--output', help='The output language', choices = ['numpy', 'eigen', 'latex','matlab'])
+    arg_parser.add_argument('-o', '--output', help='The output language', choices = ['numpy', 'eigen', 'latex','matlab', 'numba'])
     # arg_parser.add_argument('-i', '--input', help='File name containing I heart LA source code')
     arg_parser.add_argument('--GUI', action='store_true', help='Launch the GUI editor')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes used to compile the files (0 uses all cores)')
+    arg_parser.add_argument('--profile', action='store_true', help='Time each compilation phase and print a JSON report')
+    arg_parser.add_argument('--server', action='store_true', help='Run the compile server, keeping the parsers warm between requests')
+    arg_parser.add_argument('--client', action='store_true', help='Send the files to a running compile server')
+    arg_parser.add_argument('--port', type=int, help='The port of the compile server (default 8537)')
     arg_parser.add_argument('input', nargs='*', help='The I Heart LA files to compile.')
     args = arg_parser.parse_args()
     if args.GUI:
         show_gui()
+    elif args.server:
+        from iheartla.la_parser.compile_server import run_compile_server, DEFAULT_PORT
+        run_compile_server(port=args.port or DEFAULT_PORT)
     elif args.input:
         # output all defaults (unless outputs present)
         parser_type = ParserTypeEnum.DEFAULT
-        out_dict = {"numpy": ParserTypeEnum.NUMPY, "eigen": ParserTypeEnum.EIGEN, "latex": ParserTypeEnum.LATEX, "mathjax": ParserTypeEnum.MATHJAX, "matlab": ParserTypeEnum.MATLAB}
+        out_dict = {"numpy": ParserTypeEnum.NUMPY, "eigen": ParserTypeEnum.EIGEN, "latex": ParserTypeEnum.LATEX, "mathjax": ParserTypeEnum.MATHJAX, "matlab": ParserTypeEnum.MATLAB, "numba": ParserTypeEnum.NUMBA}
         if args.output:
             # when output args are present _only_ output those
             parser_type = ParserTypeEnum.INVALID
             out_list = args.output.split(",")
             for out in out_list:
-                assert out in out_dict, "Parameters after -o or --output can only be numpy, eigen, latex, or matlab"
+                assert out in out_dict, "Parameters after -o or --output can only be numpy, eigen, latex, matlab, or numba"
                 parser_type = parser_type | out_dict[out]
-        for input in args.input: compile_la_file(input, parser_type)
+        if args.profile:
+            print(json.dumps([profile_la_file(input, parser_type) for input in args.input], indent=2))
+        elif args.client:
+            from iheartla.la_parser.compile_server import compile_la_file_remote, DEFAULT_PORT
+            for input in args.input:
+                err_msg = compile_la_file_remote(input, parser_type, port=args.port or DEFAULT_PORT)
+                if err_msg is not None:
+                    print("{}: {}".format(input, err_msg))
+        elif args.jobs == 1:
+            for input in args.input: compile_la_file(input, parser_type)
+        else:
+            for input, err_msg in compile_la_files(args.input, parser_type, jobs=args.jobs):
+                if err_msg is not None:
+                    print("{}: {}".format(input, err_msg))
     else:
         show_gui()
@@ -0,0 +1,48 @@
+## Startup benchmark: import time of the compiler plus the time of the first compile, each in a fresh interpreter.
+## Usage: python3 benchmark_startup.py [-n RUNS] [--import-budget MS] [--compile-budget MS]
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+SNIPPET = r'''
+import time
+start = time.perf_counter()
+from iheartla.la_parser.parser import compile_la_content, ParserTypeEnum
+imported = time.perf_counter()
+ret = compile_la_content("""y = A x
+where
+A: ℝ^(2×2)
+x: ℝ^2""", ParserTypeEnum.NUMPY, use_cache=False)
+compiled = time.perf_counter()
+assert 'def myExpression' in ret[0], ret
+print(json.dumps({"import": (imported - start) * 1000, "first_compile": (compiled - imported) * 1000}))
+'''
+
+
+def run_once():
+    ret = subprocess.run([sys.executable, "-c", "import json\n" + SNIPPET], capture_output=True, text=True)
+    if ret.returncode != 0:
+        raise RuntimeError(ret.stderr)
+    return json.loads(ret.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='I Heart LA startup benchmark')
+    arg_parser.add_argument('-n', '--runs', type=int, default=5, help='Number of fresh interpreters')
+    arg_parser.add_argument('--import-budget', type=float, help='Fail if the median import time (ms) is above it')
+    arg_parser.add_argument('--compile-budget', type=float, help='Fail if the median first-compile time (ms) is above it')
+    args = arg_parser.parse_args()
+    results = [run_once() for i in range(args.runs)]
+    import_time = statistics.median([r["import"] for r in results])
+    compile_time = statistics.median([r["first_compile"] for r in results])
+    print("import: {:.1f} ms, first compile: {:.1f} ms (median of {} runs)".format(import_time, compile_time, args.runs))
+    failed = False
+    if args.import_budget is not None and import_time > args.import_budget:
+        print("import time is over the budget of {} ms".format(args.import_budget))
+        failed = True
+    if args.compile_budget is not None and compile_time > args.compile_budget:
+        print("first compile time is over the budget of {} ms".format(args.compile_budget))
+        failed = True
+    sys.exit(1 if failed else 0)
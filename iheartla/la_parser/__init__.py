@@ -2,8 +2,11 @@ __all__ = ["codegen",
            "codegen_eigen",
            "codegen_latex",
            "codegen_numpy",
+           "compile_server",
+           "decl_scanner",
            "ir",
            "ir_mutator",
+           "ir_optimizer",
            "ir_printer",
            "ir_visitor",
            "la_types",
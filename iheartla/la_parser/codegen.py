@@ -1,6 +1,148 @@
 from .ir_printer import *
 
 
+class SparseIfPattern(object):
+    """
+    Nonzero structure of a sparse matrix branch, see CodeGen.get_sparse_if_pattern
+    """
+    def __init__(self, offset=None, set_node=None, item_subs=None, item_offsets=None):
+        super().__init__()
+        self.offset = offset  # row - col for the branches like i = j + 1
+        self.set_node = set_node  # the set for the branches like (i, j) ∈ E
+        self.item_subs = item_subs  # subscript of each tuple item
+        self.item_offsets = item_offsets  # subscript = tuple item + offset
+
+    def is_diagonal(self):
+        return self.offset is not None
+
+    def get_diagonal_range(self, row_sub, cols):
+        """
+        :return: first row, column bound of the last row, column of row_sub (1-based)
+        """
+        if self.offset > 0:
+            return 1 + self.offset, "{} + {}".format(cols, self.offset), "{} - {}".format(row_sub, self.offset)
+        elif self.offset < 0:
+            return 1, "{} - {}".format(cols, -self.offset), "{} + {}".format(row_sub, -self.offset)
+        return 1, "{}".format(cols), row_sub
+
+
 class CodeGen(IRPrinter):
     def __init__(self, parse_type=None):
-        super().__init__(parse_type=parse_type)
\ No newline at end of file
+        super().__init__(parse_type=parse_type)
+
+    def get_sub_offset(self, node, subs):
+        """
+        :return: (sub, offset) for nodes like i, i+1, i-2, 3; None for the other nodes
+        """
+        if node.is_node(IRNodeType.Expression):
+            ret = self.get_sub_offset(node.value, subs)
+            if ret is None or not node.sign:
+                return ret
+            if ret[0] is None:
+                return None, -ret[1]
+            return None
+        elif node.is_node(IRNodeType.Factor):
+            if node.id is not None:
+                return self.get_sub_offset(node.id, subs)
+            elif node.num is not None:
+                return self.get_sub_offset(node.num, subs)
+            elif node.sub is not None:
+                return self.get_sub_offset(node.sub, subs)
+        elif node.is_node(IRNodeType.Subexpression):
+            return self.get_sub_offset(node.value, subs)
+        elif node.is_node(IRNodeType.Id):
+            if not node.contain_subscript() and node.main_id in subs:
+                return node.main_id, 0
+        elif node.is_node(IRNodeType.Integer):
+            return None, node.value
+        elif node.is_node(IRNodeType.Add) or node.is_node(IRNodeType.Sub):
+            left = self.get_sub_offset(node.left, subs)
+            right = self.get_sub_offset(node.right, subs)
+            if left is None or right is None or right[0] is not None:
+                return None
+            if node.is_node(IRNodeType.Add):
+                return left[0], left[1] + right[1]
+            return left[0], left[1] - right[1]
+        return None
+
+    def contain_sub(self, node, sub):
+        if node is None:
+            return False
+        if isinstance(node, list):
+            return any([self.contain_sub(item, sub) for item in node])
+        if not isinstance(node, IRNode):
+            return False
+        if node.is_node(IRNodeType.Id):
+            return node.main_id == sub or (node.contain_subscript() and sub in node.subs)
+        for key, value in vars(node).items():
+            if key in ['parent', 'la_type', 'parse_info', 'raw_text']:
+                continue
+            if self.contain_sub(value, sub):
+                return True
+        return False
+
+    def is_sub_index(self, node, sub):
+        return node is not None and node.is_node(IRNodeType.Id) and not node.contain_subscript() and node.main_id == sub
+
+    def get_grid_index(self, node, subs):
+        """
+        :return: the axis of the subscript used as index, -1 if the index doesn't depend on the subscripts, None if it
+        can't be broadcast
+        """
+        if node is None:
+            return None
+        for axis in range(len(subs)):
+            if self.is_sub_index(node, subs[axis]):
+                return axis
+        for sub in subs:
+            if self.contain_sub(node, sub):
+                return None
+        return -1
+
+    def get_grid_index_content(self, node):
+        index_info = self.visit(node)
+        if node.la_type.index_type:
+            return index_info.content
+        return "{}-1".format(index_info.content)
+
+    def get_sparse_if_pattern(self, node, subs):
+        """
+        Find the nonzero structure of a branch of a sparse matrix definition, so that only the nonzeros are
+        generated instead of testing the condition for every entry.
+        :param node: SparseIfNode
+        :param subs: subscripts of the lhs, rows first
+        :return: SparseIfPattern for i = j + c (or j = i + c) and (i, j) ∈ S, None for the other conditions
+        """
+        if len(subs) != 2 or subs[0] == subs[1] or not node.cond.is_node(IRNodeType.If):
+            return None
+        cond = node.cond.cond
+        if cond.is_node(IRNodeType.BinComp) and cond.comp_type == IRNodeType.Eq:
+            left = self.get_sub_offset(cond.left, subs)
+            right = self.get_sub_offset(cond.right, subs)
+            if left is None or right is None or left[0] is None or right[0] is None or left[0] == right[0]:
+                return None
+            # left sub + left offset = right sub + right offset
+            if left[0] == subs[0]:
+                return SparseIfPattern(offset=right[1] - left[1])
+            return SparseIfPattern(offset=left[1] - right[1])
+        elif cond.is_node(IRNodeType.In):
+            if len(cond.items) != 2:
+                return None
+            item_subs = []
+            item_offsets = []
+            for item in cond.items:
+                ret = self.get_sub_offset(item, subs)
+                if ret is None or ret[0] is None or ret[1] != 0:
+                    return None
+                item_subs.append(ret[0])
+                # same conversion as the membership test
+                offset = 0
+                if cond.set.la_type.index_type and not item.la_type.index_type:
+                    offset = 1
+                elif not cond.set.la_type.index_type and item.la_type.index_type:
+                    offset = -1
+                item_offsets.append(offset)
+            if item_subs[0] == item_subs[1]:
+                return None
+            return SparseIfPattern(set_node=cond.set, item_subs=item_subs, item_offsets=item_offsets)
+        return None
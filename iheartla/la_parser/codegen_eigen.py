@@ -1,19 +1,48 @@
 from .codegen import *
 from .type_walker import *
+from .eigen_solver import *
+
+PARALLEL_BLOCKS = 256  # fixed split of the parallel loops in the deterministic mode
+# derivatives of the scalar functions for the gradients of the objectives
+DERIVATIVE_FUNCS = {
+    MathFuncType.MathFuncSin: "cos({})",
+    MathFuncType.MathFuncCos: "-sin({})",
+    MathFuncType.MathFuncTan: "(1 / pow(cos({}), 2))",
+    MathFuncType.MathFuncAsin: "(1 / sqrt(1 - pow({}, 2)))",
+    MathFuncType.MathFuncAtan: "(1 / (1 + pow({}, 2)))",
+    MathFuncType.MathFuncSinh: "cosh({})",
+    MathFuncType.MathFuncCosh: "sinh({})",
+    MathFuncType.MathFuncTanh: "(1 - pow(tanh({}), 2))",
+    MathFuncType.MathFuncExp: "exp({})",
+    MathFuncType.MathFuncLog: "(1 / {})",
+    MathFuncType.MathFuncLn: "(1 / {})",
+    MathFuncType.MathFuncSqrt: "(0.5 / sqrt({}))",
+}
 
 
 class CodeGenEigen(CodeGen):
     def __init__(self):
         super().__init__(ParserTypeEnum.EIGEN)
+        self.parallel_mode = DEFAULT_PARALLEL_MODE
+        self.sequence_storage = DEFAULT_SEQUENCE_STORAGE
 
     def init_type(self, type_walker, func_name):
         super().init_type(type_walker, func_name)
+        self.in_parallel_region = False  # inside the body of a loop run over the threads
+        self.parallel_loop = False  # the loops of the current assignment run over the threads
+        self.derivative_failed = False  # the objective of an optimization can't be differentiated
         self.pre_str = '''/*\n{}\n*/\n#include <Eigen/Core>\n#include <Eigen/Dense>\n#include <Eigen/Sparse>\n#include <iostream>\n#include <set>\n'''.format(self.la_content)
         self.post_str = ''''''
         self.ret = 'ret'
         if self.unofficial_method:
             self.pre_str += '#include <unsupported/Eigen/MatrixFunctions>\n'
+        if self.has_optimization or self.has_integral:
+            self.pre_str += '#include <algorithm>\n#include <cmath>\n#include <functional>\n#include <limits>\n#include <vector>\n'
         self.pre_str += '\n'
+        if self.has_integral:
+            self.pre_str += QUADRATURE_CODE
+        if self.has_optimization:
+            self.pre_str += OPTIMIZATION_CODE
 
     def get_dim_check_str(self):
         check_list = []
@@ -101,6 +130,179 @@ class CodeGenEigen(CodeGen):
             type_str = "std::function<{}({})>".format(self.get_ctype(la_type.ret), self.get_func_params_str(la_type))
         return type_str
 
+    def is_dense(self, la_type):
+        return la_type.is_vector() or (la_type.is_matrix() and not la_type.sparse)
+
+    def get_element_ctype(self, la_type):
+        """
+        :return: int or double, the scalar type of a vector, matrix or scalar
+        """
+        if la_type.is_scalar():
+            return self.get_ctype(la_type)
+        if la_type.element_type is not None and la_type.element_type.is_scalar() and la_type.element_type.is_int:
+            return "int"
+        return "double"
+
+    def get_param_ctype(self, la_type):
+        """
+        :return: type of a parameter of the function, the dense ones are taken as Eigen::Ref so that Eigen objects,
+        blocks and maps are all passed without a copy
+        """
+        if self.is_dense(la_type) and not la_type.is_dynamic():
+            return "const Eigen::Ref<const {}> &".format(self.get_ctype(la_type))
+        return "const {} &".format(self.get_ctype(la_type))
+
+    def is_contiguous(self, name):
+        """
+        :return: whether the sequence parameter is stored in one matrix with its elements side by side, the vectors are
+        the columns and the matrices are blocks of columns
+        """
+        if self.sequence_storage != SequenceStorageEnum.CONTIGUOUS or name not in self.parameters:
+            return False
+        la_type = self.symtable[name]
+        if not la_type.is_sequence() or la_type.is_dynamic():
+            return False
+        ele_type = la_type.element_type
+        if not self.is_dense(ele_type) or ele_type.is_dynamic():
+            return False
+        # the number of elements follows from the columns
+        return ele_type.is_vector() or isinstance(ele_type.cols, int)
+
+    def get_storage_ctype(self, la_type):
+        """
+        :return: type of the matrix holding a contiguous sequence, the rows are fixed when the elements have a constant
+        number of rows
+        """
+        ele_type = la_type.element_type
+        if isinstance(ele_type.rows, int):
+            return "Eigen::Matrix<{}, {}, Eigen::Dynamic>".format(self.get_element_ctype(ele_type), ele_type.rows)
+        if self.get_element_ctype(ele_type) == "int":
+            return "Eigen::MatrixXi"
+        return "Eigen::MatrixXd"
+
+    def get_storage_cols(self, la_type, size):
+        ele_type = la_type.element_type
+        if ele_type.is_vector():
+            return size
+        return "{}*{}".format(size, ele_type.cols)
+
+    def get_sequence_element(self, name, index):
+        """
+        :param index: content of the 0-based index
+        :return: element of a sequence, a view of the columns for the contiguous ones
+        """
+        if not self.is_contiguous(name):
+            # the loops run over the sizes checked at the start
+            return "{}[{}]".format(name, index)
+        ele_type = self.symtable[name].element_type
+        if ele_type.is_vector():
+            return "{}.col({})".format(name, index)
+        elif ele_type.is_dim_constant():
+            return "{}.block<{}, {}>(0, ({})*{})".format(name, ele_type.rows, ele_type.cols, index, ele_type.cols)
+        return "{}.middleCols(({})*{}, {})".format(name, index, ele_type.cols, ele_type.cols)
+
+    def get_sequence_size(self, name):
+        if not self.is_contiguous(name):
+            return "{}.size()".format(name)
+        ele_type = self.symtable[name].element_type
+        if ele_type.is_vector():
+            return "{}.cols()".format(name)
+        return "({}.cols() / {})".format(name, ele_type.cols)
+
+    def get_map_str(self, la_type, buffer, writable=False):
+        """
+        :return: Eigen::Map of a column-major buffer holding a vector or a dense matrix
+        """
+        ctype = self.get_ctype(la_type)
+        if not writable:
+            ctype = "const {}".format(ctype)
+        if la_type.is_dim_constant():
+            return "Eigen::Map<{}>({})".format(ctype, buffer)
+        elif la_type.is_vector():
+            return "Eigen::Map<{}>({}, {})".format(ctype, buffer, la_type.rows)
+        return "Eigen::Map<{}>({}, {}, {})".format(ctype, buffer, la_type.rows, la_type.cols)
+
+    def get_buffer_functions(self):
+        """
+        Overloads taking raw buffers, for callers holding the data in NumPy arrays or other libraries: the vectors and
+        dense matrices are column-major buffers passed on as Eigen::Map, a sequence is one buffer with its elements
+        stored one after another. The sizes follow the buffers. The second overload writes the results to
+        caller-provided buffers.
+        :return: the overloads, empty if no parameter is a dense buffer
+        """
+        param_list = []
+        arg_list = []
+        seq_content = []
+        has_buffer = False
+        for parameter in self.parameters:
+            la_type = self.symtable[parameter]
+            if la_type.is_dynamic():
+                return ''
+            if la_type.is_sequence():
+                ele_type = la_type.element_type
+                if ele_type.is_dynamic() or not (ele_type.is_scalar() or self.is_dense(ele_type)):
+                    return ''
+                has_buffer = True
+                param_list.append("const {} * {}".format(self.get_element_ctype(ele_type), parameter))
+                if self.is_contiguous(parameter):
+                    # the buffer already has the storage of the sequence
+                    arg_list.append("Eigen::Map<const {} >({}, {}, {})".format(self.get_storage_ctype(la_type), parameter, ele_type.rows,
+                                                                             self.get_storage_cols(la_type, la_type.size)))
+                    continue
+                seq_name = self.generate_var_name(parameter)
+                seq_content.append("    {} {}({});".format(self.get_ctype(la_type), seq_name, la_type.size))
+                seq_content.append("    for(int i=0; i<{}; i++){{".format(la_type.size))
+                if ele_type.is_scalar():
+                    seq_content.append("        {}[i] = {}[i];".format(seq_name, parameter))
+                else:
+                    ele_size = ele_type.rows if ele_type.is_vector() else "{}*{}".format(ele_type.rows, ele_type.cols)
+                    seq_content.append("        {}[i] = {};".format(seq_name, self.get_map_str(ele_type, "{} + i*{}".format(parameter, ele_size))))
+                seq_content.append("    }")
+                arg_list.append(seq_name)
+            elif self.is_dense(la_type):
+                has_buffer = True
+                param_list.append("const {} * {}".format(self.get_element_ctype(la_type), parameter))
+                arg_list.append(self.get_map_str(la_type, parameter))
+            else:
+                param_list.append("{} {}".format(self.get_param_ctype(la_type), parameter))
+                arg_list.append(parameter)
+        if not has_buffer:
+            return ''
+        for key in self.dim_dict.keys():
+            if key not in self.parameters:
+                param_list.append("const long {}".format(key))
+        ret_type = self.get_result_type()
+        content = "/**\n * {} over column-major buffers, the sizes follow them and a sequence is stored element after element\n */\n".format(self.func_name)
+        content += "{} {}(\n    {})\n{{\n".format(ret_type, self.func_name, ',\n    '.join(param_list))
+        if len(seq_content) > 0:
+            # the elements are copied to the std::vector storage
+            content += '\n'.join(seq_content) + '\n'
+        content += "    return {}({});\n}}\n".format(self.func_name, ', '.join(arg_list))
+        # results written to the buffers of the caller
+        out_list = []
+        write_list = []
+        ret_name = self.generate_var_name("ret")
+        for lhs in self.lhs_list:
+            la_type = self.symtable[lhs]
+            if la_type.is_scalar():
+                write_list.append("    *{} = {}.{};".format(lhs, ret_name, lhs))
+            elif self.is_dense(la_type) and not la_type.is_dynamic():
+                if la_type.is_vector():
+                    map_str = "Eigen::Map<{}>({}, {}.{}.size())".format(self.get_ctype(la_type), lhs, ret_name, lhs)
+                else:
+                    map_str = "Eigen::Map<{}>({}, {}.{}.rows(), {}.{}.cols())".format(self.get_ctype(la_type), lhs, ret_name,
+                                                                                       lhs, ret_name, lhs)
+                write_list.append("    {} = {}.{};".format(map_str, ret_name, lhs))
+            else:
+                return content
+            out_list.append("{} * {}".format(self.get_element_ctype(la_type), lhs))
+        call_list = [param.split(' ')[-1] for param in param_list]
+        content += "\n/**\n * {} writing the results to the buffers after the parameters\n */\n".format(self.func_name)
+        content += "void {}(\n    {})\n{{\n".format(self.func_name, ',\n    '.join(param_list + out_list))
+        content += "    const {} {} = {}({});\n".format(ret_type, ret_name, self.func_name, ', '.join(call_list))
+        content += '\n'.join(write_list) + '\n}\n'
+        return content
+
     def get_rand_test_str(self, la_type, rand_int_max):
         rand_test = ''
         if la_type.is_matrix():
@@ -269,7 +471,12 @@ class CodeGenEigen(CodeGen):
                         has_defined = True
                 if not has_defined:
                     test_content.append("    const int {} = rand()%{};".format(key, rand_int_max))
-                if self.symtable[target].is_sequence():
+                if self.is_contiguous(target):
+                    if target_dict[target] == 0:
+                        dim_content += "    const long {} = {};\n".format(key, self.get_sequence_size(target))
+                    elif target_dict[target] == 1:
+                        dim_content += "    const long {} = {}.rows();\n".format(key, target)
+                elif self.symtable[target].is_sequence():
                     if target_dict[target] == 0:
                         dim_content += "    const long {} = {}.size();\n".format(key, target)
                     elif target_dict[target] == 1:
@@ -286,13 +493,32 @@ class CodeGenEigen(CodeGen):
         par_des_list = []
         test_par_list = []
         for parameter in self.parameters:
-            main_declaration.append("    {} {};".format(self.get_ctype(self.symtable[parameter]), parameter))
-            par_des_list.append("const {} & {}".format(self.get_ctype(self.symtable[parameter]), parameter))
-            test_par_list.append("{} & {}".format(self.get_ctype(self.symtable[parameter]), parameter))
+            ctype = self.get_ctype(self.symtable[parameter])
+            param_ctype = self.get_param_ctype(self.symtable[parameter])
+            if self.is_contiguous(parameter):
+                ctype = self.get_storage_ctype(self.symtable[parameter])
+                param_ctype = "const Eigen::Ref<const {} > &".format(ctype)
+            main_declaration.append("    {} {};".format(ctype, parameter))
+            par_des_list.append("{} {}".format(param_ctype, parameter))
+            test_par_list.append("{} & {}".format(ctype, parameter))
             if self.symtable[parameter].desc:
                 show_doc = True
                 doc.append('@param {} {}'.format(parameter, self.symtable[parameter].desc))
-            if self.symtable[parameter].is_sequence():
+            if self.is_contiguous(parameter):
+                la_type = self.symtable[parameter]
+                ele_type = la_type.element_type
+                cols = self.get_storage_cols(la_type, la_type.size)
+                if self.get_element_ctype(ele_type) == "int":
+                    test_content.append('    {} = Eigen::MatrixXi::Random({}, {});'.format(parameter, ele_type.rows, cols))
+                else:
+                    test_content.append('    {} = Eigen::MatrixXd::Random({}, {});'.format(parameter, ele_type.rows, cols))
+                if not isinstance(ele_type.rows, int) and not (parameter in dim_defined_dict and dim_defined_dict[parameter] == 1):
+                    type_checks.append('    assert( {}.rows() == {} );'.format(parameter, ele_type.rows))
+                if not (parameter in dim_defined_dict and dim_defined_dict[parameter] == 0):
+                    type_checks.append('    assert( {}.cols() == {} );'.format(parameter, cols))
+                elif ele_type.is_matrix():
+                    type_checks.append('    assert( {}.cols() % {} == 0 );'.format(parameter, ele_type.cols))
+            elif self.symtable[parameter].is_sequence():
                 ele_type = self.symtable[parameter].element_type
                 data_type = ele_type.element_type
                 integer_type = False
@@ -439,6 +665,9 @@ class CodeGenEigen(CodeGen):
         ret_value = self.get_ret_struct()
         content += '    return ' + ret_value + ';'
         content += '\n}\n'
+        buffer_content = self.get_buffer_functions()
+        if buffer_content:
+            content += '\n' + buffer_content
         # test function
         test_function += test_content
         test_function.append('}')
@@ -453,10 +682,11 @@ class CodeGenEigen(CodeGen):
         content = self.trim_content(content)
         return content
 
-    def visit_summation(self, node, **kwargs):
+    def get_summation_conventions(self, node, sub):
+        """
+        :return: name conventions of the subscripted identifiers in the summation, identifiers indexed by sub
+        """
         target_var = []
-        sub = self.visit(node.id).content
-        # name convention
         name_convention = {}
         for var in node.symbols:
             if self.contain_subscript(var):
@@ -468,65 +698,616 @@ class CodeGenEigen(CodeGen):
                 if len(var_ids[1]) > 1:  # matrix
                     name_convention[var] = "{}({}, {})".format(var_ids[0], var_ids[1][0], var_ids[1][1])
                 else:
-                    name_convention[var] = "{}.at({})".format(var_ids[0], var_ids[1][0])
+                    name_convention[var] = self.get_sequence_element(var_ids[0], var_ids[1][0])
         for sym, subs in node.sym_dict.items():
             target_var.append(sym)
+        return name_convention, target_var
+
+    def get_summation_bound(self, node, sub, target_var):
+        sym_info = node.sym_dict[target_var[0]]
+        if self.symtable[target_var[0]].is_matrix():  # todo
+            if sub == sym_info[0]:
+                return "{}.rows()".format(target_var[0])
+            return "{}.cols()".format(target_var[0])
+        return self.get_sequence_size(target_var[0])
+
+    def visit_summation(self, node, **kwargs):
+        sub = self.visit(node.id).content
+        assign_id = node.symbol
+        if not node.cond and not node.local_stmts:
+            vectorized_content = self.get_vectorized_summation(node, sub)
+            if vectorized_content is not None:
+                return CodeNodeInfo(assign_id, pre_list=["    {} {} = {};\n".format(
+                    self.get_ctype(self.symtable[assign_id]), assign_id, vectorized_content)])
+        # name convention
+        name_convention, target_var = self.get_summation_conventions(node, sub)
         self.add_name_conventions(name_convention)
         #
-        assign_id = node.symbol
+        parallel = self.use_parallel_loop() and not self.symtable[assign_id].is_sequence()
+        in_region = self.in_parallel_region
+        self.in_parallel_region = in_region or parallel
         cond_content = ""
         if node.cond:
             cond_info = self.visit(node.cond, **kwargs)
             cond_content = "if(" + cond_info.content + "){\n"
         kwargs[WALK_TYPE] = WalkTypeEnum.RETRIEVE_EXPRESSION
-        content = []
+        local_content = self.get_local_stmts_str(node)
         exp_info = self.visit(node.exp)
+        self.in_parallel_region = in_region
         exp_str = exp_info.content
-        if self.symtable[assign_id].is_matrix():
-            if self.symtable[assign_id].sparse:
-                content.append("{} {}({}, {});\n".format(self.get_ctype(self.symtable[assign_id]), assign_id, self.symtable[
-                    assign_id].rows, self.symtable[assign_id].cols))
-            else:
-                content.append("Eigen::MatrixXd {} = Eigen::MatrixXd::Zero({}, {});\n".    format(assign_id, self.symtable[assign_id].rows,
-                                                                               self.symtable[assign_id].cols))
-        elif self.symtable[assign_id].is_vector():
-            content.append(
-                "Eigen::MatrixXd {} = Eigen::MatrixXd::Zero({}, 1);\n".format(assign_id, self.symtable[assign_id].rows))
-        elif self.symtable[assign_id].is_sequence():
-            ele_type = self.symtable[assign_id].element_type
-            content.append(
-                "Eigen::MatrixXd {} = np.zeros(({}, {}, {}))\n".format(assign_id, self.symtable[assign_id].size,
-                                                                       ele_type.rows, ele_type.cols))
-        else:
-            content.append("double {} = 0;\n".format(assign_id))
-        sym_info = node.sym_dict[target_var[0]]
-        if self.symtable[target_var[0]].is_matrix():  # todo
-            if sub == sym_info[0]:
-                content.append("for(int {}=1; {}<={}.rows(); {}++){{\n".format(sub, sub, target_var[0], sub))
-            else:
-                content.append("for(int {}=1; {}<={}.cols(); {}++){{\n".format(sub, sub, target_var[0], sub))
-        else:
-            content.append("for(int {}=1; {}<={}.size(); {}++){{\n".format(sub, sub, target_var[0], sub))
-        if exp_info.pre_list:  # catch pre_list
-            list_content = "".join(exp_info.pre_list)
+        content = [self.get_accumulator_def(self.symtable[assign_id], assign_id)]
+        bound = self.get_summation_bound(node, sub, target_var)
+        acc_id = assign_id
+        if parallel:
+            acc_id = "{}_local".format(assign_id)
+        body = []
+        if local_content or exp_info.pre_list:  # catch pre_list
+            list_content = local_content + "".join(exp_info.pre_list)
             # content += exp_info.pre_list
             list_content = list_content.split('\n')
             for index in range(len(list_content)):
                 if index != len(list_content) - 1:
-                    content.append(list_content[index] + '\n')
+                    body.append(list_content[index] + '\n')
         # only one sub for now
         if node.cond:
-            content.append("    " + cond_content)
-            content.append(str("        " + assign_id + " += " + exp_str + ';\n'))
-            content.append("    }\n")
+            body.append("    " + cond_content)
+            body.append(str("        " + acc_id + " += " + exp_str + ';\n'))
+            body.append("    }\n")
+        else:
+            body.append(str("    " + acc_id + " += " + exp_str + ';\n'))
+        if parallel:
+            content += self.get_parallel_sum(self.symtable[assign_id], assign_id, sub, "1", bound, body)
         else:
-            content.append(str("    " + assign_id + " += " + exp_str + ';\n'))
+            content.append("for(int {}=1; {}<={}; {}++){{\n".format(sub, sub, bound, sub))
+            content += body
+            content.append("}\n")
         content[0] = "    " + content[0]
-
-        content.append("}\n")
         self.del_name_conventions(name_convention)
         return CodeNodeInfo(assign_id, pre_list=["    ".join(content)])
 
+    def get_local_stmts_str(self, node):
+        """
+        :return: the declarations of the temporaries computed in each iteration of the summation node
+        """
+        content = ""
+        for stmt in node.local_stmts:
+            name = stmt.left.get_main_id()
+            right_info = self.visit(stmt.right)
+            if right_info.pre_list:
+                content += "".join(right_info.pre_list)
+            content += "    {} {} = {};\n".format(self.get_ctype(self.symtable[name]), name, right_info.content)
+        return content
+
+    def use_parallel_loop(self):
+        return self.parallel_mode != ParallelModeEnum.SERIAL and not self.in_parallel_region
+
+    def get_accumulator_ctype(self, la_type):
+        if la_type.is_scalar():
+            return "double"
+        elif self.is_dense(la_type) and self.get_element_ctype(la_type) == "int":
+            return "Eigen::MatrixXd"
+        return self.get_ctype(la_type)
+
+    def get_accumulator_def(self, la_type, name):
+        """
+        :return: declaration of a summation accumulator set to zero
+        """
+        ctype = self.get_accumulator_ctype(la_type)
+        if la_type.is_matrix():
+            if la_type.sparse:
+                return "{} {}({}, {});\n".format(ctype, name, la_type.rows, la_type.cols)
+            # fixed-size accumulator when the dimensions are known
+            return "{} {} = {}::Zero({}, {});\n".format(ctype, name, ctype, la_type.rows, la_type.cols)
+        elif la_type.is_vector():
+            return "{} {} = {}::Zero({}, 1);\n".format(ctype, name, ctype, la_type.rows)
+        elif la_type.is_sequence():
+            ele_type = la_type.element_type
+            return "Eigen::MatrixXd {} = np.zeros(({}, {}, {}))\n".format(name, la_type.size, ele_type.rows, ele_type.cols)
+        return "double {} = 0;\n".format(name)
+
+    def get_parallel_sum(self, la_type, name, sub, first, last, body):
+        """
+        Summation loop run over the threads, each of them adds its terms to a local accumulator. In the deterministic
+        mode the terms are split in PARALLEL_BLOCKS fixed blocks whose sums are added in order.
+        :param body: lines of the loop body, adding the terms to name_local
+        :return: lines replacing the loop
+        """
+        local = "{}_local".format(name)
+        if self.parallel_mode == ParallelModeEnum.OPENMP_DETERMINISTIC:
+            block = "{}_block".format(name)
+            blocks = "{}_blocks".format(name)
+            count = "{}_count".format(name)
+            content = ["{\n",
+                       "    const long {} = ({}) - ({}) + 1;\n".format(count, last, first),
+                       "    std::vector<{}> {}({});\n".format(self.get_accumulator_ctype(la_type), blocks, PARALLEL_BLOCKS),
+                       "    #pragma omp parallel for schedule(dynamic)\n",
+                       "    for(int {}=0; {}<{}; {}++){{\n".format(block, block, PARALLEL_BLOCKS, block),
+                       "        " + self.get_accumulator_def(la_type, local),
+                       "        for(int {}={} + {}*{}/{}; {}<{} + ({}+1)*{}/{}; {}++){{\n".format(
+                           sub, first, block, count, PARALLEL_BLOCKS, sub, first, block, count, PARALLEL_BLOCKS, sub)]
+            content += ["        " + line for line in body]
+            content += ["        }\n",
+                        "        {}[{}] = {};\n".format(blocks, block, local),
+                        "    }\n",
+                        "    for(int {}=0; {}<{}; {}++){{\n".format(block, block, PARALLEL_BLOCKS, block),
+                        "        {} += {}[{}];\n".format(name, blocks, block),
+                        "    }\n",
+                        "}\n"]
+            return content
+        content = ["#pragma omp parallel\n",
+                   "{\n",
+                   "    " + self.get_accumulator_def(la_type, local),
+                   "    #pragma omp for nowait\n",
+                   "    for(int {}={}; {}<={}; {}++){{\n".format(sub, first, sub, last, sub)]
+        content += ["    " + line for line in body]
+        content += ["    }\n",
+                    "    #pragma omp critical\n",
+                    "    {} += {};\n".format(name, local),
+                    "}\n"]
+        return content
+
+    def get_parallel_triplets(self, triplet, sub, first, last, body):
+        """
+        Triplet assembly run over the threads: the rows are split in PARALLEL_BLOCKS blocks filling their own lists,
+        which are joined in the block order. The triplets, and so the sums of the duplicates, are the same as the
+        serial loop.
+        :param body: lines of the loop body, pushing to triplet
+        :return: lines replacing the loop
+        """
+        block = "{}_block".format(triplet)
+        blocks = "{}_blocks".format(triplet)
+        count = "{}_count".format(triplet)
+        local = "{}_local".format(triplet)
+        content = ["{\n",
+                   "    const long {} = ({}) - ({}) + 1;\n".format(count, last, first),
+                   "    std::vector<std::vector<Eigen::Triplet<double> > > {}({});\n".format(blocks, PARALLEL_BLOCKS),
+                   "    #pragma omp parallel for schedule(dynamic)\n",
+                   "    for(int {}=0; {}<{}; {}++){{\n".format(block, block, PARALLEL_BLOCKS, block),
+                   "        std::vector<Eigen::Triplet<double> > &{} = {}[{}];\n".format(local, blocks, block),
+                   "        for(int {}={} + {}*{}/{}; {}<{} + ({}+1)*{}/{}; {}++){{\n".format(
+                       sub, first, block, count, PARALLEL_BLOCKS, sub, first, block, count, PARALLEL_BLOCKS, sub)]
+        content += ["        " + line.replace("{}.push_back(".format(triplet), "{}.push_back(".format(local)) for line in body]
+        content += ["        }\n",
+                    "    }\n",
+                    "    for(int {}=0; {}<{}; {}++){{\n".format(block, block, PARALLEL_BLOCKS, block),
+                    "        {}.insert({}.end(), {}[{}].begin(), {}[{}].end());\n".format(triplet, triplet, blocks, block,
+                                                                                     blocks, block),
+                    "    }\n",
+                    "}\n"]
+        return content
+
+    def get_vectorized_summation(self, node, sub):
+        """
+        Lower the summation to one Eigen expression: the terms are stacked as the columns of a matrix (Maps over the
+        sequences, rows of the vectors, ...) and summed with .sum() or .rowwise().sum().
+        :return: the content, None when the loop is needed (conditions, function calls, nested summations, ...)
+        """
+        assign_type = self.symtable[node.symbol]
+        if not (assign_type.is_scalar() or assign_type.is_vector()) or self.get_element_ctype(assign_type) == "int":
+            return None
+        if assign_type.is_vector():
+            product = self.get_sequence_product(node.exp, sub)
+            if product is not None:
+                return product
+        size_list = []
+        ret = self.visit_stacked(node.exp, sub, size_list)
+        if ret is None or not ret[1]:
+            return None
+        # the loop only runs over the first sequence
+        if len(set([str(size) for size in size_list])) != 1:
+            return None
+        if assign_type.is_scalar():
+            return "({}).sum()".format(ret[0])
+        return "({}).rowwise().sum()".format(ret[0])
+
+    def get_sequence_product(self, node, sub):
+        """
+        ∑_i A_i x_i over sequences of fixed-size matrices and vectors: the matrices side by side times the vectors
+        stacked in one column
+        :return: the content, None for the other summations
+        """
+        if not node.is_node(IRNodeType.Mul):
+            return None
+        operands = []
+        for child in [node.left, node.right]:
+            if child.is_node(IRNodeType.Factor):
+                child = child.id
+            if child is None or not child.is_node(IRNodeType.SequenceIndex) or not self.is_sub_index(child.main_index, sub) \
+                    or child.row_index is not None or child.col_index is not None:
+                return None
+            la_type = self.symtable[child.main.get_main_id()]
+            ele_type = la_type.element_type
+            if not self.is_dense(ele_type) or not ele_type.is_dim_constant() or self.get_element_ctype(ele_type) != "double":
+                return None
+            operands.append((self.visit(child.main).content, child.main.get_main_id(), la_type))
+        (matrix, matrix_id, matrix_type), (vector, vector_id, vector_type) = operands
+        if not matrix_type.element_type.is_matrix() or not vector_type.element_type.is_vector() or \
+                str(matrix_type.size) != str(vector_type.size):
+            return None
+        rows = matrix_type.element_type.rows
+        cols = matrix_type.element_type.cols
+        if not self.is_contiguous(matrix_id):
+            # fixed-size matrices are stored back to back in the std::vector
+            matrix = "Eigen::Map<const Eigen::Matrix<double, {}, Eigen::Dynamic> >(reinterpret_cast<const double *>({}.data()), {}, {}.size()*{})".format(
+                rows, matrix, rows, matrix, cols)
+        if self.is_contiguous(vector_id):
+            vector = "{}.reshaped()".format(vector)
+        else:
+            vector = "Eigen::Map<const Eigen::VectorXd>(reinterpret_cast<const double *>({}.data()), {}.size()*{})".format(
+                vector, vector, cols)
+        return "{} * {}".format(matrix, vector)
+
+    def is_stackable(self, la_type):
+        return (la_type.is_scalar() or la_type.is_vector()) and self.get_element_ctype(la_type) == "double"
+
+    def visit_stacked(self, node, sub, size_list):
+        """
+        :param size_list: lengths of the indexed dimensions, they have to be the same
+        :return: (content, stacked) where a stacked content has one column per term (a row vector for scalars), None
+        if the node can't be lowered
+        """
+        if not self.contain_sub(node, sub):
+            info = self.visit(node)
+            if info is None or info.pre_list:
+                return None
+            return info.content, False
+        if node.la_type is None or not self.is_stackable(node.la_type):
+            return None
+        if node.is_node(IRNodeType.Expression):
+            ret = self.visit_stacked(node.value, sub, size_list)
+            if ret is not None and node.sign:
+                ret = ('-' + ret[0], ret[1])
+            return ret
+        elif node.is_node(IRNodeType.Factor):
+            for child in [node.id, node.num, node.sub, node.m, node.v, node.nm, node.op]:
+                if child is not None:
+                    return self.visit_stacked(child, sub, size_list)
+        elif node.is_node(IRNodeType.Subexpression):
+            ret = self.visit_stacked(node.value, sub, size_list)
+            if ret is not None:
+                ret = ("({})".format(ret[0]), ret[1])
+            return ret
+        elif node.is_node(IRNodeType.SequenceIndex):
+            main_type = self.symtable[node.main.get_main_id()]
+            if not self.is_sub_index(node.main_index, sub) or node.row_index is not None or node.col_index is not None \
+                    or self.contain_sub(node.main, sub):
+                return None
+            ele_type = main_type.element_type
+            main_content = self.visit(node.main).content
+            size_list.append(main_type.size)
+            if ele_type.is_scalar():
+                return "Eigen::Map<const Eigen::RowVectorXd>({}.data(), {}.size())".format(main_content, main_content), True
+            elif self.is_contiguous(node.main.get_main_id()):
+                return main_content, True
+            elif ele_type.is_dim_constant():
+                # fixed-size vectors are stored back to back in the std::vector
+                return "Eigen::Map<const Eigen::Matrix<double, {}, Eigen::Dynamic> >(reinterpret_cast<const double *>({}.data()), {}, {}.size())".format(
+                    ele_type.rows, main_content, ele_type.rows, main_content), True
+        elif node.is_node(IRNodeType.VectorIndex):
+            main_type = self.symtable[node.main.get_main_id()]
+            if not self.is_sub_index(node.row_index, sub) or self.contain_sub(node.main, sub):
+                return None
+            size_list.append(main_type.rows)
+            return "{}.transpose()".format(self.visit(node.main).content), True
+        elif node.is_node(IRNodeType.MatrixIndex):
+            main_type = self.symtable[node.main.get_main_id()]
+            if main_type.sparse or self.contain_sub(node.main, sub):
+                return None
+            main_content = self.visit(node.main).content
+            row_sub = self.is_sub_index(node.row_index, sub)
+            col_sub = self.is_sub_index(node.col_index, sub)
+            if row_sub and col_sub:
+                size_list += [main_type.rows, main_type.cols]
+                return "{}.diagonal().transpose()".format(main_content), True
+            elif row_sub and node.col_index is None:
+                size_list.append(main_type.rows)
+                return "{}.transpose()".format(main_content), True
+            elif col_sub and node.row_index is None:
+                size_list.append(main_type.cols)
+                return main_content, True
+            elif row_sub and not self.contain_sub(node.col_index, sub):
+                size_list.append(main_type.rows)
+                return "{}.col({}).transpose()".format(main_content, self.get_grid_index_content(node.col_index)), True
+            elif col_sub and not self.contain_sub(node.row_index, sub):
+                size_list.append(main_type.cols)
+                return "{}.row({})".format(main_content, self.get_grid_index_content(node.row_index)), True
+        elif node.is_node(IRNodeType.Add) or node.is_node(IRNodeType.Sub):
+            left = self.visit_stacked(node.left, sub, size_list)
+            right = self.visit_stacked(node.right, sub, size_list)
+            if left is None or right is None:
+                return None
+            op = ' + ' if node.is_node(IRNodeType.Add) else ' - '
+            if left[1] and right[1]:
+                return left[0] + op + right[0], True
+            # the other operand is the same for all the terms
+            if left[1]:
+                stacked, other = left[0], right[0]
+            else:
+                stacked, other = right[0], left[0]
+            if node.is_node(IRNodeType.Sub) and not left[1]:
+                stacked = "(-({}))".format(stacked)
+                op = ' + '
+            if node.la_type.is_scalar():
+                return "(({}).array(){}{}).matrix()".format(stacked, op, other), True
+            return "({}).colwise(){}{}".format(stacked, op, other), True
+        elif node.is_node(IRNodeType.Mul):
+            return self.visit_stacked_mul(node, sub, size_list)
+        elif node.is_node(IRNodeType.Div):
+            left = self.visit_stacked(node.left, sub, size_list)
+            right = self.visit_stacked(node.right, sub, size_list)
+            if left is None or right is None or not node.right.la_type.is_scalar():
+                return None
+            if not right[1]:
+                return "{} / double({})".format(left[0], right[0]), True
+            if not node.left.la_type.is_scalar():
+                return "({}) * ({}).cwiseInverse().asDiagonal()".format(left[0], right[0]), True
+            if left[1]:
+                return "({}).cwiseQuotient({})".format(left[0], right[0]), True
+            return "({}) * ({}).cwiseInverse()".format(left[0], right[0]), True
+        elif node.is_node(IRNodeType.InnerProduct) or node.is_node(IRNodeType.DotProduct):
+            if node.is_node(IRNodeType.InnerProduct) and node.sub:
+                return None
+            left = self.visit_stacked(node.left, sub, size_list)
+            right = self.visit_stacked(node.right, sub, size_list)
+            if left is None or right is None:
+                return None
+            if left[1] and right[1]:
+                return "({}).cwiseProduct({}).colwise().sum()".format(left[0], right[0]), True
+            if left[1]:
+                return "({}).transpose() * ({})".format(right[0], left[0]), True
+            return "({}).transpose() * ({})".format(left[0], right[0]), True
+        elif node.is_node(IRNodeType.HadamardProduct):
+            left = self.visit_stacked(node.left, sub, size_list)
+            right = self.visit_stacked(node.right, sub, size_list)
+            if left is None or right is None:
+                return None
+            if left[1] and right[1]:
+                return "({}).cwiseProduct({})".format(left[0], right[0]), True
+            if left[1]:
+                return "({}).asDiagonal() * ({})".format(right[0], left[0]), True
+            return "({}).asDiagonal() * ({})".format(left[0], right[0]), True
+        elif node.is_node(IRNodeType.Norm):
+            value = self.visit_stacked(node.value, sub, size_list)
+            if value is None or not value[1]:
+                return None
+            if node.value.la_type.is_scalar():
+                return "({}).cwiseAbs()".format(value[0]), True
+            elif node.value.la_type.is_vector() and node.norm_type == NormType.NormInteger and node.sub == 2:
+                return "({}).colwise().norm()".format(value[0]), True
+        elif node.is_node(IRNodeType.Squareroot):
+            value = self.visit_stacked(node.value, sub, size_list)
+            if value is None or not value[1]:
+                return None
+            return "({}).cwiseSqrt()".format(value[0]), True
+        elif node.is_node(IRNodeType.Power):
+            base = self.visit_stacked(node.base, sub, size_list)
+            if base is None or not base[1] or node.t or not node.base.la_type.is_scalar():
+                return None
+            if node.r:
+                return "({}).cwiseInverse()".format(base[0]), True
+            if self.contain_sub(node.power, sub):
+                return None
+            power_info = self.visit(node.power)
+            if power_info.pre_list:
+                return None
+            return "({}).array().pow({}).matrix()".format(base[0], power_info.content), True
+        elif node.is_node(IRNodeType.MathFunc):
+            param = self.visit_stacked(node.param, sub, size_list)
+            if param is None or not param[1] or not node.param.la_type.is_scalar():
+                return None
+            func_name = self.get_array_func_name(node)
+            if func_name is not None:
+                return "({}).array().{}().matrix()".format(param[0], func_name), True
+        return None
+
+    def visit_stacked_mul(self, node, sub, size_list):
+        left = self.visit_stacked(node.left, sub, size_list)
+        right = self.visit_stacked(node.right, sub, size_list)
+        if left is None or right is None:
+            return None
+        l_type = node.left.la_type
+        r_type = node.right.la_type
+        if l_type.is_scalar() and r_type.is_scalar():
+            if left[1] and right[1]:
+                return "({}).cwiseProduct({})".format(left[0], right[0]), True
+            return "{} * {}".format(left[0], right[0]), True
+        if l_type.is_scalar() or r_type.is_scalar():
+            if l_type.is_scalar():
+                scalar, vector = left, right
+            else:
+                scalar, vector = right, left
+            if not scalar[1]:
+                return "{} * {}".format(left[0], right[0]), True
+            if vector[1]:
+                return "({}) * ({}).asDiagonal()".format(vector[0], scalar[0]), True
+            # same vector scaled by each term
+            return "({}) * ({})".format(vector[0], scalar[0]), True
+        if l_type.is_matrix() and r_type.is_vector() and not left[1]:
+            return "{} * ({})".format(left[0], right[0]), True
+        return None
+
+    def get_array_func_name(self, node):
+        """
+        :return: name of the Eigen array method for the element-wise functions, None for the others
+        """
+        func_dict = {MathFuncType.MathFuncSin: 'sin',
+                     MathFuncType.MathFuncAsin: 'asin',
+                     MathFuncType.MathFuncCos: 'cos',
+                     MathFuncType.MathFuncAcos: 'acos',
+                     MathFuncType.MathFuncTan: 'tan',
+                     MathFuncType.MathFuncAtan: 'atan',
+                     MathFuncType.MathFuncSinh: 'sinh',
+                     MathFuncType.MathFuncCosh: 'cosh',
+                     MathFuncType.MathFuncTanh: 'tanh',
+                     MathFuncType.MathFuncExp: 'exp',
+                     MathFuncType.MathFuncLog: 'log',
+                     MathFuncType.MathFuncLog10: 'log10',
+                     MathFuncType.MathFuncLn: 'log',
+                     MathFuncType.MathFuncSqrt: 'sqrt'}
+        return func_dict.get(node.func_type)
+
+    def get_array_content(self, node, subs, dim_list):
+        """
+        Element-wise definition (v_i = ..., A_ij = ...) as one Eigen array expression broadcast over the index grid:
+        the axis k of the grid is the subscript subs[k], LinSpaced(dim, 1, dim) when the subscript itself is used.
+        :return: the content, None when it can't be written with arrays
+        """
+        if node.op != '=' or self.contain_sub(node.right, node.left.get_main_id()):
+            return None  # the loop would read the elements it has already written
+        size_list = [[] for sub in subs]
+        ret = self.visit_array(node.right, subs, dim_list, size_list)
+        if ret is None or not ret[1]:
+            return None
+        for index in range(len(subs)):
+            for size in size_list[index]:
+                if str(size) != str(dim_list[index]):
+                    return None
+        return "({}).matrix()".format(ret[0])
+
+    def get_nullary_content(self, node, subs, dim_list, right_info):
+        """
+        Element-wise definition as a NullaryExpr: the loop body becomes a lambda of the (0-based) indices
+        :return: the content, None when the body needs statements before the expression
+        """
+        if node.op != '=' or right_info.pre_list or self.contain_sub(node.right, node.left.get_main_id()):
+            return None
+        la_type = self.symtable[node.left.get_main_id()]
+        index_list = ["Eigen::Index {}_0".format(sub) for sub in subs]
+        sub_list = ["const int {} = {}_0 + 1;".format(sub, sub) for sub in subs]
+        return "{}::NullaryExpr({}, [&]({}) -> {} {{ {} return {}; }})".format(
+            self.get_ctype(la_type), ', '.join([str(dim) for dim in dim_list]), ', '.join(index_list),
+            self.get_element_ctype(la_type), ' '.join(sub_list), right_info.content)
+
+    def get_array_axis(self, content, axis, dim_list):
+        # content is a column array along the axis
+        if len(dim_list) == 1:
+            return content
+        if axis == 0:
+            return "{}.replicate(1, {})".format(content, dim_list[1])
+        return "{}.transpose().replicate({}, 1)".format(content, dim_list[0])
+
+    def visit_array(self, node, subs, dim_list, size_list):
+        """
+        :param size_list: for each axis, the lengths of the dimensions indexed by its subscript
+        :return: (content, is_array) where an array content has one axis per subscript, None if the node can't be
+        broadcast
+        """
+        if node.la_type is None or not node.la_type.is_scalar():
+            return None
+        if not any([self.contain_sub(node, sub) for sub in subs]):
+            info = self.visit(node)
+            if info is None or info.pre_list:
+                return None
+            return info.content, False
+        if node.is_node(IRNodeType.Expression):
+            ret = self.visit_array(node.value, subs, dim_list, size_list)
+            if ret is not None and node.sign:
+                ret = ('-' + ret[0], ret[1])
+            return ret
+        elif node.is_node(IRNodeType.Factor):
+            for child in [node.id, node.num, node.sub, node.m, node.v, node.nm, node.op]:
+                if child is not None:
+                    return self.visit_array(child, subs, dim_list, size_list)
+        elif node.is_node(IRNodeType.Subexpression):
+            ret = self.visit_array(node.value, subs, dim_list, size_list)
+            if ret is not None:
+                ret = ("({})".format(ret[0]), ret[1])
+            return ret
+        elif node.is_node(IRNodeType.Id):
+            if node.contain_subscript():
+                return None
+            axis = subs.index(node.main_id)
+            return self.get_array_axis("Eigen::ArrayXd::LinSpaced({}, 1, {})".format(dim_list[axis], dim_list[axis]),
+                                       axis, dim_list), True
+        elif node.is_node(IRNodeType.SequenceIndex):
+            main_type = self.symtable[node.main.get_main_id()]
+            axis = self.get_grid_index(node.main_index, subs)
+            if axis is None or axis < 0 or node.row_index is not None or node.col_index is not None \
+                    or not main_type.element_type.is_scalar() or self.get_element_ctype(main_type.element_type) != "double":
+                return None
+            main_content = self.visit(node.main).content
+            size_list[axis].append(main_type.size)
+            return self.get_array_axis("Eigen::Map<const Eigen::ArrayXd>({}.data(), {}.size())".format(
+                main_content, main_content), axis, dim_list), True
+        elif node.is_node(IRNodeType.VectorIndex):
+            main_type = self.symtable[node.main.get_main_id()]
+            axis = self.get_grid_index(node.row_index, subs)
+            if axis is None or axis < 0 or self.get_element_ctype(main_type) != "double":
+                return None
+            size_list[axis].append(main_type.rows)
+            return self.get_array_axis("{}.array()".format(self.visit(node.main).content), axis, dim_list), True
+        elif node.is_node(IRNodeType.MatrixIndex):
+            main_type = self.symtable[node.main.get_main_id()]
+            if main_type.sparse or self.get_element_ctype(main_type) != "double":
+                return None
+            main_content = self.visit(node.main).content
+            row_axis = self.get_grid_index(node.row_index, subs)
+            col_axis = self.get_grid_index(node.col_index, subs)
+            if row_axis is None or col_axis is None:
+                return None
+            if row_axis >= 0 and col_axis >= 0:
+                size_list[row_axis].append(main_type.rows)
+                size_list[col_axis].append(main_type.cols)
+                if row_axis == col_axis:
+                    return self.get_array_axis("{}.diagonal().array()".format(main_content), row_axis, dim_list), True
+                elif row_axis == 0:
+                    return "{}.array()".format(main_content), True
+                return "{}.transpose().array()".format(main_content), True
+            elif row_axis >= 0:
+                size_list[row_axis].append(main_type.rows)
+                return self.get_array_axis("{}.col({}).array()".format(main_content, self.get_grid_index_content(node.col_index)),
+                                           row_axis, dim_list), True
+            size_list[col_axis].append(main_type.cols)
+            return self.get_array_axis("{}.row({}).transpose().array()".format(main_content, self.get_grid_index_content(node.row_index)),
+                                       col_axis, dim_list), True
+        elif node.is_node(IRNodeType.Add) or node.is_node(IRNodeType.Sub) or node.is_node(IRNodeType.Mul) \
+                or node.is_node(IRNodeType.Div):
+            left = self.visit_array(node.left, subs, dim_list, size_list)
+            right = self.visit_array(node.right, subs, dim_list, size_list)
+            if left is None or right is None:
+                return None
+            if node.is_node(IRNodeType.Add):
+                op = ' + '
+            elif node.is_node(IRNodeType.Sub):
+                op = ' - '
+            elif node.is_node(IRNodeType.Mul):
+                op = ' * '
+            else:
+                if not left[1]:
+                    # scalar divided by an array
+                    return "double({}) * ({}).inverse()".format(left[0], right[0]), True
+                elif not right[1]:
+                    return "{} / double({})".format(left[0], right[0]), True
+                op = ' / '
+            return left[0] + op + right[0], True
+        elif node.is_node(IRNodeType.Power):
+            base = self.visit_array(node.base, subs, dim_list, size_list)
+            if base is None or not base[1] or node.t:
+                return None
+            if node.r:
+                return "({}).inverse()".format(base[0]), True
+            power = self.visit_array(node.power, subs, dim_list, size_list)
+            if power is None or power[1]:
+                return None
+            return "({}).pow({})".format(base[0], power[0]), True
+        elif node.is_node(IRNodeType.Squareroot):
+            value = self.visit_array(node.value, subs, dim_list, size_list)
+            if value is None or not value[1]:
+                return None
+            return "({}).sqrt()".format(value[0]), True
+        elif node.is_node(IRNodeType.Norm):
+            value = self.visit_array(node.value, subs, dim_list, size_list)
+            if value is None or not value[1]:
+                return None
+            return "({}).abs()".format(value[0]), True
+        elif node.is_node(IRNodeType.MathFunc):
+            param = self.visit_array(node.param, subs, dim_list, size_list)
+            func_name = self.get_array_func_name(node)
+            if param is None or not param[1] or func_name is None:
+                return None
+            return "({}).{}()".format(param[0], func_name), True
+        return None
+
     def visit_norm(self, node, **kwargs):
         value_info = self.visit(node.value, **kwargs)
         value = value_info.content
@@ -598,13 +1379,22 @@ class CodeGenEigen(CodeGen):
                 base_info.content = "pow({}, {})".format(base_info.content, power_info.content)
             else:
                 name = self.generate_var_name('pow')
-                base_info.pre_list.append("    Eigen::MatrixPower<{}> {}({});\n".format(self.get_ctype(node.la_type), name, base_info.content))
+                base_content = base_info.content
+                if base_content not in self.symtable or base_content in self.parameters:
+                    # MatrixPower keeps a reference to the matrix, a Ref parameter or an expression would be a temporary
+                    base_content = self.generate_var_name('pow_base')
+                    base_info.pre_list.append("    {} {} = {};\n".format(self.get_ctype(node.la_type), base_content, base_info.content))
+                base_info.pre_list.append("    Eigen::MatrixPower<{}> {}({});\n".format(self.get_ctype(node.la_type), name, base_content))
                 base_info.content = "{}({})".format(name, power_info.content)
         base_info.pre_list += pre_list
         return base_info
 
     def visit_solver(self, node, **kwargs):
         pre_list = []
+        if node.factorization is not None:
+            right_info = self.visit(node.right, **kwargs)
+            right_info.content = "{}.solve({})".format(node.factorization, right_info.content)
+            return right_info
         left_info = self.visit(node.left, **kwargs)
         right_info = self.visit(node.right, **kwargs)
         left_info.pre_list += right_info.pre_list
@@ -623,6 +1413,13 @@ class CodeGenEigen(CodeGen):
         left_info.pre_list += pre_list
         return left_info
 
+    def visit_factorization(self, node, **kwargs):
+        lhs = kwargs[LHS]
+        matrix_info = self.visit(node.matrix, **kwargs)
+        content = "".join(matrix_info.pre_list)
+        content += "    Eigen::PartialPivLU<{}> {}({});\n".format(self.get_ctype(node.matrix.la_type), lhs, matrix_info.content)
+        return CodeNodeInfo(content)
+
     def visit_sparse_matrix(self, node, **kwargs):
         assign_node = node.get_ancestor(IRNodeType.Assignment)
         type_info = node
@@ -640,6 +1437,9 @@ class CodeGenEigen(CodeGen):
         assign_node = node.get_ancestor(IRNodeType.Assignment)
         sparse_node = node.get_ancestor(IRNodeType.SparseMatrix)
         subs = assign_node.left.subs
+        nonzeros = self.get_sparse_nonzeros(node, **kwargs)
+        if nonzeros is not None:
+            return nonzeros
         ret = ["    for( int {}=1; {}<={}; {}++){{\n".format(subs[0], subs[0], sparse_node.la_type.rows, subs[0]),
                "        for( int {}=1; {}<={}; {}++){{\n".format(subs[1], subs[1], sparse_node.la_type.cols, subs[1])]
         pre_list = []
@@ -651,8 +1451,74 @@ class CodeGenEigen(CodeGen):
             pre_list += cond_info.pre_list
         ret.append("        }\n")
         ret.append("    }\n")
+        if self.parallel_loop:
+            body = [line[4:] for line in ret[1:-1]]
+            ret = ["    " + line for line in self.get_parallel_triplets("tripletList_{}".format(assign_node.left.main.main_id),
+                                                                        subs[0], "1", sparse_node.la_type.rows, body)]
         return CodeNodeInfo(ret, pre_list)
 
+    def get_sparse_nonzeros(self, node, **kwargs):
+        """
+        Visit only the nonzeros when the structure of every branch is known (diagonals, members of an index set)
+        :param node: SparseIfsNode
+        :return: CodeNodeInfo, None if the scan is needed
+        """
+        assign_node = node.get_ancestor(IRNodeType.Assignment)
+        sparse_node = node.get_ancestor(IRNodeType.SparseMatrix)
+        subs = assign_node.left.subs
+        rows = sparse_node.la_type.rows
+        cols = sparse_node.la_type.cols
+        triplet = "tripletList_{}".format(assign_node.left.main.main_id)
+        pattern_list = []
+        for cond in node.cond_list:
+            pattern = self.get_sparse_if_pattern(cond, subs)
+            if pattern is None:
+                return None
+            pattern_list.append(pattern)
+        ret = []
+        reserve_list = []
+        for cond, pattern in zip(node.cond_list, pattern_list):
+            loop_index = len(ret)
+            if pattern.is_diagonal():
+                # i - j = offset
+                first, col_bound, col_content = pattern.get_diagonal_range(subs[0], cols)
+                reserve_list.append("std::min({}, {})".format(rows, cols))
+                ret.append("    for( int {}={}; {}<=std::min({}, {}); {}++){{\n".format(subs[0], first, subs[0], rows, col_bound, subs[0]))
+                ret.append("        int {} = {};\n".format(subs[1], col_content))
+            else:
+                set_info = self.visit(pattern.set_node, **kwargs)
+                ret += set_info.pre_list
+                tuple_name = self.generate_var_name("tuple")
+                if pattern.set_node.is_node(IRNodeType.Id):
+                    reserve_list.append("{}.size()".format(set_info.content))
+                ret.append("    for(const auto& {} : {}){{\n".format(tuple_name, set_info.content))
+                for index in range(2):
+                    item_content = "std::get<{}>({})".format(index, tuple_name)
+                    if pattern.item_offsets[index] > 0:
+                        item_content += " + {}".format(pattern.item_offsets[index])
+                    elif pattern.item_offsets[index] < 0:
+                        item_content += " - {}".format(-pattern.item_offsets[index])
+                    ret.append("        int {} = {};\n".format(pattern.item_subs[index], item_content))
+                ret.append("        if({} < 1 || {} > {} || {} < 1 || {} > {}){{\n".format(subs[0], subs[0], rows,
+                                                                                          subs[1], subs[1], cols))
+                ret.append("            continue;\n")
+                ret.append("        }\n")
+            self.convert_matrix = True
+            stat_info = self.visit(cond.stat, **kwargs)
+            self.convert_matrix = False
+            stat_content = stat_info.content.replace('_{}{}'.format(subs[0], subs[1]), '({}, {})'.format(subs[0], subs[1]))
+            ret += ['    ' + line for line in stat_info.pre_list]
+            ret.append("        {}.push_back(Eigen::Triplet<double>({}-1, {}-1, {}));\n".format(triplet, subs[0], subs[1], stat_content))
+            ret.append("    }\n")
+            if pattern.is_diagonal() and self.parallel_loop:
+                # the members of a set are visited in order by a single thread
+                body = [line[4:] for line in ret[loop_index+1:-1]]
+                ret = ret[:loop_index] + ["    " + line for line in self.get_parallel_triplets(
+                    triplet, subs[0], first, "std::min({}, {})".format(rows, col_bound), body)]
+        if len(reserve_list) == len(pattern_list):
+            ret.insert(0, "    {}.reserve({});\n".format(triplet, ' + '.join(reserve_list)))
+        return CodeNodeInfo(ret)
+
     def visit_sparse_if(self, node, **kwargs):
         self.convert_matrix = True
         assign_node = node.get_ancestor(IRNodeType.Assignment)
@@ -896,6 +1762,7 @@ class CodeGenEigen(CodeGen):
             main_index_content = main_index_info.content
         else:
             main_index_content = "{}-1".format(main_index_info.content)
+        element = self.get_sequence_element(main_info.content, main_index_content)
         if node.slice_matrix:
             if node.row_index is not None:
                 row_info = self.visit(node.row_index, **kwargs)
@@ -903,14 +1770,14 @@ class CodeGenEigen(CodeGen):
                     row_content = row_info.content
                 else:
                     row_content = "{}-1".format(row_info.content)
-                content = "{}.at({}).row({})".format(main_info.content, main_index_content, row_content)
+                content = "{}.row({})".format(element, row_content)
             else:
                 col_info = self.visit(node.col_index, **kwargs)
                 if node.col_index.la_type.index_type:
                     col_content = col_info.content
                 else:
                     col_content = "{}-1".format(col_info.content)
-                content = "{}.at({}).col({})".format(main_info.content, main_index_content, col_content)
+                content = "{}.col({})".format(element, col_content)
         else:
             if node.row_index is not None:
                 row_info = self.visit(node.row_index, **kwargs)
@@ -924,12 +1791,12 @@ class CodeGenEigen(CodeGen):
                         col_content = col_info.content
                     else:
                         col_content = "{}-1".format(col_info.content)
-                    content = "{}.at({})({}, {})".format(main_info.content, main_index_content, row_content, col_content)
+                    content = "{}({}, {})".format(element, row_content, col_content)
                 else:
                     # use [] instead of (): vector-like data structure
-                    content = "{}.at({})[{}]".format(main_info.content, main_index_content, row_content)
+                    content = "{}[{}]".format(element, row_content)
             else:
-                content = "{}.at({})".format(main_info.content, main_index_content)
+                content = element
         return CodeNodeInfo(content)
 
     def visit_mul(self, node, **kwargs):
@@ -963,8 +1830,19 @@ class CodeGenEigen(CodeGen):
         left_id = left_info.content
         kwargs[LHS] = left_id
         kwargs[ASSIGN_TYPE] = node.op
+        # the elements are independent when the rhs doesn't read the lhs
+        parallel_loop = node.left.contain_subscript() and self.use_parallel_loop() and \
+                        not self.contain_sub(node.right, node.left.get_main_id())
+        in_region = self.in_parallel_region
+        self.in_parallel_region = in_region or parallel_loop
+        self.parallel_loop = parallel_loop
         # self left-hand-side symbol
         right_info = self.visit(node.right, **kwargs)
+        self.in_parallel_region = in_region
+        self.parallel_loop = False
+        if node.right.is_node(IRNodeType.Factorization):
+            # declared by the factorization
+            return right_info
         right_exp = ""
         # y_i = stat
         if node.left.contain_subscript():
@@ -984,14 +1862,19 @@ class CodeGenEigen(CodeGen):
                                 content += '    std::vector<Eigen::Triplet<double> > tripletList_{};\n'.format(sequence)
                             else:
                                 content += '    tripletList_{}.clear();\n'.format(sequence)
-                        content += "    for( int {}=1; {}<={}; {}++){{\n".format(left_subs[0], left_subs[0],
-                                                                                 self.symtable[sequence].rows,
-                                                                                 left_subs[0])
+                        body = []
                         if right_info.pre_list:
-                            content += self.update_prelist_str(right_info.pre_list, "    ")
-                        content += '        tripletList_{}.push_back(Eigen::Triplet<double>({}-1, {}-1, {}));\n'.format(
-                            sequence, left_subs[0], left_subs[0], right_info.content)
-                        content += "    }\n"
+                            body += self.update_prelist_str(right_info.pre_list, "").splitlines(True)
+                        body.append('    tripletList_{}.push_back(Eigen::Triplet<double>({}-1, {}-1, {}));\n'.format(
+                            sequence, left_subs[0], left_subs[0], right_info.content))
+                        if parallel_loop:
+                            body = self.get_parallel_triplets("tripletList_{}".format(sequence), left_subs[0], "1",
+                                                              self.symtable[sequence].rows, body)
+                        else:
+                            body = ["for( int {}=1; {}<={}; {}++){{\n".format(left_subs[0], left_subs[0],
+                                                                              self.symtable[sequence].rows,
+                                                                              left_subs[0])] + body + ["}\n"]
+                        content += "".join(["    " + line for line in body])
                         content += '    {}.setFromTriplets(tripletList_{}.begin(), tripletList_{}.end());\n'.format(sequence, sequence,
                                                                                             sequence)
                     else:  # L_ij
@@ -1015,6 +1898,8 @@ class CodeGenEigen(CodeGen):
                 elif left_subs[0] == left_subs[1]:
                     # L_ii
                     content = ""
+                    if parallel_loop:
+                        content += "    #pragma omp parallel for\n"
                     content += "    for( int {}=1; {}<={}; {}++){{\n".format(left_subs[0], left_subs[0],
                                                                             self.symtable[sequence].rows, left_subs[0])
                     if right_info.pre_list:
@@ -1028,6 +1913,20 @@ class CodeGenEigen(CodeGen):
                             right_info.content = right_info.content.replace(right_var, "{}({}, {})".format(var_ids[0], var_ids[1][0], var_ids[1][1]))
                     right_exp += "    {}({}-1, {}-1) = {}".format(node.left.get_main_id(), left_subs[0], left_subs[1],
                                                                right_info.content)
+                    if self.symtable[sequence].is_matrix() and node.op == '=':
+                        dim_list = [self.symtable[sequence].rows, self.symtable[sequence].cols]
+                        array_content = self.get_array_content(node, left_subs, dim_list)
+                        if array_content is None and not parallel_loop:
+                            array_content = self.get_nullary_content(node, left_subs, dim_list, right_info)
+                        if array_content is not None:
+                            # one Eigen expression instead of the loops
+                            if sequence not in self.declared_symbols:
+                                content += "    Eigen::MatrixXd {} = {};\n".format(sequence, array_content)
+                            else:
+                                content += "    {} = {};\n".format(sequence, array_content)
+                            la_remove_key(LHS, **kwargs)
+                            self.declared_symbols.add(node.left.get_main_id())
+                            return CodeNodeInfo(content)
                     if self.symtable[sequence].is_matrix():
                         if node.op == '=':
                             # declare
@@ -1037,11 +1936,18 @@ class CodeGenEigen(CodeGen):
                                                                                                                   sequence].rows,
                                                                                                               self.symtable[
                                                                                                                   sequence].cols)
-                    content += "    for( int {}=1; {}<={}; {}++){{\n".format(left_subs[0], left_subs[0],
-                                                                            self.symtable[sequence].rows, left_subs[0])
-                    content += "        for( int {}=1; {}<={}; {}++){{\n".format(left_subs[1], left_subs[1],
-                                                                                self.symtable[sequence].cols,
-                                                                                left_subs[1])
+                    row_loop = "for( int {}=1; {}<={}; {}++){{\n".format(left_subs[0], left_subs[0],
+                                                                        self.symtable[sequence].rows, left_subs[0])
+                    col_loop = "for( int {}=1; {}<={}; {}++){{\n".format(left_subs[1], left_subs[1],
+                                                                        self.symtable[sequence].cols, left_subs[1])
+                    if parallel_loop:
+                        # a column per thread: the storage is column-major
+                        content += "    #pragma omp parallel for\n"
+                        content += "    " + col_loop
+                        content += "        " + row_loop
+                    else:
+                        content += "    " + row_loop
+                        content += "        " + col_loop
                     if right_info.pre_list:
                         content += self.update_prelist_str(right_info.pre_list, "        ")
                     content += "        " + right_exp + ";\n"
@@ -1055,7 +1961,7 @@ class CodeGenEigen(CodeGen):
                     if self.contain_subscript(right_var):
                         var_ids = self.get_all_ids(right_var)
                         right_info.content = right_info.content.replace(right_var,
-                                                                        "{}.at({})".format(var_ids[0], var_ids[1][0]))
+                                                                        self.get_sequence_element(var_ids[0], var_ids[1][0]))
 
                 ele_type = self.symtable[sequence].element_type
                 # definition
@@ -1063,12 +1969,27 @@ class CodeGenEigen(CodeGen):
                     right_exp += "    {} = {}".format(left_info.content, right_info.content)
                     content += "    {} {}({});\n".format(self.get_ctype(self.symtable[sequence]), sequence,
                                                          self.symtable[sequence].size)
+                    if parallel_loop:
+                        content += "    #pragma omp parallel for\n"
                     content += "    for( int {}=1; {}<={}; {}++){{\n".format(left_subs[0], left_subs[0],
                                                                             self.symtable[sequence].size, left_subs[0])
                 else:
+                    dim_list = [self.symtable[sequence].rows]
+                    array_content = None
+                    if self.get_element_ctype(self.symtable[sequence]) == "double":
+                        array_content = self.get_array_content(node, left_subs, dim_list)
+                    if array_content is None and not parallel_loop:
+                        array_content = self.get_nullary_content(node, left_subs, dim_list, right_info)
+                    if array_content is not None:
+                        content += "    {} {} = {};\n".format(self.get_ctype(self.symtable[sequence]), sequence, array_content)
+                        la_remove_key(LHS, **kwargs)
+                        self.declared_symbols.add(node.left.get_main_id())
+                        return CodeNodeInfo(content)
                     right_exp += "    {} = {}".format(left_info.content, right_info.content)
                     content += "    {} {}({});\n".format(self.get_ctype(self.symtable[sequence]), sequence,
                                                          self.symtable[sequence].rows)
+                    if parallel_loop:
+                        content += "    #pragma omp parallel for\n"
                     content += "    for( int {}=1; {}<={}; {}++){{\n".format(left_subs[0], left_subs[0],
                                                                             self.symtable[sequence].rows, left_subs[0])
                 if right_info.pre_list:
@@ -1188,13 +2109,392 @@ class CodeGenEigen(CodeGen):
         return CodeNodeInfo("")
 
     def visit_optimize(self, node, **kwargs):
-        return CodeNodeInfo("")
+        base_id = node.base.get_main_id()
+        base_type = node.base_type.la_type
+        if base_type.is_scalar():
+            size = 1
+        elif base_type.is_vector():
+            size = base_type.rows
+        else:
+            size = "{}*{}".format(base_type.rows, base_type.cols)
+        sign = ''
+        if node.opt_type == OptimizeType.OptimizeMax or node.opt_type == OptimizeType.OptimizeArgmax:
+            sign = '-'
+        # the optimization variable is only in the symbol table during the type walk
+        symtable = self.symtable
+        self.symtable = dict(symtable)
+        self.symtable[base_id] = base_type
+        pre_list = []
+        # objective and gradient
+        target_func = self.generate_var_name('target')
+        opt_param = self.generate_var_name('x')
+        opt_grad = self.generate_var_name('grad')
+        exp_info = self.visit(node.exp, **kwargs)
+        grad_list = []
+        derivative = None
+        self.derivative_failed = not (base_type.is_scalar() or base_type.is_vector())
+        if not self.derivative_failed:
+            derivative = self.get_derivative(node.exp, base_id, size, grad_list)
+        has_gradient = not self.derivative_failed
+        pre_list.append("    iheartla::Objective {} = [&](const Eigen::VectorXd & {}, Eigen::VectorXd * {}) -> double {{\n".format(target_func, opt_param, opt_grad))
+        pre_list.append(self.get_base_declaration(base_id, base_type, opt_param))
+        pre_list += self.get_indented(exp_info.pre_list)
+        if has_gradient:
+            pre_list.append("        if({}){{\n".format(opt_grad))
+            pre_list += self.get_indented(self.get_indented(grad_list))
+            if derivative is None:
+                pre_list.append("            *{} = Eigen::VectorXd::Zero({});\n".format(opt_grad, size))
+            else:
+                pre_list.append("            *{} = {}{}.transpose();\n".format(opt_grad, sign, derivative))
+            pre_list.append("        }\n")
+        pre_list.append("        return {}({});\n".format(sign, exp_info.content))
+        pre_list.append("    };\n")
+        # constraints: bounds of a scalar, set membership and the others for the augmented Lagrangian
+        lower_list = []
+        upper_list = []
+        candidates = None
+        cons = self.generate_var_name('cons')
+        cons_list = []
+        for cond_node in node.cond_list:
+            cond = cond_node.cond
+            if cond.is_node(IRNodeType.BinComp):
+                if cond.comp_type == IRNodeType.Ne:
+                    # satisfied almost everywhere, same as the NumPy output
+                    continue
+                greater, lesser = cond.left, cond.right
+                if cond.comp_type == IRNodeType.Lt or cond.comp_type == IRNodeType.Le:
+                    greater, lesser = cond.right, cond.left
+                bound = self.get_optimize_bound(greater, lesser, base_id, base_type, pre_list)
+                if bound is not None:
+                    lower_list.append(bound)
+                    if cond.comp_type == IRNodeType.Eq:
+                        upper_list.append(bound)
+                    continue
+                bound = self.get_optimize_bound(lesser, greater, base_id, base_type, pre_list)
+                if bound is not None:
+                    upper_list.append(bound)
+                    if cond.comp_type == IRNodeType.Eq:
+                        lower_list.append(bound)
+                    continue
+                greater_info = self.visit(greater, **kwargs)
+                lesser_info = self.visit(lesser, **kwargs)
+                cons_list.append((greater_info.pre_list + lesser_info.pre_list,
+                                  "({}) - ({})".format(greater_info.content, lesser_info.content),
+                                  cond.comp_type == IRNodeType.Eq))
+            elif cond.is_node(IRNodeType.In):
+                if candidates is None and len(cond.items) == 1 and self.get_sub_offset(cond.items[0], [base_id]) == (base_id, 0) and not base_type.is_matrix():
+                    candidates = self.get_optimize_candidates(cond.set, size, pre_list)
+                    continue
+                cond_info = self.visit(cond, **kwargs)
+                cons_list.append((cond_info.pre_list, "({}) ? 0 : 1".format(cond_info.content), True))
+        if len(cons_list) > 0:
+            pre_list.append("    std::vector<iheartla::Constraint> {};\n".format(cons))
+            for cons_pre_list, cons_content, equality in cons_list:
+                cons_param = self.generate_var_name('x')
+                pre_list.append("    {}.push_back({{[&](const Eigen::VectorXd & {}) -> double {{\n".format(cons, cons_param))
+                pre_list.append(self.get_base_declaration(base_id, base_type, cons_param))
+                pre_list += self.get_indented(cons_pre_list)
+                pre_list.append("        return {};\n".format(cons_content))
+                pre_list.append("    }}, {}}});\n".format('true' if equality else 'false'))
+        # solve from zero
+        opt_ret = self.generate_var_name('x')
+        init_value = "Eigen::VectorXd::Zero({})".format(size)
+        if candidates is None and len(lower_list) + len(upper_list) + len(cons_list) == 0:
+            opt_content = "iheartla::minimize({}, {}, {})".format(target_func, 'true' if has_gradient else 'false', init_value)
+        else:
+            lower = self.get_optimize_limit(lower_list, size, 'max', '-')
+            upper = self.get_optimize_limit(upper_list, size, 'min', '')
+            cons_param = cons if len(cons_list) > 0 else "{}"
+            if candidates is not None:
+                opt_content = "iheartla::minimize_over({}, {}, {}, {}, {}, {})".format(target_func, candidates, init_value, lower, upper, cons_param)
+            else:
+                opt_content = "iheartla::minimize({}, {}, {}, {}, {}, {})".format(target_func, 'true' if has_gradient else 'false',
+                                                                               init_value, lower, upper, cons_param)
+        pre_list.append("    Eigen::VectorXd {} = {};\n".format(opt_ret, opt_content))
+        if node.opt_type == OptimizeType.OptimizeMin or node.opt_type == OptimizeType.OptimizeMax:
+            content = "{}{}({}, nullptr)".format(sign, target_func, opt_ret)
+        elif base_type.is_scalar():
+            content = "{}(0)".format(opt_ret)
+        elif base_type.is_vector():
+            content = opt_ret
+        else:
+            content = "Eigen::Map<Eigen::MatrixXd>({}.data(), {}, {})".format(opt_ret, base_type.rows, base_type.cols)
+        self.symtable = symtable
+        return CodeNodeInfo(content, pre_list=pre_list)
+
+    def get_base_declaration(self, base_id, base_type, param):
+        """
+        :return: definition of the optimization variable in a lambda taking the vector param
+        """
+        if base_type.is_scalar():
+            return "        const double {} = {}(0);\n".format(base_id, param)
+        elif base_type.is_vector():
+            return "        const Eigen::VectorXd & {} = {};\n".format(base_id, param)
+        return "        const Eigen::Map<const Eigen::MatrixXd> {}({}.data(), {}, {});\n".format(base_id, param, base_type.rows, base_type.cols)
+
+    def get_optimize_bound(self, node, other, base_id, base_type, pre_list):
+        """
+        :return: bound of a scalar from the constraint node >= other when node is base_id plus a constant, else None
+        """
+        if not base_type.is_scalar() or self.contain_sub(other, base_id):
+            return None
+        sub_offset = self.get_sub_offset(node, [base_id])
+        if sub_offset is None or sub_offset[0] != base_id:
+            return None
+        other_info = self.visit(other)
+        pre_list += other_info.pre_list
+        if sub_offset[1] != 0:
+            return "({}) - {}".format(other_info.content, sub_offset[1])
+        return other_info.content
+
+    def get_optimize_limit(self, bound_list, size, func, sign):
+        if len(bound_list) == 0:
+            return "Eigen::VectorXd::Constant({}, {}std::numeric_limits<double>::infinity())".format(size, sign)
+        elif len(bound_list) == 1:
+            return "Eigen::VectorXd::Constant({}, {})".format(size, bound_list[0])
+        return "Eigen::VectorXd::Constant({}, std::{}<double>({{{}}}))".format(size, func, ', '.join(bound_list))
+
+    def get_optimize_candidates(self, set_node, size, pre_list):
+        """
+        :return: name of the list of the items of set_node, as vectors of the given size
+        """
+        set_info = self.visit(set_node)
+        pre_list += set_info.pre_list
+        candidates = self.generate_var_name('candidates')
+        offset = ''
+        if set_node.la_type.index_type:
+            offset = ' + 1'
+        items = ["std::get<{}>(item){}".format(index, offset) for index in range(set_node.la_type.size)]
+        pre_list.append("    std::vector<Eigen::VectorXd> {};\n".format(candidates))
+        pre_list.append("    for(const auto & item : {}){{\n".format(set_info.content))
+        pre_list.append("        Eigen::VectorXd candidate({});\n".format(size))
+        pre_list.append("        candidate << {};\n".format(', '.join(items)))
+        pre_list.append("        {}.push_back(candidate);\n".format(candidates))
+        pre_list.append("    }\n")
+        return candidates
+
+    def get_indented(self, pre_list):
+        """
+        :return: lines of pre_list moved into a lambda body
+        """
+        lines = "".join(pre_list).split('\n')
+        return ["    {}\n".format(line) for line in lines if line != '']
 
     def visit_domain(self, node, **kwargs):
         return CodeNodeInfo("")
 
     def visit_integral(self, node, **kwargs):
-        return CodeNodeInfo("")
+        pre_list = []
+        lower_info = self.visit(node.domain.lower, **kwargs)
+        pre_list += lower_info.pre_list
+        upper_info = self.visit(node.domain.upper, **kwargs)
+        pre_list += upper_info.pre_list
+        exp_info = self.visit(node.exp, **kwargs)
+        integrand = self.generate_var_name('integrand')
+        pre_list.append("    std::function<double(double)> {} = [&](double {}) -> double {{\n".format(integrand, node.base.get_main_id()))
+        pre_list += self.get_indented(exp_info.pre_list)
+        pre_list.append("        return {};\n".format(exp_info.content))
+        pre_list.append("    };\n")
+        content = "iheartla::integrate({}, {}, {})".format(integrand, lower_info.content, upper_info.content)
+        return CodeNodeInfo(content, pre_list=pre_list)
+
+    def is_row(self, la_type):
+        return la_type.is_matrix() and la_type.rows == 1
+
+    def is_column(self, la_type):
+        return la_type.is_vector() or (la_type.is_matrix() and la_type.cols == 1)
+
+    def get_derivative_rows(self, la_type):
+        """
+        :return: number of elements of a scalar, vector, row or column, None for the other types
+        """
+        if la_type.is_scalar():
+            return 1
+        elif self.is_column(la_type):
+            return la_type.rows
+        elif self.is_row(la_type):
+            return la_type.cols
+        return None
+
+    def get_derivative_value(self, node, pre_list, column=False):
+        """
+        :return: value of node used in a Jacobian, the elements of a row are put in a column when column is True
+        """
+        value_info = self.visit(node)
+        pre_list += value_info.pre_list
+        content = "({})".format(value_info.content)
+        if not node.la_type.is_scalar():
+            if self.get_element_ctype(node.la_type) == "int":
+                content = "{}.cast<double>()".format(content)
+            if column and self.is_row(node.la_type):
+                content = "{}.transpose()".format(content)
+        return content
+
+    def get_identity(self, size):
+        return "Eigen::MatrixXd::Identity({}, {})".format(size, size)
+
+    def get_jacobian_product(self, factor, derivative, size, factor_type):
+        """
+        :return: factor times the Jacobian derivative, without multiplying a matrix by the identity
+        """
+        if derivative == self.get_identity(size) and not factor_type.is_scalar():
+            return factor
+        return "{} * {}".format(factor, derivative)
+
+    def add_derivative(self, content, pre_list):
+        name = self.generate_var_name('d')
+        pre_list.append("    Eigen::MatrixXd {} = {};\n".format(name, content))
+        return name
+
+    def fail_derivative(self):
+        self.derivative_failed = True
+        return None
+
+    def get_derivative(self, node, base, size, pre_list):
+        """
+        Jacobian of a scalar, vector, row or column node with respect to the scalar or vector base
+        :param size: number of elements of base
+        :param pre_list: receives the statements computing the Jacobian
+        :return: the Jacobian, a matrix with a row for each element of node, or None when node doesn't depend on
+        base. The nodes that can't be differentiated set self.derivative_failed.
+        """
+        if not self.contain_sub(node, base):
+            return None
+        if node.la_type is not None and self.get_derivative_rows(node.la_type) is None:
+            return self.fail_derivative()
+        if node.is_node(IRNodeType.Id):
+            if node.contain_subscript() or node.main_id != base:
+                return self.fail_derivative()
+            return self.get_identity(size)
+        elif node.is_node(IRNodeType.VectorIndex):
+            if not self.is_sub_index(node.main, base) or self.contain_sub(node.row_index, base):
+                return self.fail_derivative()
+            index_content = self.get_grid_index_content(node.row_index)
+            return self.add_derivative("{}.row({})".format(self.get_identity(size), index_content), pre_list)
+        elif node.is_node(IRNodeType.Expression):
+            value = self.get_derivative(node.value, base, size, pre_list)
+            if value is None or not node.sign:
+                return value
+            return self.add_derivative("-{}".format(value), pre_list)
+        elif node.is_node(IRNodeType.Factor):
+            for child in [node.id, node.num, node.sub, node.nm, node.op]:
+                if child is not None:
+                    return self.get_derivative(child, base, size, pre_list)
+            return self.fail_derivative()
+        elif node.is_node(IRNodeType.Subexpression) or node.is_node(IRNodeType.Cast):
+            return self.get_derivative(node.value, base, size, pre_list)
+        elif node.is_node(IRNodeType.Add) or node.is_node(IRNodeType.Sub):
+            if node.left.la_type.is_scalar() != node.right.la_type.is_scalar():
+                return self.fail_derivative()
+            left = self.get_derivative(node.left, base, size, pre_list)
+            right = self.get_derivative(node.right, base, size, pre_list)
+            op = '+' if node.is_node(IRNodeType.Add) else '-'
+            if right is None:
+                return left
+            if left is None:
+                return right if op == '+' else self.add_derivative("-{}".format(right), pre_list)
+            return self.add_derivative("{} {} {}".format(left, op, right), pre_list)
+        elif node.is_node(IRNodeType.Mul):
+            left_type = node.left.la_type
+            right_type = node.right.la_type
+            left = self.get_derivative(node.left, base, size, pre_list)
+            right = self.get_derivative(node.right, base, size, pre_list)
+            terms = []
+            if left_type.is_scalar():
+                if right is not None:
+                    terms.append("{} * {}".format(self.get_derivative_value(node.left, pre_list), right))
+                if left is not None:
+                    terms.append(self.get_jacobian_product(self.get_derivative_value(node.right, pre_list, True), left, size, right_type))
+            elif right_type.is_scalar():
+                if left is not None:
+                    terms.append("{} * {}".format(left, self.get_derivative_value(node.right, pre_list)))
+                if right is not None:
+                    terms.append(self.get_jacobian_product(self.get_derivative_value(node.left, pre_list, True), right, size, left_type))
+            else:
+                # matrix times column or row times matrix
+                if right is not None:
+                    if not self.is_column(right_type):
+                        return self.fail_derivative()
+                    terms.append(self.get_jacobian_product(self.get_derivative_value(node.left, pre_list), right, size, left_type))
+                if left is not None:
+                    if not self.is_row(left_type):
+                        return self.fail_derivative()
+                    terms.append(self.get_jacobian_product("{}.transpose()".format(self.get_derivative_value(node.right, pre_list)), left, size, right_type))
+            if len(terms) == 0:
+                return None
+            return self.add_derivative(" + ".join(terms), pre_list)
+        elif node.is_node(IRNodeType.Div):
+            if not node.right.la_type.is_scalar():
+                return self.fail_derivative()
+            left = self.get_derivative(node.left, base, size, pre_list)
+            right = self.get_derivative(node.right, base, size, pre_list)
+            right_value = self.get_derivative_value(node.right, pre_list)
+            terms = []
+            if left is not None:
+                terms.append("{} / {}".format(left, right_value))
+            if right is not None:
+                terms.append("{} * {} / pow({}, 2)".format(self.get_derivative_value(node.left, pre_list, True), right, right_value))
+            if len(terms) == 0:
+                return None
+            if left is None:
+                return self.add_derivative("-{}".format(terms[0]), pre_list)
+            return self.add_derivative(" - ".join(terms), pre_list)
+        elif node.is_node(IRNodeType.Transpose):
+            return self.get_derivative(node.f, base, size, pre_list)
+        elif node.is_node(IRNodeType.Power):
+            if node.t:
+                return self.get_derivative(node.base, base, size, pre_list)
+            if not node.base.la_type.is_scalar() or (node.power is not None and self.contain_sub(node.power, base)):
+                return self.fail_derivative()
+            value = self.get_derivative(node.base, base, size, pre_list)
+            base_value = self.get_derivative_value(node.base, pre_list)
+            if node.r:
+                return self.add_derivative("-{} / pow({}, 2)".format(value, base_value), pre_list)
+            power_value = self.get_derivative_value(node.power, pre_list)
+            return self.add_derivative("{} * pow({}, {} - 1) * {}".format(power_value, base_value, power_value, value), pre_list)
+        elif node.is_node(IRNodeType.Norm):
+            value = self.get_derivative(node.value, base, size, pre_list)
+            if node.value.la_type.is_scalar():
+                return self.add_derivative("({} < 0 ? -1.0 : 1.0) * {}".format(self.get_derivative_value(node.value, pre_list), value), pre_list)
+            if node.norm_type != NormType.NormInteger or node.sub != 2:
+                return self.fail_derivative()
+            norm_value = self.get_derivative_value(node.value, pre_list, True)
+            # zero at the origin
+            return self.add_derivative("{} / std::max({}.norm(), std::numeric_limits<double>::min())".format(
+                self.get_jacobian_product("{}.transpose()".format(norm_value), value, size, node.value.la_type), norm_value), pre_list)
+        elif node.is_node(IRNodeType.Squareroot):
+            value = self.get_derivative(node.value, base, size, pre_list)
+            return self.add_derivative("{} / (2 * sqrt({}))".format(value, self.get_derivative_value(node.value, pre_list)), pre_list)
+        elif node.is_node(IRNodeType.MathFunc):
+            if node.func_type not in DERIVATIVE_FUNCS or not node.param.la_type.is_scalar():
+                return self.fail_derivative()
+            value = self.get_derivative(node.param, base, size, pre_list)
+            factor = DERIVATIVE_FUNCS[node.func_type].format(self.get_derivative_value(node.param, pre_list))
+            return self.add_derivative("{} * {}".format(factor, value), pre_list)
+        elif node.is_node(IRNodeType.Summation):
+            if node.local_stmts:
+                return self.fail_derivative()
+            sub = self.visit(node.id).content
+            name_convention, target_var = self.get_summation_conventions(node, sub)
+            self.add_name_conventions(name_convention)
+            body = []
+            value = self.get_derivative(node.exp, base, size, body)
+            cond_content = None
+            if node.cond:
+                cond_content = self.visit(node.cond).content
+            self.del_name_conventions(name_convention)
+            if value is None:
+                return None
+            name = self.generate_var_name('d')
+            body.append("    {} += {};\n".format(name, value))
+            if cond_content is not None:
+                body = ["    if({}){{\n".format(cond_content)] + self.get_indented(body) + ["    }\n"]
+            pre_list.append("    Eigen::MatrixXd {} = Eigen::MatrixXd::Zero({}, {});\n".format(name, self.get_derivative_rows(node.la_type), size))
+            pre_list.append("    for(int {}=1; {}<={}; {}++){{\n".format(sub, sub, self.get_summation_bound(node, sub, target_var), sub))
+            pre_list += self.get_indented(body)
+            pre_list.append("    }\n")
+            return name
+        return self.fail_derivative()
 
     def visit_inner_product(self, node, **kwargs):
         left_info = self.visit(node.left, **kwargs)
@@ -1,17 +1,43 @@
 from .codegen import *
 from .type_walker import *
+import ast
+import builtins
 import keyword
+import textwrap
 
 
 class CodeGenNumpy(CodeGen):
-    def __init__(self):
+    def __init__(self, numba=False):
         super().__init__(ParserTypeEnum.NUMPY)
+        self.numba = numba  # loops in @njit kernels
+        self.kernel_list = []  # numba kernels of the current function
+        self.nonzero_arrays = set()  # sparse matrices whose index/value lists became arrays
+        self.sparse_views = {}  # (sparse matrix, format) -> converted copy valid for the current statement
+        self.new_sparse_views = []  # conversions needed before the current statement
+        self.accumulated_sparse = set()  # sparse matrices with += contributions
+        self.sparse_builders = {}  # sparse matrix -> (index chunks, value chunks) of all its contributions
+        self.pending_sparse = set()  # sparse matrices with contributions not built yet
 
     def init_type(self, type_walker, func_name):
         super().init_type(type_walker, func_name)
+        self.nonzero_arrays.clear()
+        self.sparse_views.clear()
+        self.new_sparse_views.clear()
+        self.accumulated_sparse.clear()
+        self.sparse_builders.clear()
+        self.pending_sparse.clear()
         self.pre_str = '''"""\n{}\n"""\nimport numpy as np\nimport scipy\nimport scipy.linalg\nfrom scipy import sparse\n'''.format(self.la_content)
         self.pre_str += "from scipy.integrate import quad\n"
         self.pre_str += "from scipy.optimize import minimize\n"
+        if self.numba:
+            self.pre_str += "try:\n    import numba\n\n"
+            self.pre_str += "    def njit(*args, **kwargs):\n"
+            self.pre_str += "        # numba caches the kernels next to the source file, exec'd or compile()d code has none\n"
+            self.pre_str += "        if '__file__' not in globals():\n            kwargs.pop('cache', None)\n"
+            self.pre_str += "        return numba.njit(*args, **kwargs)\nexcept ImportError:\n"
+            self.pre_str += "    # plain NumPy without numba\n"
+            self.pre_str += "    def njit(*args, **kwargs):\n        return lambda func: func\n"
+        self.kernel_list = []
         self.pre_str += "\n\n"
         self.post_str = ''''''
 
@@ -98,11 +124,105 @@ class CodeGenNumpy(CodeGen):
             if len(node.subs) == 2:
                 if self.symtable[node.main_id].is_matrix():
                     if self.symtable[node.main_id].sparse:
-                        content = "{}.tocsr()[{}, {}]".format(node.main_id, node.subs[0], node.subs[1])
+                        content = "{}.get(({}, {}), 0)".format(self.get_sparse_view(node.main_id, 'dok'), node.subs[0], node.subs[1])
                     else:
                         content = "{}[{}][{}]".format(node.main_id, node.subs[0], node.subs[1])
         return CodeNodeInfo(content)
 
+    def get_sparse_view(self, symbol, format):
+        """
+        The sparse matrix converted once for its element accesses: csr for rows, csc for columns,
+        dok (as a dict) for scalar reads. The conversion is emitted before the current statement.
+        :return: name of the converted matrix
+        """
+        key = (symbol, format)
+        if key not in self.sparse_views:
+            name = self.generate_var_name("{}_{}".format(symbol, format))
+            self.sparse_views[key] = name
+            if format == 'dok':
+                self.new_sparse_views.append("    {} = dict({}.todok().items())\n".format(name, symbol))
+            else:
+                self.new_sparse_views.append("    {} = {}.to{}()\n".format(name, symbol, format))
+        return self.sparse_views[key]
+
+    def get_sparse_build_content(self, symbol):
+        """
+        Build the accumulated sparse matrix from its triplet chunks, duplicates summed. The entries keep the order of
+        a += rebuild: the latest contribution first, each entry where its coordinates first appear
+        """
+        index_chunks, value_chunks = self.sparse_builders[symbol]
+        self.pending_sparse.discard(symbol)
+        index = self.generate_var_name("{}_index".format(symbol))
+        value = self.generate_var_name("{}_value".format(symbol))
+        first = self.generate_var_name("{}_first".format(symbol))
+        inverse = self.generate_var_name("{}_inverse".format(symbol))
+        order = self.generate_var_name("{}_order".format(symbol))
+        rows, cols = self.symtable[symbol].rows, self.symtable[symbol].cols
+        content = "    {} = np.concatenate({}[::-1])\n".format(index, index_chunks)
+        content += "    {} = np.concatenate({}[::-1])\n".format(value, value_chunks)
+        content += "    _, {}, {} = np.unique({}[:, 0] * {} + {}[:, 1], return_index=True, return_inverse=True)\n".format(
+            first, inverse, index, cols, index)
+        content += "    {} = np.argsort({})\n".format(order, first)
+        content += "    {} = scipy.sparse.coo_matrix((np.bincount({}.ravel(), weights={})[{}], {}[{}[{}]].T), shape=({}, {}))\n".format(
+            symbol, inverse, value, order, index, first, order, rows, cols)
+        return content
+
+    def is_numba_symbol(self, symbol):
+        """
+        :return: whether the symbol is a number or a dense array, so that numba can type it
+        """
+        if symbol in self.dim_dict:
+            return True
+        if symbol not in self.symtable:
+            return False
+        la_type = self.symtable[symbol]
+        if la_type.is_sequence():
+            la_type = la_type.element_type
+        return la_type.is_scalar() or la_type.is_vector() or (la_type.is_matrix() and not la_type.sparse)
+
+    def get_numba_kernel(self, content, lhs, defined_symbols):
+        """
+        Move the loops of a statement into an @njit kernel
+        :param content: generated statement
+        :param lhs: symbol defined by the statement
+        :param defined_symbols: parameters and symbols defined by the previous statements
+        :return: call of the kernel, None if the statement has no loop or numba can't compile it
+        """
+        try:
+            tree = ast.parse(textwrap.dedent(content))
+        except SyntaxError:
+            return None
+        loaded = []
+        stored = set()
+        has_loop = False
+        for node in ast.walk(tree):
+            if isinstance(node, ast.For) or isinstance(node, ast.While):
+                has_loop = True
+            elif isinstance(node, ast.Name):
+                if isinstance(node.ctx, ast.Store):
+                    stored.add(node.id)
+                elif node.id not in loaded:
+                    loaded.append(node.id)
+            elif isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'np':
+                # np.linalg and the other submodules are left to numpy
+                if node.attr in ['linalg', 'random', 'matrix']:
+                    return None
+        if not has_loop or lhs not in stored:
+            return None
+        args = []
+        for name in loaded:
+            if name in stored or name == 'np' or hasattr(builtins, name):
+                continue
+            if name not in defined_symbols or not self.is_numba_symbol(name):
+                return None
+            args.append(name)
+        kernel_name = self.generate_var_name("{}_kernel".format(self.func_name))
+        kernel = "@njit(cache=True)\ndef {}({}):\n".format(kernel_name, ', '.join(args))
+        kernel += content.rstrip('\n') + '\n'
+        kernel += "    return {}\n".format(lhs)
+        self.kernel_list.append(kernel)
+        return "    {} = {}({})\n".format(lhs, kernel_name, ', '.join(args))
+
     def get_struct_definition(self):
         assign_list = []
         for parameter in self.lhs_list:
@@ -116,6 +236,250 @@ class CodeGenNumpy(CodeGen):
     def get_ret_struct(self):
         return "{}({})".format(self.get_result_type(), ', '.join(self.lhs_list))
 
+    def get_batched_function(self, node):
+        """
+        <func>_batched: every parameter has an extra leading batch axis, the fields of the result are stacked
+        along it. The statements are lowered to operations on stacks when possible, otherwise <func> is
+        called on each set of parameters.
+        :param node: BlockNode
+        """
+        if len(self.parameters) == 0:
+            return ''
+        name = "{}_batched".format(self.func_name)
+        content = "def {}({}):\n".format(name, ', '.join(self.parameters))
+        content += '    """\n    {} over a leading batch axis of every parameter\n    """\n'.format(self.func_name)
+        body = self.get_stacked_body(node)
+        if body is not None:
+            return content + body + "    return {}\n".format(self.get_ret_struct())
+        content += "    results = [{}(*params) for params in zip({})]\n".format(self.func_name, ', '.join(self.parameters))
+        field_list = []
+        for lhs in self.lhs_list:
+            field = "[result.{} for result in results]".format(lhs)
+            la_type = self.symtable[lhs]
+            if la_type.is_scalar() or la_type.is_vector() or (la_type.is_matrix() and not la_type.sparse):
+                field = "np.stack({})".format(field)
+            field_list.append(field)
+        content += "    return {}({})\n".format(self.get_result_type(), ', '.join(field_list))
+        return content
+
+    def get_stacked_body(self, node):
+        """
+        :return: checks and statements of the batched function, None if they can't be lowered to stacks
+        """
+        batch = self.generate_var_name("batch")
+        content = ""
+        check_list = []
+        stacked_dict = {}  # symbol -> ndim of an item
+        for parameter in self.parameters:
+            la_type = self.symtable[parameter]
+            if la_type.is_scalar() and not la_type.is_int:
+                stacked_dict[parameter] = 0
+                check_list.append("    assert {}.shape == ({},)\n".format(parameter, batch))
+            elif la_type.is_vector() and not self.is_int_element(la_type):
+                stacked_dict[parameter] = 1
+                check_list.append("    assert {}.shape == ({}, {})\n".format(parameter, batch, la_type.rows))
+            elif la_type.is_matrix() and not la_type.sparse and not self.is_int_element(la_type):
+                stacked_dict[parameter] = 2
+                check_list.append("    assert {}.shape == ({}, {}, {})\n".format(parameter, batch, la_type.rows, la_type.cols))
+            else:
+                return None
+            content += "    {} = np.asarray({}, dtype=np.float64)\n".format(parameter, parameter)
+        content += "    {} = {}.shape[0]\n".format(batch, self.parameters[0])
+        for key, target_dict in self.dim_dict.items():
+            if key in self.parameters:
+                return None
+            target = list(target_dict.keys())[0]
+            content += "    {} = {}.shape[{}]\n".format(key, target, target_dict[target] + 1)
+        content += ''.join(check_list)
+        dim_checks = self.get_dim_check_str()
+        if len(dim_checks) > 0:
+            content += '\n'.join(dim_checks) + '\n'
+        content += '\n'
+        for index in range(len(node.stmts)):
+            stmt = node.stmts[index]
+            if stmt.is_node(IRNodeType.Assignment):
+                if stmt.op != '=' or not stmt.left.is_node(IRNodeType.Id) or stmt.left.contain_subscript():
+                    return None
+                if stmt.right.is_node(IRNodeType.Factorization):
+                    # the stacked solves factorize on their own
+                    continue
+                lhs = stmt.left.get_main_id()
+                ret = self.visit_stacked(stmt.right, stacked_dict)
+            elif index == len(node.stmts) - 1:
+                lhs = self.ret_symbol
+                ret = self.visit_stacked(stmt, stacked_dict)
+            else:
+                continue
+            if ret is None or not ret[2]:
+                return None
+            content += "    {} = {}\n".format(self.filter_symbol(lhs), ret[0])
+            stacked_dict[lhs] = ret[1]
+        return content + '\n'
+
+    def is_int_element(self, la_type):
+        return isinstance(la_type.element_type, LaVarType) and la_type.element_type.is_scalar() and la_type.element_type.is_int
+
+    def get_stacked_operand(self, operand, ndim):
+        # append axes so that a stack of items with fewer dimensions broadcasts against the other operand
+        content, cur_ndim, stacked = operand
+        if stacked and cur_ndim < ndim:
+            return "({})[{}]".format(content, ', '.join([':'] + ['None'] * (ndim - cur_ndim)))
+        return content
+
+    def visit_stacked(self, node, stacked_dict):
+        """
+        Lower an expression of the batched function
+        :param stacked_dict: ndim of an item of each stacked symbol
+        :return: (content, ndim of an item, stacked), None if the node isn't supported
+        """
+        if node.is_node(IRNodeType.Expression):
+            ret = self.visit_stacked(node.value, stacked_dict)
+            if ret is not None and node.sign:
+                ret = ('-' + ret[0], ret[1], ret[2])
+            return ret
+        elif node.is_node(IRNodeType.Factor):
+            for child in [node.id, node.num, node.sub, node.op, getattr(node, 'c', None)]:
+                if child is not None:
+                    return self.visit_stacked(child, stacked_dict)
+            return None
+        elif node.is_node(IRNodeType.Subexpression):
+            ret = self.visit_stacked(node.value, stacked_dict)
+            if ret is not None:
+                ret = ("({})".format(ret[0]), ret[1], ret[2])
+            return ret
+        elif node.is_node(IRNodeType.Id):
+            if node.contain_subscript():
+                return None
+            if node.main_id in stacked_dict:
+                return self.visit(node).content, stacked_dict[node.main_id], True
+            if node.main_id in self.dim_dict:
+                return self.visit(node).content, 0, False
+            return None
+        elif node.is_node(IRNodeType.Integer) or node.is_node(IRNodeType.Double) or node.is_node(IRNodeType.Constant):
+            return self.visit(node).content, 0, False
+        elif node.is_node(IRNodeType.Add) or node.is_node(IRNodeType.Sub):
+            left = self.visit_stacked(node.left, stacked_dict)
+            right = self.visit_stacked(node.right, stacked_dict)
+            if left is None or right is None:
+                return None
+            ndim = max(left[1], right[1])
+            op = ' + ' if node.is_node(IRNodeType.Add) else ' - '
+            return self.get_stacked_operand(left, ndim) + op + self.get_stacked_operand(right, ndim), ndim, left[2] or right[2]
+        elif node.is_node(IRNodeType.Mul):
+            left = self.visit_stacked(node.left, stacked_dict)
+            right = self.visit_stacked(node.right, stacked_dict)
+            if left is None or right is None:
+                return None
+            if left[1] == 0 or right[1] == 0:
+                ndim = max(left[1], right[1])
+                return self.get_stacked_operand(left, ndim) + ' * ' + self.get_stacked_operand(right, ndim), ndim, left[2] or right[2]
+            if not left[2] or not right[2]:
+                return None
+            # same shapes as @ on each item
+            subscripts = {(2, 2): ('bij,bjk->bik', 2), (2, 1): ('bij,bj->bi', 1), (1, 2): ('bi,bij->bj', 1),
+                          (1, 1): ('bi,bi->b', 0)}[(left[1], right[1])]
+            return "np.einsum('{}', {}, {})".format(subscripts[0], left[0], right[0]), subscripts[1], True
+        elif node.is_node(IRNodeType.Div):
+            left = self.visit_stacked(node.left, stacked_dict)
+            right = self.visit_stacked(node.right, stacked_dict)
+            if left is None or right is None or right[1] != 0:
+                return None
+            return left[0] + ' / ' + self.get_stacked_operand(right, left[1]), left[1], left[2] or right[2]
+        elif node.is_node(IRNodeType.Transpose):
+            ret = self.visit_stacked(node.f, stacked_dict)
+            if ret is None or not ret[2]:
+                return None
+            if ret[1] == 1:
+                return "({})[:, None, :]".format(ret[0]), 2, True
+            elif ret[1] == 2:
+                return "np.swapaxes({}, 1, 2)".format(ret[0]), 2, True
+            return ret
+        elif node.is_node(IRNodeType.Power):
+            base = self.visit_stacked(node.base, stacked_dict)
+            if base is None:
+                return None
+            if node.t:
+                if base[1] == 2:
+                    return "np.swapaxes({}, 1, 2)".format(base[0]), 2, base[2]
+                return base
+            elif node.r:
+                if base[1] == 0:
+                    return "1 / ({})".format(base[0]), 0, base[2]
+                elif base[1] == 2 and base[2]:
+                    return "np.linalg.inv({})".format(base[0]), 2, True
+                return None
+            power = self.visit_stacked(node.power, stacked_dict)
+            if power is None or power[1] != 0:
+                return None
+            if base[1] == 0:
+                return "np.power({}, {})".format(base[0], power[0]), 0, base[2] or power[2]
+            elif base[1] == 2 and base[2] and not power[2]:
+                return "np.linalg.matrix_power({}, {})".format(base[0], power[0]), 2, True
+            return None
+        elif node.is_node(IRNodeType.Solver):
+            left = self.visit_stacked(node.left, stacked_dict)
+            right = self.visit_stacked(node.right, stacked_dict)
+            if left is None or right is None or left[1] != 2 or not left[2] or not right[2]:
+                return None
+            if right[1] == 1:
+                return "np.linalg.solve({}, ({})[..., None])[..., 0]".format(left[0], right[0]), 1, True
+            elif right[1] == 2:
+                return "np.linalg.solve({}, {})".format(left[0], right[0]), 2, True
+            return None
+        elif node.is_node(IRNodeType.Squareroot):
+            ret = self.visit_stacked(node.value, stacked_dict)
+            if ret is None:
+                return None
+            return "np.sqrt({})".format(ret[0]), ret[1], ret[2]
+        elif node.is_node(IRNodeType.MathFunc):
+            param = self.visit_stacked(node.param, stacked_dict)
+            if param is None:
+                return None
+            if node.func_type == MathFuncType.MathFuncAtan2:
+                remain = self.visit_stacked(node.remain_params[0], stacked_dict)
+                if remain is None or param[1] != 0 or remain[1] != 0:
+                    return None
+                return "np.arctan2({}, {})".format(param[0], remain[0]), 0, param[2] or remain[2]
+            elif node.func_type <= MathFuncType.MathFuncSqrt:
+                return "{}({})".format(self.get_math_func_name(node), param[0]), param[1], param[2]
+            elif param[1] == 2 and param[2]:
+                if node.func_type == MathFuncType.MathFuncTrace:
+                    return "np.trace({}, axis1=1, axis2=2)".format(param[0]), 0, True
+                elif node.func_type == MathFuncType.MathFuncDet:
+                    return "np.linalg.det({})".format(param[0]), 0, True
+                elif node.func_type == MathFuncType.MathFuncInv:
+                    return "np.linalg.inv({})".format(param[0]), 2, True
+            return None
+        elif node.is_node(IRNodeType.Norm):
+            value = self.visit_stacked(node.value, stacked_dict)
+            if value is None:
+                return None
+            if value[1] == 0:
+                return "np.absolute({})".format(value[0]), 0, value[2]
+            elif not value[2]:
+                return None
+            elif value[1] == 1:
+                if node.norm_type == NormType.NormInteger:
+                    return "np.linalg.norm({}, {}, axis=1)".format(value[0], node.sub), 0, True
+                elif node.norm_type == NormType.NormMax:
+                    return "np.linalg.norm({}, np.inf, axis=1)".format(value[0]), 0, True
+            elif value[1] == 2:
+                if node.norm_type == NormType.NormDet:
+                    return "np.linalg.det({})".format(value[0]), 0, True
+                elif node.norm_type == NormType.NormFrobenius:
+                    return "np.linalg.norm({}, axis=(1, 2))".format(value[0]), 0, True
+                elif node.norm_type == NormType.NormNuclear:
+                    return "np.linalg.norm({}, 'nuc', axis=(1, 2))".format(value[0]), 0, True
+            return None
+        elif node.is_node(IRNodeType.Cast):
+            value = self.visit_stacked(node.value, stacked_dict)
+            if value is None or not node.la_type.is_scalar():
+                return None
+            if value[1] == 0:
+                return value
+            return "({}).reshape(-1)".format(value[0]), 0, value[2]
+        return None
+
     def visit_block(self, node, **kwargs):
         type_checks = []
         type_declare = []
@@ -284,6 +648,7 @@ class CodeGenNumpy(CodeGen):
                 test_content += self.get_func_test_str(parameter, self.symtable[parameter], rand_int_max)
             main_content.append('    print("{}:", {})'.format(parameter, parameter))
         content = self.get_struct_definition() + '\n'
+        kernel_index = len(content)
         content += 'def ' + self.func_name + '(' + ', '.join(self.parameters) + '):\n'
         if show_doc:
             content += '    \"\"\"\n' + '\n'.join(doc) + '\n    \"\"\"\n'
@@ -294,9 +659,22 @@ class CodeGenNumpy(CodeGen):
         type_checks += self.get_dim_check_str()
         if len(type_checks) > 0:
             content += '\n'.join(type_checks) + '\n\n'
+        # the checked entry point delegates to the one that trusts its inputs
+        unchecked_name = "{}_unchecked".format(self.func_name)
+        content += '    return {}({})\n\n\n'.format(unchecked_name, ', '.join(self.parameters))
+        content += 'def ' + unchecked_name + '(' + ', '.join(self.parameters) + '):\n'
+        content += '    \"\"\"\n    {} without the conversions and checks: the arrays must already be float64 with the right shapes\n    \"\"\"\n'.format(self.func_name)
+        if dim_content:
+            content += dim_content + '\n'
         #
         # statements
         stats_content = ""
+        defined_symbols = set(self.parameters) | set(self.dim_dict.keys())
+        for stmt in node.stmts:
+            if stmt.is_node(IRNodeType.Assignment) and stmt.op == '+=':
+                lhs = stmt.left.get_main_id()
+                if self.symtable[lhs].is_matrix() and self.symtable[lhs].sparse:
+                    self.accumulated_sparse.add(lhs)
         for index in range(len(node.stmts)):
             ret_str = ''
             if index == len(node.stmts) - 1:
@@ -307,14 +685,41 @@ class CodeGenNumpy(CodeGen):
                 if type(node.stmts[index]).__name__ != 'AssignNode':
                     # meaningless
                     continue
+            stmt = node.stmts[index]
+            for symbol in sorted(self.pending_sparse):
+                if self.contain_sub(stmt.right if stmt.is_node(IRNodeType.Assignment) else stmt, symbol):
+                    stats_content += self.get_sparse_build_content(symbol)
             stat_info = self.visit(node.stmts[index], **kwargs)
-            if stat_info.pre_list:
-                stats_content += "".join(stat_info.pre_list)
-            stats_content += ret_str + stat_info.content + '\n'
+            if self.new_sparse_views:
+                stats_content += "".join(self.new_sparse_views)
+                self.new_sparse_views.clear()
+            stat_content = "".join(stat_info.pre_list) + ret_str + stat_info.content + '\n'
+            if self.numba:
+                lhs = stmt.left.get_main_id() if stmt.is_node(IRNodeType.Assignment) else self.ret_symbol
+                kernel_call = self.get_numba_kernel(stat_content, self.filter_symbol(lhs), defined_symbols)
+                if kernel_call is not None:
+                    stat_content = kernel_call + '\n'
+                defined_symbols.add(self.filter_symbol(lhs))
+            stats_content += stat_content
+            if node.stmts[index].is_node(IRNodeType.Assignment):
+                # the conversions are stale once the matrix is redefined
+                lhs = node.stmts[index].left.get_main_id()
+                for key in [key for key in self.sparse_views if key[0] == lhs]:
+                    del self.sparse_views[key]
+                if lhs in self.sparse_builders and lhs not in self.pending_sparse:
+                    # redefined without the builder
+                    del self.sparse_builders[lhs]
+        for symbol in sorted(self.pending_sparse):
+            stats_content += self.get_sparse_build_content(symbol) + '\n'
 
         content += stats_content
         content += '    return ' + self.get_ret_struct()
         content += '\n'
+        if len(self.kernel_list) > 0:
+            content = content[:kernel_index] + '\n\n'.join(self.kernel_list) + '\n\n' + content[kernel_index:]
+        batched_content = self.get_batched_function(node)
+        if batched_content:
+            content += '\n\n' + batched_content
         # test
         test_function += test_content
         test_function.append('    return {}'.format(', '.join(self.parameters)))
@@ -351,7 +756,12 @@ class CodeGenNumpy(CodeGen):
             cond_info = self.visit(node.cond, **kwargs)
             cond_content = "if(" + cond_info.content + "):\n"
         kwargs[WALK_TYPE] = WalkTypeEnum.RETRIEVE_EXPRESSION
+        if not node.cond and not node.local_stmts:
+            vectorized_content = self.get_vectorized_summation(node, sub)
+            if vectorized_content is not None:
+                return CodeNodeInfo(assign_id, pre_list=["    {} = {}\n".format(assign_id, vectorized_content)])
         content = []
+        local_content = self.get_local_stmts_str(node)
         exp_info = self.visit(node.exp)
         exp_str = exp_info.content
         if self.symtable[assign_id].is_matrix():
@@ -368,8 +778,8 @@ class CodeGenNumpy(CodeGen):
             content.append("for {} in range(1, {}.shape[0]+1):\n".format(sub, target_var[0]))
         else:
             content.append("for {} in range(1, len({})+1):\n".format(sub, target_var[0]))
-        if exp_info.pre_list:   # catch pre_list
-            list_content = "".join(exp_info.pre_list)
+        if local_content or exp_info.pre_list:   # catch pre_list
+            list_content = local_content + "".join(exp_info.pre_list)
             # content += exp_info.pre_list
             list_content = list_content.split('\n')
             for index in range(len(list_content)):
@@ -384,6 +794,386 @@ class CodeGenNumpy(CodeGen):
         content[0] = "    " + content[0]
         return CodeNodeInfo(assign_id, pre_list=["    ".join(content)])
 
+    def get_local_stmts_str(self, node):
+        """
+        :return: the assignments of the temporaries computed in each iteration of the summation node
+        """
+        content = ""
+        for stmt in node.local_stmts:
+            right_info = self.visit(stmt.right)
+            if right_info.pre_list:
+                content += "".join(right_info.pre_list)
+            content += "    {} = {}\n".format(stmt.left.get_main_id(), right_info.content)
+        return content
+
+    def get_vectorized_summation(self, node, sub):
+        """
+        Lower the summation to array operations over all the terms at once (np.sum over the first axis, np.einsum,
+        batched @) when the body only indexes sequences, vectors and matrices with the summation subscript.
+        :return: the content, None when the loop is needed (conditions, function calls, nested summations, ...)
+        """
+        if self.symtable[node.symbol].is_sequence():
+            return None
+        size_list = []
+        ret = self.visit_batched(node.exp, sub, size_list)
+        if ret is None or not ret[1]:
+            return None
+        # the loop only runs over the first sequence
+        if len(set([str(size) for size in size_list])) != 1:
+            return None
+        return "np.sum({}, axis=0)".format(ret[0])
+
+    def get_batched_scalar(self, content, la_type):
+        # align the batched scalars of shape (n,) with the vector or matrix terms
+        if la_type.is_vector():
+            return "({})[:, None]".format(content)
+        elif la_type.is_matrix():
+            return "({})[:, None, None]".format(content)
+        return content
+
+    def visit_batched(self, node, sub, size_list):
+        """
+        :param size_list: lengths of the indexed dimensions, they have to be the same
+        :return: (content, batched) where a batched content has an extra first axis for the subscript, None if the
+        node can't be lowered
+        """
+        if not self.contain_sub(node, sub):
+            info = self.visit(node)
+            if info is None or info.pre_list:
+                return None
+            return info.content, False
+        if node.is_node(IRNodeType.Expression):
+            ret = self.visit_batched(node.value, sub, size_list)
+            if ret is not None and node.sign:
+                ret = ('-' + ret[0], ret[1])
+            return ret
+        elif node.is_node(IRNodeType.Factor):
+            for child in [node.id, node.num, node.sub, node.m, node.v, node.nm, node.op]:
+                if child is not None:
+                    return self.visit_batched(child, sub, size_list)
+        elif node.is_node(IRNodeType.Subexpression):
+            ret = self.visit_batched(node.value, sub, size_list)
+            if ret is not None:
+                ret = ("({})".format(ret[0]), ret[1])
+            return ret
+        elif node.is_node(IRNodeType.SequenceIndex):
+            main_type = self.symtable[node.main.get_main_id()]
+            if not self.is_sub_index(node.main_index, sub) or node.row_index is not None or node.col_index is not None \
+                    or self.contain_sub(node.main, sub):
+                return None
+            ele_type = main_type.element_type
+            if not (ele_type.is_scalar() or ele_type.is_vector() or (ele_type.is_matrix() and not ele_type.sparse)):
+                return None
+            size_list.append(main_type.size)
+            return self.visit(node.main).content, True
+        elif node.is_node(IRNodeType.VectorIndex):
+            if not self.is_sub_index(node.row_index, sub) or self.contain_sub(node.main, sub):
+                return None
+            size_list.append(self.symtable[node.main.get_main_id()].rows)
+            return self.visit(node.main).content, True
+        elif node.is_node(IRNodeType.MatrixIndex):
+            main_type = self.symtable[node.main.get_main_id()]
+            if main_type.sparse or self.contain_sub(node.main, sub):
+                return None
+            main_content = self.visit(node.main).content
+            row_sub = self.is_sub_index(node.row_index, sub)
+            col_sub = self.is_sub_index(node.col_index, sub)
+            if row_sub and col_sub:
+                size_list += [main_type.rows, main_type.cols]
+                return "np.diagonal({})".format(main_content), True
+            elif row_sub and node.col_index is None:
+                size_list.append(main_type.rows)
+                return main_content, True
+            elif col_sub and node.row_index is None:
+                size_list.append(main_type.cols)
+                return "{}.T".format(main_content), True
+            elif row_sub and not self.contain_sub(node.col_index, sub):
+                col_content = self.visit(node.col_index).content
+                if not node.col_index.la_type.index_type:
+                    col_content = "{}-1".format(col_content)
+                size_list.append(main_type.rows)
+                return "{}[:, {}]".format(main_content, col_content), True
+            elif col_sub and not self.contain_sub(node.row_index, sub):
+                row_content = self.visit(node.row_index).content
+                if not node.row_index.la_type.index_type:
+                    row_content = "{}-1".format(row_content)
+                size_list.append(main_type.cols)
+                return "{}[{}, :]".format(main_content, row_content), True
+        elif node.is_node(IRNodeType.Add) or node.is_node(IRNodeType.Sub):
+            left = self.visit_batched(node.left, sub, size_list)
+            right = self.visit_batched(node.right, sub, size_list)
+            if left is None or right is None:
+                return None
+            op = ' + ' if node.is_node(IRNodeType.Add) else ' - '
+            return left[0] + op + right[0], True
+        elif node.is_node(IRNodeType.Mul):
+            return self.visit_batched_mul(node, sub, size_list)
+        elif node.is_node(IRNodeType.Div):
+            left = self.visit_batched(node.left, sub, size_list)
+            right = self.visit_batched(node.right, sub, size_list)
+            if left is None or right is None or not node.right.la_type.is_scalar():
+                return None
+            right_content = right[0]
+            if right[1]:
+                right_content = self.get_batched_scalar(right_content, node.left.la_type)
+            return "{} / {}".format(left[0], right_content), True
+        elif node.is_node(IRNodeType.Norm):
+            value = self.visit_batched(node.value, sub, size_list)
+            if value is None or not value[1]:
+                return None
+            value_type = node.value.la_type
+            if value_type.is_scalar():
+                return "np.absolute({})".format(value[0]), True
+            elif value_type.is_vector():
+                if node.norm_type == NormType.NormInteger:
+                    return "np.linalg.norm({}, {}, axis=1)".format(value[0], node.sub), True
+                elif node.norm_type == NormType.NormMax:
+                    return "np.linalg.norm({}, np.inf, axis=1)".format(value[0]), True
+                elif node.norm_type == NormType.NormIdentifier and node.sub.la_type.is_scalar() and not self.contain_sub(node.sub, sub):
+                    sub_info = self.visit(node.sub)
+                    if sub_info.pre_list:
+                        return None
+                    return "np.linalg.norm({}, {}, axis=1)".format(value[0], sub_info.content), True
+            elif value_type.is_matrix():
+                if node.norm_type == NormType.NormDet:
+                    return "np.linalg.det({})".format(value[0]), True
+                elif node.norm_type == NormType.NormFrobenius:
+                    return "np.linalg.norm({}, 'fro', axis=(1, 2))".format(value[0]), True
+                elif node.norm_type == NormType.NormNuclear:
+                    return "np.linalg.norm({}, 'nuc', axis=(1, 2))".format(value[0]), True
+        elif node.is_node(IRNodeType.Transpose):
+            value = self.visit_batched(node.f, sub, size_list)
+            if value is None or not node.f.la_type.is_matrix():
+                return None
+            return "np.swapaxes({}, 1, 2)".format(value[0]), True
+        elif node.is_node(IRNodeType.Squareroot):
+            value = self.visit_batched(node.value, sub, size_list)
+            if value is None:
+                return None
+            return "np.sqrt({})".format(value[0]), True
+        elif node.is_node(IRNodeType.Power):
+            base = self.visit_batched(node.base, sub, size_list)
+            if base is None:
+                return None
+            base_type = node.base.la_type
+            if node.t:
+                if not base_type.is_matrix():
+                    return None
+                return "np.swapaxes({}, 1, 2)".format(base[0]), True
+            elif node.r:
+                if base_type.is_scalar():
+                    return "1 / ({})".format(base[0]), True
+                return "np.linalg.inv({})".format(base[0]), True
+            if not base_type.is_scalar() or self.contain_sub(node.power, sub):
+                return None
+            power_info = self.visit(node.power)
+            if power_info.pre_list:
+                return None
+            return "np.power({}, {})".format(base[0], power_info.content), True
+        elif node.is_node(IRNodeType.MathFunc):
+            return self.visit_batched_math_func(node, sub, size_list)
+        elif node.is_node(IRNodeType.InnerProduct) or node.is_node(IRNodeType.DotProduct):
+            if node.is_node(IRNodeType.InnerProduct) and node.sub:
+                return None
+            if not (node.left.la_type.is_vector() and node.right.la_type.is_vector()):
+                return None
+            left = self.visit_batched(node.left, sub, size_list)
+            right = self.visit_batched(node.right, sub, size_list)
+            if left is None or right is None:
+                return None
+            return "np.einsum('{},{}->n', {}, {})".format('ni' if left[1] else 'i', 'ni' if right[1] else 'i',
+                                                         left[0], right[0]), True
+        elif node.is_node(IRNodeType.HadamardProduct):
+            left = self.visit_batched(node.left, sub, size_list)
+            right = self.visit_batched(node.right, sub, size_list)
+            if left is None or right is None:
+                return None
+            return "np.multiply({}, {})".format(left[0], right[0]), True
+        return None
+
+    def visit_batched_mul(self, node, sub, size_list):
+        left = self.visit_batched(node.left, sub, size_list)
+        right = self.visit_batched(node.right, sub, size_list)
+        if left is None or right is None:
+            return None
+        l_type = node.left.la_type
+        r_type = node.right.la_type
+        left_content = left[0]
+        right_content = right[0]
+        if l_type.is_scalar() or r_type.is_scalar():
+            if left[1] and l_type.is_scalar():
+                left_content = self.get_batched_scalar(left_content, r_type)
+            if right[1] and r_type.is_scalar():
+                right_content = self.get_batched_scalar(right_content, l_type)
+            return "{} * {}".format(left_content, right_content), True
+        if l_type.is_matrix() and not l_type.sparse:
+            if r_type.is_vector():
+                return "np.einsum('{},{}->ni', {}, {})".format('nij' if left[1] else 'ij', 'nj' if right[1] else 'j',
+                                                              left_content, right_content), True
+            elif r_type.is_matrix() and not r_type.sparse:
+                # matmul broadcasts over the first axis
+                return "({}) @ ({})".format(left_content, right_content), True
+        return None
+
+    def visit_batched_math_func(self, node, sub, size_list):
+        param = self.visit_batched(node.param, sub, size_list)
+        if param is None:
+            return None
+        if node.func_type == MathFuncType.MathFuncAtan2:
+            remain = self.visit_batched(node.remain_params[0], sub, size_list)
+            if remain is None:
+                return None
+            return "np.arctan2({}, {})".format(param[0], remain[0]), True
+        if node.func_type == MathFuncType.MathFuncTrace:
+            return "np.trace({}, axis1=1, axis2=2)".format(param[0]), True
+        elif node.func_type == MathFuncType.MathFuncDet:
+            return "np.linalg.det({})".format(param[0]), True
+        elif node.func_type == MathFuncType.MathFuncInv:
+            return "np.linalg.inv({})".format(param[0]), True
+        elif node.func_type <= MathFuncType.MathFuncSqrt:
+            # element-wise functions
+            return "{}({})".format(self.get_math_func_name(node), param[0]), True
+        return None
+
+    def get_grid_content(self, node, subs, dim_list):
+        """
+        Element-wise definition (v_i = ..., A_ij = ..., L_ii = ...) as one expression broadcast over the index grid:
+        the axis k of the grid is the subscript subs[k], np.arange(1, dim+1) when the subscript itself is used.
+        :return: the content, None when the loop is needed
+        """
+        if node.op != '=' or self.contain_sub(node.right, node.left.get_main_id()):
+            return None  # the loop would read the elements it has already written
+        size_list = [[] for sub in subs]
+        content = self.visit_grid(node.right, subs, dim_list, size_list)
+        if content is None:
+            return None
+        for index in range(len(subs)):
+            for size in size_list[index]:
+                if str(size) != str(dim_list[index]):
+                    return None
+        return content
+
+    def get_grid_axis(self, content, axis, dims):
+        if dims == 1:
+            return content
+        if axis == 0:
+            return "{}[:, None]".format(content)
+        return "{}[None, :]".format(content)
+
+    def visit_grid(self, node, subs, dim_list, size_list):
+        """
+        :param size_list: for each axis, the lengths of the dimensions indexed by its subscript
+        :return: the content with one axis per subscript (or a scalar), None if the node can't be broadcast
+        """
+        dims = len(subs)
+        if node.la_type is None or not node.la_type.is_scalar():
+            return None
+        if not any([self.contain_sub(node, sub) for sub in subs]):
+            info = self.visit(node)
+            if info is None or info.pre_list:
+                return None
+            return info.content
+        if node.is_node(IRNodeType.Expression):
+            content = self.visit_grid(node.value, subs, dim_list, size_list)
+            if content is not None and node.sign:
+                content = '-' + content
+            return content
+        elif node.is_node(IRNodeType.Factor):
+            for child in [node.id, node.num, node.sub, node.m, node.v, node.nm, node.op]:
+                if child is not None:
+                    return self.visit_grid(child, subs, dim_list, size_list)
+        elif node.is_node(IRNodeType.Subexpression):
+            content = self.visit_grid(node.value, subs, dim_list, size_list)
+            if content is not None:
+                content = "({})".format(content)
+            return content
+        elif node.is_node(IRNodeType.Id):
+            if node.contain_subscript():
+                return None
+            axis = subs.index(node.main_id)
+            return self.get_grid_axis("np.arange(1, {}+1)".format(dim_list[axis]), axis, dims)
+        elif node.is_node(IRNodeType.SequenceIndex):
+            axis = self.get_grid_index(node.main_index, subs)
+            if axis is None or axis < 0 or node.row_index is not None or node.col_index is not None:
+                return None
+            size_list[axis].append(self.symtable[node.main.get_main_id()].size)
+            return self.get_grid_axis(self.visit(node.main).content, axis, dims)
+        elif node.is_node(IRNodeType.VectorIndex):
+            axis = self.get_grid_index(node.row_index, subs)
+            if axis is None or axis < 0:
+                return None
+            size_list[axis].append(self.symtable[node.main.get_main_id()].rows)
+            return self.get_grid_axis(self.visit(node.main).content, axis, dims)
+        elif node.is_node(IRNodeType.MatrixIndex):
+            main_type = self.symtable[node.main.get_main_id()]
+            if main_type.sparse:
+                return None
+            main_content = self.visit(node.main).content
+            row_axis = self.get_grid_index(node.row_index, subs)
+            col_axis = self.get_grid_index(node.col_index, subs)
+            if row_axis is None or col_axis is None:
+                return None
+            if row_axis >= 0 and col_axis >= 0:
+                size_list[row_axis].append(main_type.rows)
+                size_list[col_axis].append(main_type.cols)
+                if row_axis == col_axis:
+                    return self.get_grid_axis("np.diagonal({})".format(main_content), row_axis, dims)
+                elif row_axis == 0:
+                    return main_content
+                return "{}.T".format(main_content)
+            elif row_axis >= 0:
+                size_list[row_axis].append(main_type.rows)
+                return self.get_grid_axis("{}[:, {}]".format(main_content, self.get_grid_index_content(node.col_index)), row_axis, dims)
+            size_list[col_axis].append(main_type.cols)
+            return self.get_grid_axis("{}[{}, :]".format(main_content, self.get_grid_index_content(node.row_index)), col_axis, dims)
+        elif node.is_node(IRNodeType.Add) or node.is_node(IRNodeType.Sub) or node.is_node(IRNodeType.Mul) \
+                or node.is_node(IRNodeType.Div):
+            left = self.visit_grid(node.left, subs, dim_list, size_list)
+            right = self.visit_grid(node.right, subs, dim_list, size_list)
+            if left is None or right is None:
+                return None
+            if node.is_node(IRNodeType.Add):
+                op = ' + '
+            elif node.is_node(IRNodeType.Sub):
+                op = ' - '
+            elif node.is_node(IRNodeType.Mul):
+                op = ' * '
+            else:
+                op = ' / '
+            return left + op + right
+        elif node.is_node(IRNodeType.Power):
+            base = self.visit_grid(node.base, subs, dim_list, size_list)
+            if base is None or node.t:
+                return None
+            if node.r:
+                return "1 / ({})".format(base)
+            power = self.visit_grid(node.power, subs, dim_list, size_list)
+            if power is None:
+                return None
+            return "np.power({}, {})".format(base, power)
+        elif node.is_node(IRNodeType.Squareroot):
+            value = self.visit_grid(node.value, subs, dim_list, size_list)
+            if value is None:
+                return None
+            return "np.sqrt({})".format(value)
+        elif node.is_node(IRNodeType.Norm):
+            value = self.visit_grid(node.value, subs, dim_list, size_list)
+            if value is None:
+                return None
+            return "np.absolute({})".format(value)
+        elif node.is_node(IRNodeType.MathFunc):
+            param = self.visit_grid(node.param, subs, dim_list, size_list)
+            if param is None:
+                return None
+            if node.func_type == MathFuncType.MathFuncAtan2:
+                remain = self.visit_grid(node.remain_params[0], subs, dim_list, size_list)
+                if remain is None:
+                    return None
+                return "np.arctan2({}, {})".format(param, remain)
+            if node.func_type <= MathFuncType.MathFuncSqrt:
+                return "{}({})".format(self.get_math_func_name(node), param)
+        return None
+
     def visit_norm(self, node, **kwargs):
         value_info = self.visit(node.value, **kwargs)
         value = value_info.content
@@ -449,6 +1239,10 @@ class CodeGenNumpy(CodeGen):
         return base_info
 
     def visit_solver(self, node, **kwargs):
+        if node.factorization is not None:
+            right_info = self.visit(node.right, **kwargs)
+            right_info.content = "scipy.linalg.lu_solve({}, {})".format(node.factorization, right_info.content)
+            return right_info
         left_info = self.visit(node.left, **kwargs)
         right_info = self.visit(node.right, **kwargs)
         left_info.pre_list += right_info.pre_list
@@ -458,6 +1252,11 @@ class CodeGenNumpy(CodeGen):
             left_info.content = "np.linalg.solve({}, {})".format(left_info.content, right_info.content)
         return left_info
 
+    def visit_factorization(self, node, **kwargs):
+        matrix_info = self.visit(node.matrix, **kwargs)
+        matrix_info.content = "scipy.linalg.lu_factor({})".format(matrix_info.content)
+        return matrix_info
+
     def visit_sparse_matrix(self, node, **kwargs):
         op_type = kwargs[ASSIGN_TYPE]
         lhs = kwargs[LHS]
@@ -468,8 +1267,33 @@ class CodeGenNumpy(CodeGen):
         value_var = type_info.la_type.value_var
         pre_list.append("    {} = []\n".format(index_var))
         pre_list.append("    {} = []\n".format(value_var))
-        if_info = self.visit(node.ifs, **kwargs)
-        pre_list += if_info.content
+        nonzeros_content = self.get_sparse_nonzeros(node)
+        if nonzeros_content is not None:
+            pre_list += nonzeros_content
+        else:
+            if_info = self.visit(node.ifs, **kwargs)
+            pre_list += if_info.content
+        lhs_id = node.get_ancestor(IRNodeType.Assignment).left.get_main_id()
+        if lhs_id in self.accumulated_sparse:
+            # the contributions are collected as triplet chunks and built once, right before the matrix is read
+            if op_type == '=' or lhs_id not in self.sparse_builders:
+                index_chunks = self.generate_var_name("{}_index_chunks".format(lhs_id))
+                value_chunks = self.generate_var_name("{}_value_chunks".format(lhs_id))
+                self.sparse_builders[lhs_id] = (index_chunks, value_chunks)
+                if op_type == '=':
+                    pre_list.append("    {} = []\n".format(index_chunks))
+                    pre_list.append("    {} = []\n".format(value_chunks))
+                else:
+                    # defined otherwise before
+                    coo_name = self.generate_var_name("{}_coo".format(lhs_id))
+                    pre_list.append("    {} = {}.tocoo()\n".format(coo_name, lhs_id))
+                    pre_list.append("    {} = [np.stack(({}.row, {}.col), axis=1)]\n".format(index_chunks, coo_name, coo_name))
+                    pre_list.append("    {} = [{}.data]\n".format(value_chunks, coo_name))
+            index_chunks, value_chunks = self.sparse_builders[lhs_id]
+            pre_list.append("    {}.append(np.asarray({}, dtype=int).reshape(-1, 2))\n".format(index_chunks, index_var))
+            pre_list.append("    {}.append(np.asarray({}))\n".format(value_chunks, value_var))
+            self.pending_sparse.add(lhs_id)
+            return CodeNodeInfo(lhs_id, pre_list)
         # assignment
         if op_type == '=':
             pre_list.append("    {} = scipy.sparse.coo_matrix(({}, np.asarray({}).T), shape=({}, {}))\n".format(cur_m_id, value_var, index_var, self.symtable[cur_m_id].rows,
@@ -478,7 +1302,7 @@ class CodeGenNumpy(CodeGen):
             # left_ids = self.get_all_ids(lhs)
             # left_subs = left_ids[1]
             pre_list.append(
-                "    {} = scipy.sparse.coo_matrix(({}+{}.data.tolist(), np.hstack((np.asarray({}).T, np.asarray(({}.row, {}.col))))), shape=({}, {}))\n".format(cur_m_id, value_var, cur_m_id,
+                "    {} = scipy.sparse.coo_matrix((np.hstack(({}, {}.data)), np.hstack((np.asarray({}).T, np.asarray(({}.row, {}.col))))), shape=({}, {}))\n".format(cur_m_id, value_var, cur_m_id,
                                                                                                     index_var, cur_m_id, cur_m_id,
                                                                                                     self.symtable[
                                                                                                         cur_m_id].rows,
@@ -487,6 +1311,106 @@ class CodeGenNumpy(CodeGen):
 
         return CodeNodeInfo(cur_m_id, pre_list)
 
+    def get_sparse_nonzeros(self, node):
+        """
+        Generate the index and value arrays of the nonzeros directly when the structure of every branch is known
+        (diagonals, members of an index set) and the values can be evaluated on index arrays.
+        The entries are in the same order as the scan over all the rows and columns.
+        :param node: SparseMatrixNode
+        :return: list of lines, None if the scan is needed
+        """
+        assign_node = node.get_ancestor(IRNodeType.Assignment)
+        subs = assign_node.left.subs
+        rows = node.la_type.rows
+        cols = node.la_type.cols
+        index_var = node.la_type.index_var
+        value_var = node.la_type.value_var
+        content = []
+        if len(node.ifs.cond_list) == 0:
+            return None
+        for cond in node.ifs.cond_list:
+            pattern = self.get_sparse_if_pattern(cond, subs)
+            if pattern is None or not self.is_elementwise(cond.stat):
+                return None
+            stat_info = self.visit(cond.stat)
+            if stat_info.pre_list:
+                return None
+            if pattern.is_diagonal():
+                # i - j = offset
+                first, col_bound, col_content = pattern.get_diagonal_range(subs[0], cols)
+                content.append("    {} = np.arange({}, min({}, {}) + 1)\n".format(subs[0], first, rows, col_bound))
+                content.append("    {} = {}\n".format(subs[1], col_content))
+            else:
+                set_content = self.visit(pattern.set_node).content
+                entries = self.generate_var_name("entries")
+                content.append("    {} = np.asarray(sorted(set({})), dtype=int).reshape(-1, 2)\n".format(entries, set_content))
+                for index in range(2):
+                    item_content = "{}[:, {}]".format(entries, index)
+                    if pattern.item_offsets[index] > 0:
+                        item_content += " + {}".format(pattern.item_offsets[index])
+                    elif pattern.item_offsets[index] < 0:
+                        item_content += " - {}".format(-pattern.item_offsets[index])
+                    content.append("    {} = {}\n".format(pattern.item_subs[index], item_content))
+                mask = self.generate_var_name("mask")
+                if pattern.item_subs[0] != subs[0]:
+                    # sorted by row, then column
+                    content.append("    {} = np.lexsort(({}, {}))\n".format(mask, subs[1], subs[0]))
+                    content.append("    {}, {} = {}[{}], {}[{}]\n".format(subs[0], subs[1], subs[0], mask, subs[1], mask))
+                content.append("    {} = (1 <= {}) & ({} <= {}) & (1 <= {}) & ({} <= {})\n".format(mask, subs[0], subs[0], rows,
+                                                                                           subs[1], subs[1], cols))
+                content.append("    {}, {} = {}[{}], {}[{}]\n".format(subs[0], subs[1], subs[0], mask, subs[1], mask))
+            content.append("    {}.append(np.stack(({}-1, {}-1), axis=1))\n".format(index_var, subs[0], subs[1]))
+            content.append("    {}.append(np.broadcast_to({}, {}.shape))\n".format(value_var, stat_info.content, subs[0]))
+        content.append("    {} = np.concatenate({}).reshape(-1, 2)\n".format(index_var, index_var))
+        content.append("    {} = np.concatenate({})\n".format(value_var, value_var))
+        self.nonzero_arrays.add(assign_node.left.get_main_id())
+        if len(node.ifs.cond_list) > 1:
+            # stable, the branches keep their order on the same entry
+            order = self.generate_var_name("order")
+            content.append("    {} = np.lexsort(({}[:, 1], {}[:, 0]))\n".format(order, index_var, index_var))
+            content.append("    {}, {} = {}[{}], {}[{}]\n".format(index_var, value_var, index_var, order, value_var, order))
+        return content
+
+    def is_elementwise(self, node):
+        """
+        :return: whether the scalar expression gives the same result when the subscripts are index arrays
+        """
+        if node is None:
+            return True
+        if node.la_type is not None and not node.la_type.is_scalar():
+            return False
+        if node.is_node(IRNodeType.Expression) or node.is_node(IRNodeType.Subexpression):
+            return self.is_elementwise(node.value)
+        elif node.is_node(IRNodeType.Factor):
+            for child in [node.id, node.num, node.sub, node.op, getattr(node, 'c', None)]:
+                if child is not None:
+                    return self.is_elementwise(child)
+            return False
+        elif node.is_node(IRNodeType.Id):
+            return not node.contain_subscript()
+        elif node.is_node(IRNodeType.Integer) or node.is_node(IRNodeType.Double) or node.is_node(IRNodeType.Constant):
+            return True
+        elif node.is_node(IRNodeType.Add) or node.is_node(IRNodeType.Sub) or node.is_node(IRNodeType.Mul) \
+                or node.is_node(IRNodeType.Div):
+            return self.is_elementwise(node.left) and self.is_elementwise(node.right)
+        elif node.is_node(IRNodeType.Power):
+            return not node.t and self.is_elementwise(node.base) and self.is_elementwise(node.power)
+        elif node.is_node(IRNodeType.Squareroot):
+            return self.is_elementwise(node.value)
+        elif node.is_node(IRNodeType.MathFunc):
+            if node.func_type == MathFuncType.MathFuncAtan2:
+                return self.is_elementwise(node.param) and self.is_elementwise(node.remain_params[0])
+            return node.func_type <= MathFuncType.MathFuncSqrt and self.is_elementwise(node.param)
+        elif node.is_node(IRNodeType.VectorIndex):
+            return self.is_elementwise(node.row_index)
+        elif node.is_node(IRNodeType.MatrixIndex):
+            if self.symtable[node.main.get_main_id()].sparse or node.row_index is None or node.col_index is None:
+                return False
+            return self.is_elementwise(node.row_index) and self.is_elementwise(node.col_index)
+        elif node.is_node(IRNodeType.SequenceIndex):
+            return node.row_index is None and node.col_index is None and self.is_elementwise(node.main_index)
+        return False
+
     def visit_sparse_ifs(self, node, **kwargs):
         assign_node = node.get_ancestor(IRNodeType.Assignment)
         sparse_node = node.get_ancestor(IRNodeType.SparseMatrix)
@@ -652,18 +1576,25 @@ class CodeGenNumpy(CodeGen):
                     col_content = col_info.content
                 else:
                     col_content = "{}-1".format(col_info.content)
-                if self.symtable[main_info.content].sparse:
-                    content = "{}.tocsr()[{}, {}]".format(main_info.content, row_content, col_content)
+                assign_node = node.get_ancestor(IRNodeType.Assignment)
+                if self.symtable[main_info.content].sparse and (assign_node is None or assign_node.left is not node):
+                    content = "{}.get(({}, {}), 0)".format(self.get_sparse_view(main_info.content, 'dok'), row_content, col_content)
                 else:
                     content = "{}[{}, {}]".format(main_info.content, row_content, col_content)
             else:
-                content = "{}[{}, :]".format(main_info.content, row_content)
+                main_content = main_info.content
+                if self.symtable[main_info.content].sparse:
+                    main_content = self.get_sparse_view(main_info.content, 'csr')
+                content = "{}[{}, :]".format(main_content, row_content)
         else:
             col_info = self.visit(node.col_index, **kwargs)
+            main_content = main_info.content
+            if self.symtable[main_info.content].sparse:
+                main_content = self.get_sparse_view(main_info.content, 'csc')
             if node.col_index.la_type.index_type:
-                content = "{}[:, {}]".format(main_info.content, col_info.content)
+                content = "{}[:, {}]".format(main_content, col_info.content)
             else:
-                content = "{}[:, {}-1]".format(main_info.content, col_info.content)
+                content = "{}[:, {}-1]".format(main_content, col_info.content)
         return CodeNodeInfo(content)
 
     def visit_vector_index(self, node, **kwargs):
@@ -771,6 +1702,9 @@ class CodeGenNumpy(CodeGen):
                             if sequence not in self.declared_symbols:
                                 content += "    {} = []\n".format(self.symtable[sequence].index_var)
                                 content += "    {} = []\n".format(self.symtable[sequence].value_var)
+                        elif sequence in self.nonzero_arrays:
+                            content += "    {} = list({})\n".format(self.symtable[sequence].index_var, self.symtable[sequence].index_var)
+                            content += "    {} = list({})\n".format(self.symtable[sequence].value_var, self.symtable[sequence].value_var)
                         content += "    for {} in range(1, {}+1):\n".format(left_subs[0], self.symtable[sequence].rows)
                         if right_info.pre_list:
                             content += self.update_prelist_str(right_info.pre_list, "    ")
@@ -787,11 +1721,23 @@ class CodeGenNumpy(CodeGen):
                         if right_info.pre_list:
                             content += "".join(right_info.pre_list)
                         # sparse mat assign
-                        right_exp += '    ' + sequence + ' = ' + right_info.content
+                        if sequence in self.pending_sparse:
+                            # built later, the triplet chunks end the statement
+                            content = content.rstrip('\n')
+                        else:
+                            right_exp += '    ' + sequence + ' = ' + right_info.content
                         content += right_exp
                 elif left_subs[0] == left_subs[1]:
                     # L_ii
                     content = ""
+                    grid_content = self.get_grid_content(node, [left_subs[0]], [self.symtable[sequence].rows])
+                    if grid_content is not None:
+                        content += "    {}[np.arange({}), np.arange({})] = {}".format(sequence, self.symtable[sequence].rows,
+                                                                                   self.symtable[sequence].rows, grid_content)
+                        content += '\n'
+                        la_remove_key(LHS, **kwargs)
+                        self.declared_symbols.add(node.left.get_main_id())
+                        return CodeNodeInfo(content)
                     content += "    for {} in range(1, {}+1):\n".format(left_subs[0], self.symtable[sequence].rows)
                     if right_info.pre_list:
                         content += self.update_prelist_str(right_info.pre_list, "    ")
@@ -809,6 +1755,17 @@ class CodeGenNumpy(CodeGen):
                                 content += "    {} = np.zeros(({}, {}))\n".format(sequence,
                                                                                   self.symtable[sequence].rows,
                                                                                   self.symtable[sequence].cols)
+                    grid_content = None
+                    if self.symtable[sequence].is_matrix() and node.op == '=':
+                        grid_content = self.get_grid_content(node, left_subs, [self.symtable[sequence].rows,
+                                                                               self.symtable[sequence].cols])
+                    if grid_content is not None:
+                        # broadcast over the index grid
+                        content += "    {}[:, :] = {}".format(sequence, grid_content)
+                        content += '\n'
+                        la_remove_key(LHS, **kwargs)
+                        self.declared_symbols.add(node.left.get_main_id())
+                        return CodeNodeInfo(content)
                     content += "    for {} in range(1, {}+1):\n".format(left_subs[0], self.symtable[sequence].rows)
                     content += "        for {} in range(1, {}+1):\n".format(left_subs[1], self.symtable[sequence].cols)
                     if right_info.pre_list:
@@ -839,6 +1796,13 @@ class CodeGenNumpy(CodeGen):
                 else:
                     # vector
                     content += "    {} = np.zeros({})\n".format(sequence, self.symtable[sequence].rows)
+                    grid_content = self.get_grid_content(node, left_subs, [self.symtable[sequence].rows])
+                    if grid_content is not None:
+                        content += "    {}[:] = {}".format(sequence, grid_content)
+                        content += '\n'
+                        la_remove_key(LHS, **kwargs)
+                        self.declared_symbols.add(node.left.get_main_id())
+                        return CodeNodeInfo(content)
                     content += "    for {} in range(1, {}+1):\n".format(left_subs[0], self.symtable[sequence].rows)
                 if right_info.pre_list:
                     content += self.update_prelist_str(right_info.pre_list, "    ")
@@ -852,6 +1816,10 @@ class CodeGenNumpy(CodeGen):
                 op = ' += '
             right_exp += '    ' + self.get_main_id(left_id) + op + right_info.content
             content += right_exp
+            if node.right.is_node(IRNodeType.Factorization):
+                # lu_factor only warns on a zero pivot, raise like np.linalg.solve and np.linalg.inv
+                content += "\n    if not np.all(np.diagonal({}[0])):\n".format(self.get_main_id(left_id))
+                content += "        raise np.linalg.LinAlgError('Singular matrix')"
         content += '\n'
         la_remove_key(LHS, **kwargs)
         self.declared_symbols.add(node.left.get_main_id())
@@ -1090,11 +2058,8 @@ class CodeGenNumpy(CodeGen):
         right_info = self.visit(node.right, **kwargs)
         return CodeNodeInfo("np.dot(({}).ravel(), ({}).ravel())".format(left_info.content, right_info.content), pre_list=left_info.pre_list+right_info.pre_list)
 
-    def visit_math_func(self, node, **kwargs):
+    def get_math_func_name(self, node):
         content = ''
-        param_info = self.visit(node.param, **kwargs)
-        params_content = param_info.content
-        pre_list = param_info.pre_list
         if node.func_type == MathFuncType.MathFuncSin:
             content = 'np.sin'
         elif node.func_type == MathFuncType.MathFuncAsin:
@@ -1127,9 +2092,6 @@ class CodeGenNumpy(CodeGen):
             content = '1/np.sin'
         elif node.func_type == MathFuncType.MathFuncAtan2:
             content = 'np.arctan2'
-            remain_info = self.visit(node.remain_params[0], **kwargs)
-            params_content += ', ' + remain_info.content
-            pre_list += remain_info.pre_list
         elif node.func_type == MathFuncType.MathFuncExp:
             content = 'np.exp'
         elif node.func_type == MathFuncType.MathFuncLog:
@@ -1146,8 +2108,6 @@ class CodeGenNumpy(CodeGen):
             content = 'np.trace'
         elif node.func_type == MathFuncType.MathFuncDiag:
             content = 'np.diag'
-        elif node.func_type == MathFuncType.MathFuncVec:
-            return CodeNodeInfo("np.matrix.flatten({}, order='F')".format(params_content))  # column-major
         elif node.func_type == MathFuncType.MathFuncDet:
             content = 'scipy.linalg.det'
         elif node.func_type == MathFuncType.MathFuncRank:
@@ -1158,6 +2118,19 @@ class CodeGenNumpy(CodeGen):
             content = 'scipy.linalg.orth'
         elif node.func_type == MathFuncType.MathFuncInv:
             content = 'scipy.linalg.inv'
+        return content
+
+    def visit_math_func(self, node, **kwargs):
+        param_info = self.visit(node.param, **kwargs)
+        params_content = param_info.content
+        pre_list = param_info.pre_list
+        if node.func_type == MathFuncType.MathFuncVec:
+            return CodeNodeInfo("np.matrix.flatten({}, order='F')".format(params_content))  # column-major
+        content = self.get_math_func_name(node)
+        if node.func_type == MathFuncType.MathFuncAtan2:
+            remain_info = self.visit(node.remain_params[0], **kwargs)
+            params_content += ', ' + remain_info.content
+            pre_list += remain_info.pre_list
         return CodeNodeInfo("{}({})".format(content, params_content), pre_list=pre_list)
 
     def visit_constant(self, node, **kwargs):
@@ -0,0 +1,188 @@
+import json
+import queue
+import signal
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ..la_tools.la_helper import *
+from .parser import CompilerSession, get_compiled_outputs, get_compile_error_msg, get_file_name, write_la_file_outputs
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8537
+
+
+class CompileServer(ThreadingHTTPServer):
+    """
+    Long-running compiler: keeps a pool of warmed sessions (parsers, type walker, codegens) and serves
+    compile requests over a localhost HTTP port.
+    POST /compile   {"source": str, "parser_type": int, "func_name": str or null}
+                    -> {"outputs": [str]} or {"error": str}
+    GET  /status    -> queue depth, active requests and latency percentiles
+    POST /shutdown  -> stop after the requests in flight are answered
+    """
+    daemon_threads = False
+    block_on_close = True  # graceful shutdown: wait for the requests in flight
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, sessions=4, use_cache=True):
+        super().__init__((host, port), CompileRequestHandler)
+        self.use_cache = use_cache
+        self.session_pool = queue.Queue()
+        for index in range(sessions):
+            session = CompilerSession()
+            session.create_parser()
+            self.session_pool.put(session)
+        self.session_cnt = sessions
+        self.lock = threading.Lock()
+        self.pending = 0  # waiting for a session
+        self.active = 0
+        self.served = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=1000)  # ms, most recent requests
+        self.start_time = time.time()
+
+    def compile(self, source, parser_type, func_name=None):
+        """
+        :return: (outputs, None) or (None, error message)
+        """
+        start = time.perf_counter()
+        with self.lock:
+            self.pending += 1
+        session = self.session_pool.get()
+        with self.lock:
+            self.pending -= 1
+            self.active += 1
+        outputs = None
+        err_msg = None
+        try:
+            outputs = get_compiled_outputs(source, parser_type, func_name=func_name, use_cache=self.use_cache, session=session)
+        except Exception as e:
+            err_msg = get_compile_error_msg(e)
+        finally:
+            self.session_pool.put(session)
+            with self.lock:
+                self.active -= 1
+                self.served += 1
+                if err_msg is not None:
+                    self.errors += 1
+                self.latencies.append((time.perf_counter() - start) * 1000)
+        return outputs, err_msg
+
+    def get_status(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            status = {"pending": self.pending,
+                      "active": self.active,
+                      "served": self.served,
+                      "errors": self.errors,
+                      "sessions": self.session_cnt,
+                      "uptime": time.time() - self.start_time}
+        percentiles = {}
+        for p in [50, 90, 99]:
+            key = "p{}".format(p)
+            if len(latencies) > 0:
+                percentiles[key] = latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+            else:
+                percentiles[key] = None
+        status["latency_ms"] = percentiles
+        return status
+
+    def stop(self):
+        # shutdown() blocks until serve_forever returns, so it can't run on a request thread
+        threading.Thread(target=self.shutdown).start()
+
+
+class CompileRequestHandler(BaseHTTPRequestHandler):
+    def send_json(self, code, content):
+        data = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json(200, self.server.get_status())
+        else:
+            self.send_json(404, {"error": "unknown path: {}".format(self.path)})
+
+    def do_POST(self):
+        if self.path == '/compile':
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length).decode())
+                source = request["source"]
+                parser_type = ParserTypeEnum(int(request.get("parser_type", ParserTypeEnum.NUMPY)))
+                func_name = request.get("func_name")
+            except Exception as e:
+                self.send_json(400, {"error": "invalid request: {}".format(e)})
+                return
+            outputs, err_msg = self.server.compile(source, parser_type, func_name)
+            if err_msg is None:
+                self.send_json(200, {"outputs": outputs})
+            else:
+                self.send_json(200, {"error": err_msg})
+        elif self.path == '/shutdown':
+            self.send_json(200, {"status": "shutting down"})
+            self.server.stop()
+        else:
+            self.send_json(404, {"error": "unknown path: {}".format(self.path)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_compile_server(host=DEFAULT_HOST, port=DEFAULT_PORT, sessions=4):
+    """
+    used for command line, serve until /shutdown, SIGINT or SIGTERM
+    """
+    server = CompileServer(host, port, sessions)
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(sig, lambda signum, frame: server.stop())
+    print("I Heart LA compile server on {}:{}".format(host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def send_request(path, content=None, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=60):
+    url = "http://{}:{}{}".format(host, port, path)
+    data = None
+    if content is not None:
+        data = json.dumps(content).encode()
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as f:
+        return json.loads(f.read().decode())
+
+
+def compile_la_content_remote(la_content, parser_type, func_name=None, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+    :return: (outputs, None) or (None, error message)
+    """
+    ret = send_request('/compile', {"source": la_content, "parser_type": int(parser_type), "func_name": func_name},
+                       host, port)
+    if "error" in ret:
+        return None, ret["error"]
+    return ret["outputs"], None
+
+
+def compile_la_file_remote(la_file, parser_type=ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN | ParserTypeEnum.LATEX,
+                           host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+    used for command line (--client), the outputs are written next to la_file
+    :return: None on success, the error message otherwise
+    """
+    # mathjax is not written to disk
+    parser_type = parser_type & (ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN | ParserTypeEnum.LATEX | ParserTypeEnum.NUMBA)
+    try:
+        outputs, err_msg = compile_la_content_remote(read_from_file(la_file), parser_type, get_file_name(la_file),
+                                                     host, port)
+    except (urllib.error.URLError, OSError) as e:
+        return "Can't reach the compile server on {}:{}: {}".format(host, port, e)
+    if err_msg is None:
+        write_la_file_outputs(la_file, parser_type, outputs)
+    return err_msg
@@ -0,0 +1,137 @@
+import regex as re
+from ..la_tools.la_helper import is_keyword
+
+# same identifiers as the init grammar: multi-letter names are single tokens there
+_id_str = r"[A-Za-z\p{Ll}\p{Lu}\p{Lo}]\p{M}*(?:[A-Z0-9a-z\p{Ll}\p{Lu}\p{Lo}]\p{M}*)*"
+_id_pattern = re.compile(_id_str)
+_main_id_str = r"(?P<id>`[^`]*`|" + _id_str + r")(?P<sub>_[^\s=:∈]*)?"
+_directive_pattern = re.compile(r"^\s*from\s+(?P<package>\S+)\s*:\s*(?P<names>.*?)\s*$")
+_condition_pattern = re.compile(r"^\s*" + _main_id_str + r"\s*(?P<op>:|∈)\s*(?P<type>.*?)\s*$")
+_subject_to_pattern = re.compile(r"(?<![A-Za-z0-9_])(?:s\.t\.|subject to)")
+_assignment_pattern = re.compile(r"^\s*" + _main_id_str + r"\s*=(?!=)(?P<rhs>.*)$")
+_annotation_pattern = re.compile(r"^\s*(?:where|given)\s*$")
+_alias_pattern = re.compile(r"^\s*" + _main_id_str + r"\s*$")
+_builtin_keywords = {'where', 'given', 'sum', 'min', 'max', 'argmin', 'argmax', 'int', 'if', 'otherwise', 'exp',
+                     'log', 'ln', 'sqrt', 'from'}
+
+
+class DeclScanResult(object):
+    def __init__(self):
+        self.parameters = []      # declared symbols, main ids
+        self.multi_lhs_list = []  # assigned symbols with more than one letter, main ids
+        self.func_dict = {}       # function symbol -> type text
+        self.package_dict = {}    # package -> imported names
+        self.rhs_raw_str_list = []
+
+
+def filter_symbol(symbol):
+    """
+    same as TypeWalker.filter_symbol: drop the backticks when they aren't needed
+    """
+    if '`' in symbol:
+        new_symbol = symbol.replace('`', '')
+        if not _id_pattern.fullmatch(new_symbol) or is_keyword(new_symbol):
+            new_symbol = symbol
+    else:
+        new_symbol = symbol
+    return new_symbol
+
+
+def split_statements(content):
+    """
+    Split the source into lines and the lines on the ';' separators of the grammar. A ';' inside brackets is a
+    parameter or matrix row separator, and a piece that doesn't start a statement stays with the previous one,
+    e.g. the function type f: ℝ; ℝ → ℝ
+    :return: list of statements
+    """
+    statements = []
+    for line in content.split('\n'):
+        pieces = []
+        depth = 0
+        start = 0
+        for index, char in enumerate(line):
+            if char in '([{':
+                depth += 1
+            elif char in ')]}':
+                depth -= 1
+            elif char == ';' and depth <= 0:
+                pieces.append(line[start:index])
+                start = index + 1
+        pieces.append(line[start:])
+        statements.append(pieces[0])
+        for piece in pieces[1:]:
+            if piece.strip() == '' or _annotation_pattern.match(piece) or _directive_pattern.match(piece) \
+                    or _condition_pattern.match(piece) or _assignment_pattern.match(piece):
+                statements.append(piece)
+            else:
+                statements[-1] += ';' + piece
+    return statements
+
+
+def scan_declarations(content):
+    """
+    Collect from the source text what the specialized default parser needs: the declared symbols of
+    the where/given blocks, the multi-letter lhs names, the function symbols and the imports.
+    This replaces the parse with the init grammar plus the pre-walk; it's a statement-based scan, so the
+    caller falls back to the full pre-pass when the specialized parse fails.
+    :return: DeclScanResult
+    """
+    result = DeclScanResult()
+    seq_func_list = []
+    alias_list = []  # lhs = rhs symbol, the lhs is a function when the rhs is
+    constraints = False  # after s.t. the lines x ∈ s constrain an optimization variable, they aren't declarations
+    for line in split_statements(content):
+        if line.strip() == '':
+            continue
+        if _annotation_pattern.match(line):
+            constraints = False
+            continue
+        match = _directive_pattern.match(line)
+        if match:
+            names = [name.strip() for name in match.group('names').split(',')]
+            package = match.group('package')
+            result.package_dict[package] = sorted(set(result.package_dict.get(package, []) + names))
+            continue
+        match = _condition_pattern.match(line)
+        if constraints and (match.group('op') == '∈' if match else not _assignment_pattern.match(line)):
+            # the constraints end at the next declaration or assignment
+            result.rhs_raw_str_list.append(line)
+            continue
+        constraints = _subject_to_pattern.search(line) is not None
+        if match and match.group('id') not in _builtin_keywords:
+            main_id = filter_symbol(match.group('id'))
+            result.parameters.append(main_id)
+            # the description follows the second ':'
+            la_type = match.group('type').split(':')[0]
+            if '→' in la_type or '->' in la_type:
+                if match.group('sub'):
+                    seq_func_list.append(main_id)
+                else:
+                    result.func_dict[main_id] = la_type.strip()
+            continue
+        match = _assignment_pattern.match(line)
+        if match and match.group('id') not in _builtin_keywords:
+            main_id = filter_symbol(match.group('id'))
+            if len(main_id) > 1 and main_id not in result.multi_lhs_list:
+                result.multi_lhs_list.append(main_id)
+            result.rhs_raw_str_list.append(match.group('rhs'))
+            rhs_match = _alias_pattern.match(match.group('rhs'))
+            if rhs_match:
+                alias_list.append((main_id, match.group('sub'), filter_symbol(rhs_match.group('id'))))
+        else:
+            result.rhs_raw_str_list.append(line)
+    for lhs, lhs_sub, rhs in alias_list:
+        if rhs in result.func_dict and not lhs_sub:
+            result.func_dict[lhs] = result.func_dict[rhs]
+        elif rhs in seq_func_list and lhs_sub:
+            seq_func_list.append(lhs)
+    # sequences of functions, see TypeWalker.get_func_symbols
+    rhs_str = '\n'.join(result.rhs_raw_str_list)
+    for seq in seq_func_list:
+        results = re.findall(r"("
+                             + seq + r"_`[^`]*`|"
+                             + seq + r"_[A-Za-z\p{Ll}\p{Lu}\p{Lo}]\p{M}*(?:[A-Z0-9a-z\p{Ll}\p{Lu}\p{Lo}]\p{M}*)*|"
+                             + seq + r"_\d*)(?=\()", rhs_str)
+        for match in results:
+            result.func_dict[match] = match
+    return result
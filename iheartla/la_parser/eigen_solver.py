@@ -0,0 +1,292 @@
+# Numerical routines copied into the generated C++ code, the output only depends on Eigen and the standard library
+
+
+QUADRATURE_CODE = '''namespace iheartla {
+/**
+ * Gauss-Kronrod (7, 15) rule on [a, b], error is set to the difference from the Gauss rule
+ */
+inline double gauss_kronrod(const std::function<double(double)> & f, double a, double b, double & error)
+{
+    static const double xgk[8] = {0.991455371120812639206854697526329, 0.949107912342758524526189684047851,
+                                  0.864864423359769072789712788640926, 0.741531185599394439863864773280788,
+                                  0.586087235467691130294144845693013, 0.405845151377397166906606412076961,
+                                  0.207784955007898467600689403773245, 0.000000000000000000000000000000000};
+    static const double wgk[8] = {0.022935322010529224963732008058970, 0.063092092629978553290700663189204,
+                                  0.104790010322250183839876322541518, 0.140653259715525918745189590510238,
+                                  0.169004726639267902826583426598550, 0.190350578064785409913256402421014,
+                                  0.204432940075298892414161999234649, 0.209482141084727828012999174891714};
+    static const double wg[4] = {0.129484966168869693270611432679082, 0.279705391489276667901467771423780,
+                                 0.381830050505118944950369775488975, 0.417959183673469387755102040816327};
+    const double center = 0.5 * (a + b);
+    const double half = 0.5 * (b - a);
+    const double f_center = f(center);
+    double kronrod = wgk[7] * f_center;
+    double gauss = wg[3] * f_center;
+    for(int j=0; j<7; j++){
+        const double dx = half * xgk[j];
+        const double f_sum = f(center - dx) + f(center + dx);
+        kronrod += wgk[j] * f_sum;
+        if(j % 2 == 1){
+            gauss += wg[j / 2] * f_sum;
+        }
+    }
+    error = std::abs((kronrod - gauss) * half);
+    return kronrod * half;
+}
+
+/**
+ * Adaptive quadrature of f on [a, b], the interval with the largest error is bisected until the error is below
+ * max(epsabs, epsrel * |integral|) or there are limit intervals, the same defaults as scipy.integrate.quad
+ */
+inline double integrate(const std::function<double(double)> & f, double a, double b,
+                        double epsabs=1.49e-8, double epsrel=1.49e-8, int limit=50)
+{
+    std::vector<double> lower(1, a), upper(1, b), values(1), errors(1);
+    values[0] = gauss_kronrod(f, a, b, errors[0]);
+    double value = values[0];
+    double error = errors[0];
+    while(error > std::max(epsabs, epsrel * std::abs(value)) && (int)values.size() < limit){
+        const int worst = std::max_element(errors.begin(), errors.end()) - errors.begin();
+        const double mid = 0.5 * (lower[worst] + upper[worst]);
+        double right_error;
+        const double right_value = gauss_kronrod(f, mid, upper[worst], right_error);
+        lower.push_back(mid);
+        upper.push_back(upper[worst]);
+        values.push_back(right_value);
+        errors.push_back(right_error);
+        upper[worst] = mid;
+        values[worst] = gauss_kronrod(f, lower[worst], mid, errors[worst]);
+        value = 0;
+        error = 0;
+        for(int k=0; k<(int)values.size(); k++){
+            value += values[k];
+            error += errors[k];
+        }
+    }
+    return value;
+}
+}
+
+'''
+
+OPTIMIZATION_CODE = '''namespace iheartla {
+/**
+ * Objective of a minimization: returns the value at x and writes the gradient when grad isn't null
+ */
+typedef std::function<double(const Eigen::VectorXd &, Eigen::VectorXd *)> Objective;
+
+struct Constraint {
+    std::function<double(const Eigen::VectorXd &)> fun;  // fun(x) >= 0, fun(x) == 0 for an equality
+    bool equality;
+};
+
+/**
+ * Central differences, for the objectives without a generated gradient
+ */
+inline Eigen::VectorXd numerical_gradient(const std::function<double(const Eigen::VectorXd &)> & f, const Eigen::VectorXd & x)
+{
+    Eigen::VectorXd grad(x.size());
+    Eigen::VectorXd x_h = x;
+    for(int k=0; k<x.size(); k++){
+        const double h = std::cbrt(std::numeric_limits<double>::epsilon()) * std::max(1.0, std::abs(x(k)));
+        x_h(k) = x(k) + h;
+        const double f_right = f(x_h);
+        x_h(k) = x(k) - h;
+        const double f_left = f(x_h);
+        x_h(k) = x(k);
+        grad(k) = (f_right - f_left) / (2 * h);
+    }
+    return grad;
+}
+
+inline double evaluate(const Objective & f, bool has_gradient, const Eigen::VectorXd & x, Eigen::VectorXd & grad)
+{
+    if(has_gradient){
+        const double value = f(x, &grad);
+        if(grad.allFinite()){
+            return value;
+        }
+        // not differentiable at x, e.g. a norm at the origin
+    }
+    grad = numerical_gradient([&](const Eigen::VectorXd & y) -> double { return f(y, nullptr); }, x);
+    return f(x, nullptr);
+}
+
+/**
+ * L-BFGS with a backtracking line search, the iterates are projected to the box [lower, upper]
+ */
+inline Eigen::VectorXd lbfgs(const Objective & f, bool has_gradient, Eigen::VectorXd x,
+                             const Eigen::VectorXd & lower, const Eigen::VectorXd & upper,
+                             int max_iterations=1000, int memory=10)
+{
+    const int n = x.size();
+    x = x.cwiseMax(lower).cwiseMin(upper);
+    Eigen::VectorXd grad(n);
+    double f_x = evaluate(f, has_gradient, x, grad);
+    std::vector<Eigen::VectorXd> s_list;
+    std::vector<Eigen::VectorXd> y_list;
+    for(int iteration=0; iteration<max_iterations && std::isfinite(f_x); iteration++){
+        const Eigen::VectorXd projected_grad = x - (x - grad).cwiseMax(lower).cwiseMin(upper);
+        if(projected_grad.lpNorm<Eigen::Infinity>() <= 1e-10 * std::max(1.0, std::abs(f_x))){
+            break;
+        }
+        // two-loop recursion
+        const int m = s_list.size();
+        Eigen::VectorXd d = -grad;
+        std::vector<double> alpha(m);
+        for(int k=m-1; k>=0; k--){
+            alpha[k] = s_list[k].dot(d) / s_list[k].dot(y_list[k]);
+            d -= alpha[k] * y_list[k];
+        }
+        if(m > 0){
+            d *= s_list[m-1].dot(y_list[m-1]) / y_list[m-1].squaredNorm();
+        }
+        for(int k=0; k<m; k++){
+            d += (alpha[k] - y_list[k].dot(d) / s_list[k].dot(y_list[k])) * s_list[k];
+        }
+        for(int k=0; k<n; k++){
+            if((x(k) <= lower(k) && d(k) < 0) || (x(k) >= upper(k) && d(k) > 0)){
+                d(k) = 0;
+            }
+        }
+        if(!(grad.dot(d) < 0)){
+            // restart from the steepest descent
+            s_list.clear();
+            y_list.clear();
+            d = -projected_grad;
+        }
+        double step = s_list.empty() ? std::min(1.0, 1.0 / d.lpNorm<Eigen::Infinity>()) : 1.0;
+        Eigen::VectorXd x_new = x;
+        double f_new = f_x;
+        bool decreased = false;
+        for(int k=0; k<60 && !decreased; k++){
+            x_new = (x + step * d).cwiseMax(lower).cwiseMin(upper);
+            f_new = f(x_new, nullptr);
+            decreased = f_new <= f_x + 1e-4 * grad.dot(x_new - x);
+            step *= 0.5;
+        }
+        if(!decreased || x_new == x){
+            if(s_list.empty()){
+                break;
+            }
+            s_list.clear();
+            y_list.clear();
+            continue;
+        }
+        Eigen::VectorXd grad_new(n);
+        f_new = evaluate(f, has_gradient, x_new, grad_new);
+        const Eigen::VectorXd s = x_new - x;
+        const Eigen::VectorXd y = grad_new - grad;
+        if(s.dot(y) > std::numeric_limits<double>::epsilon() * y.squaredNorm()){
+            s_list.push_back(s);
+            y_list.push_back(y);
+            if((int)s_list.size() > memory){
+                s_list.erase(s_list.begin());
+                y_list.erase(y_list.begin());
+            }
+        }
+        const bool converged = f_x - f_new <= 1e-15 * std::max(1.0, std::abs(f_x));
+        x = x_new;
+        f_x = f_new;
+        grad = grad_new;
+        if(converged){
+            break;
+        }
+    }
+    return x;
+}
+
+inline double get_violation(const std::vector<Constraint> & constraints, const Eigen::VectorXd & x)
+{
+    double violation = 0;
+    for(const Constraint & constraint : constraints){
+        const double value = constraint.fun(x);
+        violation = std::max(violation, constraint.equality ? std::abs(value) : -value);
+    }
+    return violation;
+}
+
+/**
+ * Minimize f from x0 in the box [lower, upper], the other constraints are handled by an augmented Lagrangian
+ */
+inline Eigen::VectorXd minimize(const Objective & f, bool has_gradient, const Eigen::VectorXd & x0,
+                                const Eigen::VectorXd & lower, const Eigen::VectorXd & upper,
+                                const std::vector<Constraint> & constraints)
+{
+    if(constraints.empty()){
+        return lbfgs(f, has_gradient, x0, lower, upper);
+    }
+    std::vector<double> multipliers(constraints.size(), 0);
+    double penalty = 10;
+    std::function<double(const Eigen::VectorXd &)> penalty_term = [&](const Eigen::VectorXd & x) -> double {
+        double value = 0;
+        for(int k=0; k<(int)constraints.size(); k++){
+            const double c = constraints[k].fun(x);
+            if(constraints[k].equality){
+                value += multipliers[k] * c + 0.5 * penalty * c * c;
+            }
+            else{
+                const double t = std::max(0.0, multipliers[k] - penalty * c);
+                value += (t * t - multipliers[k] * multipliers[k]) / (2 * penalty);
+            }
+        }
+        return value;
+    };
+    Objective lagrangian = [&](const Eigen::VectorXd & x, Eigen::VectorXd * grad) -> double {
+        if(grad){
+            const double value = evaluate(f, has_gradient, x, *grad);
+            *grad += numerical_gradient(penalty_term, x);
+            return value + penalty_term(x);
+        }
+        return f(x, nullptr) + penalty_term(x);
+    };
+    Eigen::VectorXd x = x0;
+    double violation = std::numeric_limits<double>::infinity();
+    for(int iteration=0; iteration<50; iteration++){
+        x = lbfgs(lagrangian, true, x, lower, upper);
+        for(int k=0; k<(int)constraints.size(); k++){
+            const double c = constraints[k].fun(x);
+            multipliers[k] = constraints[k].equality ? multipliers[k] + penalty * c : std::max(0.0, multipliers[k] - penalty * c);
+        }
+        const double new_violation = get_violation(constraints, x);
+        if(new_violation <= 1e-10){
+            break;
+        }
+        if(new_violation > 0.25 * violation){
+            penalty *= 10;
+        }
+        violation = new_violation;
+    }
+    return x;
+}
+
+inline Eigen::VectorXd minimize(const Objective & f, bool has_gradient, const Eigen::VectorXd & x0)
+{
+    const double inf = std::numeric_limits<double>::infinity();
+    return lbfgs(f, has_gradient, x0, Eigen::VectorXd::Constant(x0.size(), -inf), Eigen::VectorXd::Constant(x0.size(), inf));
+}
+
+/**
+ * Minimize f over the candidates in the box satisfying the constraints, NaN if none of them does
+ */
+inline Eigen::VectorXd minimize_over(const Objective & f, const std::vector<Eigen::VectorXd> & candidates, const Eigen::VectorXd & x0,
+                                     const Eigen::VectorXd & lower, const Eigen::VectorXd & upper,
+                                     const std::vector<Constraint> & constraints)
+{
+    Eigen::VectorXd x = Eigen::VectorXd::Constant(x0.size(), std::numeric_limits<double>::quiet_NaN());
+    double f_x = std::numeric_limits<double>::infinity();
+    for(const Eigen::VectorXd & candidate : candidates){
+        if((candidate.array() < lower.array()).any() || (candidate.array() > upper.array()).any() || get_violation(constraints, candidate) > 1e-10){
+            continue;
+        }
+        const double value = f(candidate, nullptr);
+        if(value < f_x){
+            x = candidate;
+            f_x = value;
+        }
+    }
+    return x;
+}
+}
+
+'''
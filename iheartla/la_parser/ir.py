@@ -53,6 +53,7 @@ class IRNodeType(Enum):
     KroneckerProduct = 219
     DotProduct = 220
     Squareroot = 221
+    Factorization = 222
     # matrix
     Matrix = 300
     MatrixRows = 301
@@ -519,6 +520,7 @@ class SummationNode(ExprNode):
         self.symbol = None
         self.content = None
         self.sym_dict = None  # identifiers containing sub, used for type checking only
+        self.local_stmts = []  # assignments at the start of each iteration, added by IROptimizer
 
 
 class OptimizeType(Enum):
@@ -642,6 +644,16 @@ class SolverNode(ExprNode):
         self.left = None
         self.right = None
         self.pow = None   # -> pow node
+        self.factorization = None  # name of the factorization of left shared with other solves (IROptimizer)
+
+
+class FactorizationNode(ExprNode):
+    """
+    LU factorization of a square matrix, computed once for the solves against it (IROptimizer)
+    """
+    def __init__(self, matrix=None, parse_info=None, raw_text=None):
+        super().__init__(IRNodeType.Factorization, parse_info=parse_info, raw_text=raw_text)
+        self.matrix = matrix
 
 
 class SparseMatrixNode(ExprNode):
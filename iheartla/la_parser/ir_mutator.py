@@ -1,6 +1,57 @@
+import copy
 from .ir_visitor import *
 
+_skipped_fields = ['parent', 'la_type', 'parse_info', 'raw_text']
+
 
 class IRMutator(IRVisitor):
+    """
+    Base of the passes rewriting the IR. The IR from the type walker is shared by all the backends, so the
+    passes change the copies made by copy_tree and leave the original nodes as they are.
+    """
     def __init__(self, parse_type=None):
-        super().__init__(parse_type=parse_type)
\ No newline at end of file
+        super().__init__(parse_type=parse_type)
+
+    def get_fields(self, node):
+        """
+        :return: (field, child) for the children of node, field is (name, index) for the items of a list
+        """
+        fields = []
+        for name, value in vars(node).items():
+            if name in _skipped_fields:
+                continue
+            if isinstance(value, IRNode):
+                fields.append((name, value))
+            elif isinstance(value, list):
+                for index in range(len(value)):
+                    if isinstance(value[index], IRNode):
+                        fields.append(((name, index), value[index]))
+        return fields
+
+    def set_field(self, node, field, child):
+        if isinstance(field, tuple):
+            getattr(node, field[0])[field[1]] = child
+        else:
+            setattr(node, field, child)
+        child.set_parent(node)
+
+    def copy_tree(self, node, memo=None):
+        """
+        :return: a copy of node and the nodes below it, the types and the other attributes are shared
+        """
+        if memo is None:
+            memo = {}
+        if id(node) in memo:
+            return memo[id(node)]
+        new_node = copy.copy(node)
+        memo[id(node)] = new_node
+        for name, value in vars(node).items():
+            if name in _skipped_fields:
+                continue
+            if isinstance(value, IRNode):
+                setattr(new_node, name, self.copy_tree(value, memo))
+            elif isinstance(value, list) and any([isinstance(item, IRNode) for item in value]):
+                setattr(new_node, name, [self.copy_tree(item, memo) if isinstance(item, IRNode) else item for item in value])
+        if node.parent is not None and id(node.parent()) in memo:
+            new_node.set_parent(memo[id(node.parent())])
+        return new_node
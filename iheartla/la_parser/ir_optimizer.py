@@ -0,0 +1,590 @@
+import math
+from .ir_mutator import *
+
+# operands that can be replaced by a temporary, the other fields (subscripts, conditions, exponents, the lhs)
+# are left as they are
+_operand_fields = {
+    IRNodeType.Expression: ['value'],
+    IRNodeType.Subexpression: ['value'],
+    IRNodeType.Factor: ['sub', 'op', 'm', 'v'],
+    IRNodeType.Cast: ['value'],
+    IRNodeType.Add: ['left', 'right'],
+    IRNodeType.Sub: ['left', 'right'],
+    IRNodeType.Mul: ['left', 'right'],
+    IRNodeType.Div: ['left', 'right'],
+    IRNodeType.Solver: ['left', 'right'],
+    IRNodeType.Power: ['base'],
+    IRNodeType.Transpose: ['f'],
+    IRNodeType.Squareroot: ['value'],
+    IRNodeType.Norm: ['value'],
+    IRNodeType.MathFunc: ['param', 'remain_params'],
+    IRNodeType.Function: ['params'],
+    IRNodeType.InnerProduct: ['left', 'right'],
+    IRNodeType.FroProduct: ['left', 'right'],
+    IRNodeType.HadamardProduct: ['left', 'right'],
+    IRNodeType.CrossProduct: ['left', 'right'],
+    IRNodeType.KroneckerProduct: ['left', 'right'],
+    IRNodeType.DotProduct: ['left', 'right'],
+    IRNodeType.Factorization: ['matrix'],
+    IRNodeType.Matrix: ['value'],
+    IRNodeType.MatrixRows: ['rs', 'r'],
+    IRNodeType.MatrixRow: ['rc', 'exp'],
+    IRNodeType.MatrixRowCommas: ['value', 'exp'],
+    IRNodeType.ExpInMatrix: ['value'],
+    IRNodeType.Vector: ['items'],
+}
+# the expressions worth a temporary
+_candidate_types = [IRNodeType.Add, IRNodeType.Sub, IRNodeType.Mul, IRNodeType.Div, IRNodeType.Solver,
+                    IRNodeType.Power, IRNodeType.Squareroot, IRNodeType.Norm, IRNodeType.MathFunc,
+                    IRNodeType.Function, IRNodeType.Summation, IRNodeType.Cast, IRNodeType.InnerProduct,
+                    IRNodeType.FroProduct, IRNodeType.HadamardProduct, IRNodeType.CrossProduct,
+                    IRNodeType.KroneckerProduct, IRNodeType.DotProduct]
+# the codegens need these nodes where they are
+_fixed_types = [IRNodeType.Optimize, IRNodeType.Integral, IRNodeType.Domain, IRNodeType.Derivative,
+                IRNodeType.SparseMatrix, IRNodeType.SparseIfs, IRNodeType.SparseIf, IRNodeType.SparseOther]
+# attributes that don't change the value: the links, the types derived from the children, the codegen variables
+_unkeyed_fields = ['parent', 'la_type', 'parse_info', 'raw_text', 'symbol', 'symbols', 'sym_dict', 'lhs_sub_dict',
+                   'factorization']
+
+
+class IROptimizer(IRMutator):
+    """
+    Passes run on the IR between the type walk and the NumPy, Eigen and numba codegens:
+    O1: constant folding, the products A⁻¹b computed as solves
+    O2: O1 plus the common subexpressions and the loop invariants (of summations and optimization objectives),
+        both computed once in temporaries assigned before the statement, the common subexpressions of a summation
+        body that depend on its subscript, computed once per iteration, and the LU factorization shared by the
+        solves against the same matrix
+    """
+    def __init__(self, opt_level=DEFAULT_OPT_LEVEL):
+        super().__init__()
+        self.opt_level = opt_level
+        self.new_symbols = {}  # temporary -> la_type
+        self.counts = {}  # expression key -> occurrences
+        self.available = {}  # expression key -> (temporary, symbols read), factorizations included
+
+    def optimize(self, start_node, type_walker):
+        """
+        :return: the start node with the optimized statements, the temporaries are listed in new_symbols
+        """
+        self.symtable = dict(type_walker.symtable)
+        self.name_cnt_dict = {}
+        self.new_symbols = {}
+        self.counts = {}
+        self.available = {}
+        if self.opt_level == OptLevelEnum.O0:
+            return start_node
+        block = copy.copy(start_node.stat)
+        block.stmts = [self.copy_tree(stmt) for stmt in start_node.stat.stmts]
+        for stmt in block.stmts:
+            self.fold_constants(stmt)
+            self.rewrite_inverses(stmt)
+        if self.opt_level >= OptLevelEnum.O2:
+            block.stmts = self.hoist_expressions(block.stmts)
+        for stmt in block.stmts:
+            stmt.set_parent(block)
+        new_start = copy.copy(start_node)
+        new_start.stat = block
+        block.set_parent(new_start)
+        return new_start
+
+    ####################################################
+    # constant folding
+    def fold_constants(self, node):
+        """
+        :return: node, or the number replacing it
+        """
+        for field, child in self.get_fields(node):
+            if node.is_node(IRNodeType.Assignment) and field == 'left':
+                continue
+            new_child = self.fold_constants(child)
+            if new_child is not child:
+                self.set_field(node, field, new_child)
+        if node.node_type in [IRNodeType.Add, IRNodeType.Sub, IRNodeType.Mul, IRNodeType.Div]:
+            left = self.get_constant(node.left)
+            right = self.get_constant(node.right)
+            if left is None or right is None:
+                return node
+            if node.is_node(IRNodeType.Add):
+                value = left + right
+            elif node.is_node(IRNodeType.Sub):
+                value = left - right
+            elif node.is_node(IRNodeType.Mul):
+                value = left * right
+            else:
+                if right == 0:
+                    return node
+                # the backends divide as doubles
+                value = float(left) / right
+            if isinstance(value, float) and not math.isfinite(value):
+                return node
+            return self.get_constant_node(value, node)
+        return node
+
+    def get_constant(self, node):
+        """
+        :return: the value of a number, None for the other nodes
+        """
+        if node.is_node(IRNodeType.Factor):
+            if node.num is not None:
+                return self.get_constant(node.num)
+            elif node.sub is not None:
+                return self.get_constant(node.sub)
+        elif node.is_node(IRNodeType.Expression):
+            value = self.get_constant(node.value)
+            if value is not None and node.sign:
+                return -value
+            return value
+        elif node.is_node(IRNodeType.Subexpression):
+            return self.get_constant(node.value)
+        elif node.is_node(IRNodeType.Integer):
+            return node.value
+        elif node.is_node(IRNodeType.Double):
+            return float(node.value)
+        return None
+
+    def get_constant_node(self, value, node):
+        if isinstance(value, int):
+            num_node = IntegerNode(parse_info=node.parse_info)
+            num_node.la_type = ScalarType(is_int=True, is_constant=True)
+        else:
+            num_node = DoubleNode(parse_info=node.parse_info)
+            num_node.la_type = ScalarType()
+        num_node.value = value
+        factor_node = FactorNode(parse_info=node.parse_info)
+        factor_node.num = num_node
+        factor_node.la_type = num_node.la_type
+        num_node.set_parent(factor_node)
+        return factor_node
+
+    ####################################################
+    # solves instead of inverses
+    def rewrite_inverses(self, node):
+        """
+        The inverse is only computed when its value is needed, A⁻¹b is solved for
+        :return: node, or the solve replacing it
+        """
+        for field, child in self.get_fields(node):
+            if node.is_node(IRNodeType.Assignment) and field == 'left':
+                continue
+            new_child = self.rewrite_inverses(child)
+            if new_child is not child:
+                self.set_field(node, field, new_child)
+        if node.is_node(IRNodeType.Mul) and node.la_type is not None and (node.la_type.is_vector() or node.la_type.is_matrix()):
+            base = self.get_inverse_base(node.left)
+            right_type = node.right.la_type
+            if base is not None and (right_type.is_vector() or (right_type.is_matrix() and not right_type.sparse)):
+                solver_node = SolverNode(parse_info=node.parse_info, raw_text=node.raw_text)
+                solver_node.left = base
+                solver_node.right = node.right
+                solver_node.la_type = node.la_type
+                base.set_parent(solver_node)
+                node.right.set_parent(solver_node)
+                return solver_node
+        return node
+
+    def get_inverse_base(self, node):
+        """
+        :return: A for the nodes computing the inverse of a matrix A, None for the other nodes
+        """
+        if node.is_node(IRNodeType.Factor):
+            if node.op is not None:
+                return self.get_inverse_base(node.op)
+            elif node.sub is not None:
+                return self.get_inverse_base(node.sub)
+        elif node.is_node(IRNodeType.Subexpression):
+            return self.get_inverse_base(node.value)
+        elif node.is_node(IRNodeType.Expression):
+            if not node.sign:
+                return self.get_inverse_base(node.value)
+        elif node.is_node(IRNodeType.Power):
+            if node.r and node.la_type is not None and node.la_type.is_matrix():
+                return node.base
+        return None
+
+    ####################################################
+    # common subexpressions and loop invariants
+    def hoist_expressions(self, stmts):
+        """
+        :return: the statements with the temporaries inserted before the statements using them first
+        """
+        for stmt in stmts:
+            if self.is_optimizable(stmt):
+                subs = self.get_lhs_subs(stmt)
+                self.count_expressions(stmt, subs, len(subs) > 0, 1)
+        new_stmts = []
+        for stmt in stmts:
+            if self.is_optimizable(stmt):
+                hoisted = []
+                subs = self.get_lhs_subs(stmt)
+                self.hoist_operands(stmt, subs, len(subs) > 0, hoisted)
+                new_stmts += hoisted
+            new_stmts.append(stmt)
+            if stmt.is_node(IRNodeType.Assignment):
+                self.remove_stale(stmt.left.get_main_id())
+        return new_stmts
+
+    def remove_stale(self, lhs):
+        """
+        Forget the temporaries reading the new value of lhs, and the ones reading those temporaries
+        """
+        stale = {lhs}
+        removed = True
+        while removed:
+            removed = False
+            for key, value in list(self.available.items()):
+                if len(stale & value[1]) > 0:
+                    del self.available[key]
+                    stale.add(value[0])
+                    removed = True
+
+    def is_optimizable(self, stmt):
+        if stmt.is_node(IRNodeType.Assignment):
+            if stmt.op != '=' or stmt.right.is_node(IRNodeType.SparseMatrix):
+                return False
+            lhs_type = self.symtable.get(stmt.left.get_main_id())
+            # sparse matrices built entry by entry
+            return lhs_type is not None and not (lhs_type.is_matrix() and lhs_type.sparse)
+        return isinstance(stmt, ExprNode)
+
+    def get_lhs_subs(self, stmt):
+        """
+        :return: the subscripts of the lhs, the statement loops over them
+        """
+        subs = set()
+        if stmt.is_node(IRNodeType.Assignment):
+            self.get_symbols(stmt.left, subs, set())
+            subs.discard(stmt.left.get_main_id())
+        return subs
+
+    def get_operands(self, node, bound, loop):
+        """
+        :param bound: the subscripts and variables of the loops around node
+        :param loop: whether node is evaluated inside a loop
+        :return: (field, child, bound, loop, whether child can be replaced) for the operands of node
+        """
+        operands = []
+        if node.is_node(IRNodeType.Solver) and node.factorization is not None:
+            # the factorization replaces the matrix
+            operands.append(('right', node.right, bound, loop, True))
+            return operands
+        if node.is_node(IRNodeType.Assignment):
+            operands.append(('right', node.right, bound, loop, True))
+        elif node.is_node(IRNodeType.Summation):
+            operands.append(('exp', node.exp, bound | {node.content}, True, True))
+        elif node.is_node(IRNodeType.Optimize):
+            # the objective is evaluated for each step of the solver
+            operands.append(('exp', node.exp, bound | {node.base.get_main_id()}, True, True))
+        for field, child in self.get_fields(node):
+            name = field[0] if isinstance(field, tuple) else field
+            if name in _operand_fields.get(node.node_type, []):
+                # a scalar cast can't be separated from the 1x1 product it converts
+                operands.append((field, child, bound, loop, not node.is_node(IRNodeType.Cast)))
+        return operands
+
+    def is_candidate(self, node, bound):
+        """
+        :return: whether node is an expression worth a temporary that doesn't depend on the loops around it
+        """
+        if node.node_type not in _candidate_types or node.la_type is None:
+            return False
+        if not (node.la_type.is_scalar() or node.la_type.is_vector() or node.la_type.is_matrix()):
+            return False
+        return self.is_invariant(node, bound)
+
+    def is_invariant(self, node, bound):
+        """
+        :return: whether node can be computed before the loops around it
+        """
+        symbols = set()
+        inner_bound = set()
+        if not self.get_symbols(node, symbols, inner_bound):
+            return False
+        for symbol in symbols - inner_bound:
+            if symbol in bound:
+                return False
+            if symbol not in self.symtable and not symbol.isdigit():
+                # I in block matrices
+                return False
+        return True
+
+    def get_symbols(self, node, symbols, bound):
+        """
+        Collect the symbols read by node, the subscripts of the summations inside node go to bound
+        :return: False when node contains a node that can't be moved
+        """
+        if node.node_type in _fixed_types:
+            return False
+        if node.is_node(IRNodeType.Summation):
+            bound.add(node.content)
+        elif node.is_node(IRNodeType.Id):
+            symbols.add(node.main_id)
+            if node.contain_subscript():
+                symbols.update([str(sub) for sub in node.subs])
+        for field, child in self.get_fields(node):
+            if not self.get_symbols(child, symbols, bound):
+                return False
+        return True
+
+    def get_key(self, node):
+        """
+        :return: the same key for the nodes computing the same expression
+        """
+        key = [node.node_type]
+        for name, value in sorted(vars(node).items(), key=lambda item: item[0]):
+            if name in _unkeyed_fields:
+                continue
+            if isinstance(value, IRNode):
+                key.append((name, self.get_key(value)))
+            elif isinstance(value, list):
+                key.append((name, tuple([self.get_key(item) if isinstance(item, IRNode) else str(item) for item in value])))
+            elif value is None or isinstance(value, (str, int, float, Enum)):
+                key.append((name, value))
+        return tuple(key)
+
+    def count_expressions(self, node, bound, loop, delta):
+        if self.is_factorizable(node, bound):
+            key = self.get_factorization_key(node)
+            self.counts[key] = self.counts.get(key, 0) + delta
+        for field, child, child_bound, child_loop, replaceable in self.get_operands(node, bound, loop):
+            self.count_operand(child, child_bound, child_loop, replaceable, delta)
+
+    def count_operand(self, node, bound, loop, replaceable, delta):
+        if replaceable and self.is_candidate(node, bound):
+            key = self.get_key(node)
+            self.counts[key] = self.counts.get(key, 0) + delta
+        self.count_expressions(node, bound, loop, delta)
+
+    def hoist_operands(self, node, bound, loop, hoisted, guarded=False):
+        """
+        Replace the common subexpressions and the loop invariants below node by temporaries
+        :param hoisted: the assignments of the new temporaries
+        :param guarded: whether node is in the body of a summation, which isn't evaluated when the condition is
+        false or the sequence is empty: the expressions that can raise are only replaced by the temporaries
+        already computed
+        """
+        if self.is_factorizable(node, bound):
+            key = self.get_factorization_key(node)
+            if key in self.available or (not guarded and (loop or self.counts.get(key, 0) > 1)):
+                node.factorization = self.get_factorization(node, key, hoisted)
+        child_guarded = guarded or node.is_node(IRNodeType.Summation)
+        for field, child, child_bound, child_loop, replaceable in self.get_operands(node, bound, loop):
+            new_child = None
+            if replaceable and self.is_candidate(child, child_bound):
+                key = self.get_key(child)
+                if key in self.available or ((child_loop or self.counts.get(key, 0) > 1) and
+                                             not (child_guarded and self.can_raise(child))):
+                    new_child = self.get_temporary(child, key, hoisted)
+            if new_child is None:
+                self.hoist_operands(child, child_bound, child_loop, hoisted, child_guarded)
+            else:
+                self.set_field(node, field, new_child)
+        if node.is_node(IRNodeType.Summation) and not node.cond:
+            # with a condition the body isn't evaluated for every subscript
+            self.add_local_stmts(node, bound | {node.content})
+
+    def can_raise(self, node):
+        """
+        :return: whether computing node can raise on valid input: solves, inverses, divisions and function calls
+        """
+        if node.node_type in [IRNodeType.Solver, IRNodeType.Div, IRNodeType.Function, IRNodeType.Factorization]:
+            return True
+        if node.is_node(IRNodeType.Power) and node.r:
+            return True
+        if node.is_node(IRNodeType.MathFunc) and node.func_type == MathFuncType.MathFuncInv:
+            return True
+        for field, child in self.get_fields(node):
+            if self.can_raise(child):
+                return True
+        return False
+
+    def get_temporary(self, node, key, hoisted):
+        """
+        :return: the temporary holding the value of node, its assignment is added to hoisted the first time
+        """
+        if key not in self.available:
+            count = self.counts.get(key, 0)
+            if count > 1:
+                # the expressions inside node are computed once for all the occurrences
+                self.count_expressions(node, set(), False, 1 - count)
+            self.hoist_operands(node, set(), False, hoisted)
+            name = self.generate_var_name("tmp")
+            self.symtable[name] = node.la_type
+            self.new_symbols[name] = node.la_type
+            symbols = set()
+            self.get_symbols(node, symbols, set())
+            lhs_node = IdNode(name, parse_info=node.parse_info)
+            lhs_node.la_type = node.la_type
+            assign_node = AssignNode(lhs_node, node, parse_info=node.parse_info)
+            assign_node.op = '='
+            assign_node.symbols = symbols
+            lhs_node.set_parent(assign_node)
+            node.set_parent(assign_node)
+            hoisted.append(assign_node)
+            self.available[key] = (name, symbols)
+        id_node = IdNode(self.available[key][0], parse_info=node.parse_info)
+        id_node.la_type = node.la_type
+        factor_node = FactorNode(parse_info=node.parse_info)
+        factor_node.id = id_node
+        factor_node.la_type = node.la_type
+        id_node.set_parent(factor_node)
+        return factor_node
+
+    ####################################################
+    # common subexpressions of a summation body
+    def add_local_stmts(self, node, bound):
+        """
+        The expressions repeated in the body of the summation node that depend on its subscript are computed once
+        per iteration, in temporaries assigned by node.local_stmts
+        :param bound: the subscripts and variables of the loops around the body
+        """
+        counts = {}
+        self.count_locals(node.exp, bound, counts, 1)
+        if not any([count > 1 for count in counts.values()]):
+            return
+        available = {}
+        local_stmts = []
+        new_exp = self.replace_locals(node.exp, bound, counts, available, local_stmts)
+        if new_exp is not node.exp:
+            self.set_field(node, 'exp', new_exp)
+        # a new list, the copies made by copy_tree share the empty one
+        node.local_stmts = local_stmts
+        for stmt in local_stmts:
+            stmt.set_parent(node)
+
+    def is_local_candidate(self, node, bound):
+        if node.node_type not in _candidate_types or node.la_type is None:
+            return False
+        if not (node.la_type.is_scalar() or node.la_type.is_vector() or node.la_type.is_matrix()):
+            return False
+        symbols = set()
+        inner_bound = set()
+        if not self.get_symbols(node, symbols, inner_bound):
+            return False
+        for symbol in symbols - inner_bound:
+            if symbol not in bound and symbol not in self.symtable and not symbol.isdigit():
+                return False
+        return True
+
+    def get_local_operands(self, node):
+        """
+        :return: (field, child, whether child can be replaced) for the operands of node evaluated in each iteration,
+        the nested summations have their own
+        """
+        if node.is_node(IRNodeType.Summation) or node.node_type in _fixed_types:
+            return []
+        return [(field, child, replaceable) for field, child, child_bound, child_loop, replaceable in
+                self.get_operands(node, set(), True)]
+
+    def count_locals(self, node, bound, counts, delta):
+        if self.is_local_candidate(node, bound):
+            key = self.get_key(node)
+            counts[key] = counts.get(key, 0) + delta
+        self.count_local_operands(node, bound, counts, delta)
+
+    def count_local_operands(self, node, bound, counts, delta):
+        for field, child, replaceable in self.get_local_operands(node):
+            if replaceable:
+                self.count_locals(child, bound, counts, delta)
+            else:
+                self.count_local_operands(child, bound, counts, delta)
+
+    def replace_locals(self, node, bound, counts, available, local_stmts):
+        """
+        :return: node, or the temporary replacing it
+        """
+        if self.is_local_candidate(node, bound):
+            key = self.get_key(node)
+            if key in available or counts.get(key, 0) > 1:
+                return self.get_local(node, key, bound, counts, available, local_stmts)
+        self.replace_local_operands(node, bound, counts, available, local_stmts)
+        return node
+
+    def replace_local_operands(self, node, bound, counts, available, local_stmts):
+        for field, child, replaceable in self.get_local_operands(node):
+            if replaceable:
+                new_child = self.replace_locals(child, bound, counts, available, local_stmts)
+                if new_child is not child:
+                    self.set_field(node, field, new_child)
+            else:
+                self.replace_local_operands(child, bound, counts, available, local_stmts)
+
+    def get_local(self, node, key, bound, counts, available, local_stmts):
+        """
+        :return: the temporary holding the value of node in the iteration, its assignment is added to local_stmts
+        the first time
+        """
+        if key not in available:
+            count = counts.get(key, 0)
+            if count > 1:
+                # the expressions inside node are computed once for all the occurrences
+                self.count_local_operands(node, bound, counts, 1 - count)
+            self.replace_local_operands(node, bound, counts, available, local_stmts)
+            name = self.generate_var_name("tmp")
+            self.symtable[name] = node.la_type
+            self.new_symbols[name] = node.la_type
+            lhs_node = IdNode(name, parse_info=node.parse_info)
+            lhs_node.la_type = node.la_type
+            assign_node = AssignNode(lhs_node, node, parse_info=node.parse_info)
+            assign_node.op = '='
+            lhs_node.set_parent(assign_node)
+            node.set_parent(assign_node)
+            local_stmts.append(assign_node)
+            available[key] = name
+        id_node = IdNode(available[key], parse_info=node.parse_info)
+        id_node.la_type = node.la_type
+        factor_node = FactorNode(parse_info=node.parse_info)
+        factor_node.id = id_node
+        factor_node.la_type = node.la_type
+        id_node.set_parent(factor_node)
+        return factor_node
+
+    ####################################################
+    # factorizations shared by the solves
+    def is_factorizable(self, node, bound):
+        """
+        :return: whether node solves against a dense square matrix that doesn't depend on the loops around it
+        """
+        if not node.is_node(IRNodeType.Solver) or node.left.la_type is None or node.right.la_type is None:
+            return False
+        left_type = node.left.la_type
+        right_type = node.right.la_type
+        if not left_type.is_matrix() or left_type.sparse or left_type.rows != left_type.cols:
+            return False
+        if not (right_type.is_vector() or (right_type.is_matrix() and not right_type.sparse)):
+            return False
+        return self.is_invariant(node.left, bound)
+
+    def get_factorization_key(self, node):
+        return IRNodeType.Factorization, self.get_key(node.left)
+
+    def get_factorization(self, node, key, hoisted):
+        """
+        :return: the name of the factorization of the matrix of the solve node, its assignment is added to
+        hoisted the first time
+        """
+        if key not in self.available:
+            count = self.counts.get(key, 0)
+            if count > 1:
+                # the matrix is only read by the factorization
+                self.count_operand(node.left, set(), False, True, 1 - count)
+            matrix = self.copy_tree(node.left)
+            factorization_node = FactorizationNode(matrix, parse_info=node.parse_info)
+            factorization_node.la_type = node.left.la_type
+            matrix.set_parent(factorization_node)
+            self.hoist_operands(factorization_node, set(), False, hoisted)
+            name = self.generate_var_name("lu")
+            # reserves the name, the codegens don't see the factorizations as symbols
+            self.symtable[name] = node.left.la_type
+            symbols = set()
+            self.get_symbols(factorization_node, symbols, set())
+            lhs_node = IdNode(name, parse_info=node.parse_info)
+            lhs_node.la_type = node.left.la_type
+            assign_node = AssignNode(lhs_node, factorization_node, parse_info=node.parse_info)
+            assign_node.op = '='
+            assign_node.symbols = symbols
+            lhs_node.set_parent(assign_node)
+            factorization_node.set_parent(assign_node)
+            hoisted.append(assign_node)
+            self.available[key] = (name, symbols)
+        return self.available[key][0]
@@ -22,6 +22,8 @@ class IRVisitor(object):
         self.ids_dict = {}  # identifiers with subscripts
         self.ret_symbol = None
         self.unofficial_method = False  # matrix pow only(eigen)
+        self.has_optimization = False  # solver code (eigen)
+        self.has_integral = False  # quadrature code (eigen)
         self.content = ''
         self.parse_type = parse_type
         self.logger = LaLogger.getInstance().get_logger(LoggerTypeEnum.DEFAULT)
@@ -97,14 +99,29 @@ class IRVisitor(object):
         self.name_cnt_dict = type_walker.name_cnt_dict
         self.ret_symbol = type_walker.ret_symbol
         self.unofficial_method = type_walker.unofficial_method
+        self.has_optimization = type_walker.has_optimization
+        self.has_integral = type_walker.has_integral
         self.lhs_list = type_walker.lhs_list
         self.la_content = type_walker.la_content
         self.same_dim_list = type_walker.same_dim_list
         if func_name is not None:
             self.func_name = func_name
+        else:
+            self.func_name = 'myExpression'
         # self.print_symbols()
         self.declared_symbols.clear()
 
+    def add_symbols(self, symbols):
+        """
+        add the symbols created after the type walk (temporaries of IROptimizer), the symtable of the type walker
+        is left as it is
+        """
+        if len(symbols) > 0:
+            self.symtable = dict(self.symtable)
+            for key, la_type in symbols.items():
+                self.symtable[key] = la_type
+                self.def_dict[key] = False
+
     def visit_code(self, node, **kwargs):
         self.content = ''
         self.content = self.pre_str + self.visit(node) + self.post_str
@@ -143,6 +160,7 @@ class IRVisitor(object):
             IRNodeType.Squareroot: "visit_squareroot",
             IRNodeType.Power: "visit_power",
             IRNodeType.Solver: "visit_solver",
+            IRNodeType.Factorization: "visit_factorization",
             IRNodeType.Derivative: "visit_derivative",
             IRNodeType.MathFunc: "visit_math_func",
             IRNodeType.Optimize: "visit_optimize",
@@ -287,6 +305,9 @@ class IRVisitor(object):
     def visit_solver(self, node, **kwargs):
         pass
 
+    def visit_factorization(self, node, **kwargs):
+        pass
+
     def visit_sparse_if(self, node, **kwargs):
         pass
 
@@ -1,84 +1,27 @@
-from pprint import pprint
-import time
-from tatsu.objectmodel import Node
-from tatsu.semantics import ModelBuilderSemantics
-from tatsu.ast import AST
-import tatsu
-from tatsu.exceptions import (
-    FailedCut,
-    FailedExpectingEndOfText,
-    FailedLeftRecursion,
-    FailedLookahead,
-    FailedParse,
-    FailedPattern,
-    FailedRef,
-    FailedSemantics,
-    FailedKeywordSemantics,
-    FailedToken,
-    OptionSucceeded
-)
-from enum import Enum
-from .codegen_numpy import CodeGenNumpy
-from .codegen_eigen import CodeGenEigen
-from .codegen_latex import CodeGenLatex
-from .codegen_mathjax import CodeGenMathjax
-from .codegen_matlab import CodeGenMatlab
-from .type_walker import *
-from .ir import *
-from .ir_visitor import *
 from ..la_tools.la_msg import *
 from ..la_tools.la_helper import *
+from ..la_tools.la_logger import *
 from ..la_tools.parser_manager import ParserManager
+from ..la_tools.compile_cache import CompileCache
+from ..la_tools.la_profiler import CompileProfiler
 import subprocess
 import threading
+import functools
+import time
 import regex as re
 from ..la_grammar import *
-
-## We don't need wx to run in command-line mode. This makes it optional.
-try:
-    import wx
-except ImportError:
-    class wx(object): pass
-    wx.CallAfter = lambda o, *x, **y: None
-
 import sys
 import traceback
 import os.path
 from pathlib import Path
 import tempfile
 import io
+import hashlib
 
+# The codegens, the type walker (TatSu) and the generated parsers are imported on first use, so that
+# importing this module stays cheap for short command-line runs.
 _id_pattern = re.compile("[A-Za-z\p{Ll}\p{Lu}\p{Lo}]\p{M}*")
 _backtick_pattern = re.compile("`[^`]*`")
-_codegen_dict = {}
-
-
-def get_codegen(parser_type):
-    if parser_type not in _codegen_dict:
-        if parser_type == ParserTypeEnum.LATEX:
-            gen = CodeGenLatex()
-        elif parser_type == ParserTypeEnum.NUMPY:
-            gen = CodeGenNumpy()
-        elif parser_type == ParserTypeEnum.EIGEN:
-            gen = CodeGenEigen()
-        elif parser_type == ParserTypeEnum.MATHJAX:
-            gen = CodeGenMathjax()
-        elif parser_type == ParserTypeEnum.MATLAB:
-            gen = CodeGenMatlab()
-        _codegen_dict[parser_type] = gen
-    return _codegen_dict[parser_type]
-
-
-def walk_model(parser_type, type_walker, node_info, func_name=None):
-    gen = get_codegen(parser_type)
-    #
-    gen.init_type(type_walker, func_name)
-    gen.visit_code(node_info)
-    if parser_type != ParserTypeEnum.LATEX:  # print once
-        gen.print_symbols()
-    return gen.content
-
-
 if getattr(sys, 'frozen', False):
     # We are running in a bundle.
     GRAMMAR_DIR = Path(sys._MEIPASS) / 'la_grammar'
@@ -87,59 +30,307 @@ else:
     GRAMMAR_DIR = Path(__file__).resolve().parent.parent / 'la_grammar'
 # print( 'GRAMMAR_DIR:', GRAMMAR_DIR )
 
-_grammar_content = None  # content in file
+_grammar_content = LA  # content in file
 _default_key = 'default'
-_parser_manager = ParserManager(GRAMMAR_DIR)
 
 
-def get_compiled_parser(grammar, keys='init', extra_dict={}):
-    log_la("keys:" + keys)
-    return _parser_manager.get_parser(keys, grammar, extra_dict)
+def log_la(content):
+    LaLogger.getInstance().get_logger(LoggerTypeEnum.DEFAULT).debug(content)
+
+
+class CompilerSession(object):
+    """
+    Owns the parsers, the type walker and the codegens used by a compilation.
+    Sessions don't share mutable state, so threads can compile concurrently as long as
+    each of them uses its own session.
+    """
+    def __init__(self, parser_manager=None, opt_level=DEFAULT_OPT_LEVEL, parallel_mode=DEFAULT_PARALLEL_MODE,
+                 sequence_storage=DEFAULT_SEQUENCE_STORAGE):
+        if parser_manager is None:
+            parser_manager = get_default_session().parser_manager.new_session_manager()
+        self.parser_manager = parser_manager
+        self.opt_level = opt_level  # OptLevelEnum, for the NumPy, Eigen and numba outputs
+        self.parallel_mode = parallel_mode  # ParallelModeEnum, for the Eigen output
+        self.sequence_storage = sequence_storage  # SequenceStorageEnum, for the Eigen output
+        self.type_walker = None
+        self.optimizer = None
+        self.codegen_dict = {}
+        self.profiler = None  # CompileProfiler, only while profiling
+
+    def has_default_options(self):
+        """
+        :return: whether the outputs are the ones kept in the compile cache
+        """
+        return self.opt_level == DEFAULT_OPT_LEVEL and self.parallel_mode == DEFAULT_PARALLEL_MODE and \
+            self.sequence_storage == DEFAULT_SEQUENCE_STORAGE
+
+    def begin_phase(self, name):
+        if self.profiler is not None:
+            self.profiler.begin(name)
+
+    def get_codegen(self, parser_type):
+        if parser_type not in self.codegen_dict:
+            if parser_type == ParserTypeEnum.LATEX:
+                from .codegen_latex import CodeGenLatex
+                gen = CodeGenLatex()
+            elif parser_type == ParserTypeEnum.NUMPY:
+                from .codegen_numpy import CodeGenNumpy
+                gen = CodeGenNumpy()
+            elif parser_type == ParserTypeEnum.EIGEN:
+                from .codegen_eigen import CodeGenEigen
+                gen = CodeGenEigen()
+            elif parser_type == ParserTypeEnum.NUMBA:
+                from .codegen_numpy import CodeGenNumpy
+                gen = CodeGenNumpy(numba=True)
+            elif parser_type == ParserTypeEnum.MATHJAX:
+                from .codegen_mathjax import CodeGenMathjax
+                gen = CodeGenMathjax()
+            elif parser_type == ParserTypeEnum.MATLAB:
+                from .codegen_matlab import CodeGenMatlab
+                gen = CodeGenMatlab()
+            self.codegen_dict[parser_type] = gen
+        return self.codegen_dict[parser_type]
+
+    def get_optimizer(self):
+        if self.optimizer is None:
+            from .ir_optimizer import IROptimizer
+            self.optimizer = IROptimizer()
+        self.optimizer.opt_level = self.opt_level
+        return self.optimizer
+
+    def walk_model(self, parser_type, type_walker, node_info, func_name=None):
+        gen = self.get_codegen(parser_type)
+        if parser_type == ParserTypeEnum.EIGEN:
+            gen.parallel_mode = self.parallel_mode
+            gen.sequence_storage = self.sequence_storage
+        #
+        gen.init_type(type_walker, func_name)
+        if self.opt_level > OptLevelEnum.O0 and parser_type in [ParserTypeEnum.NUMPY, ParserTypeEnum.EIGEN, ParserTypeEnum.NUMBA]:
+            # LaTeX and MathJax print the program as written. The MATLAB output is a partial port of the NumPy one,
+            # without the solves, factorizations and per-iteration temporaries the optimizer adds.
+            optimizer = self.get_optimizer()
+            node_info = optimizer.optimize(node_info, type_walker)
+            gen.add_symbols(optimizer.new_symbols)
+        gen.visit_code(node_info)
+        if parser_type != ParserTypeEnum.LATEX:  # print once
+            gen.print_symbols()
+        return gen.content
+
+    def get_compiled_parser(self, grammar, keys='init', extra_dict={}):
+        log_la("keys:" + keys)
+        return self.parser_manager.get_parser(keys, grammar, extra_dict)
+
+    def get_type_walker(self):
+        if self.type_walker:
+            self.type_walker.reset()
+        else:
+            from .type_walker import TypeWalker
+            self.type_walker = TypeWalker()
+        return self.type_walker
+
+    def create_parser(self):
+        parser = None
+        try:
+            # get init parser
+            parser = self.get_compiled_parser(SIMPLIFIED)
+            # get default parser
+            self.get_compiled_parser(_grammar_content, _default_key)
+        except IOError:
+            print("IO Error!")
+        return parser
+
+    def get_default_parser(self):
+        return self.create_parser()
+
+    def parse_ir_node(self, content, model):
+        """
+        :param model: the result of the init parser, walked once to find the symbols of the program
+        """
+        # type walker
+        type_walker = self.get_type_walker()
+        self.begin_phase("pre_walk")
+        start_node = type_walker.walk(model, pre_walk=True)
+        self.begin_phase("specialization")
+        # deal with function
+        func_dict = type_walker.get_func_symbols()
+        package_name_dict = {}
+        if len(start_node.directives) > 0:
+            package_name_dict = start_node.get_package_dict()
+        parser = self.get_specialized_parser(type_walker.parameters, type_walker.multi_lhs_list, func_dict, package_name_dict)
+        return self.walk_specialized(content, parser)
+
+    def parse_content(self, content):
+        """
+        parse the program once with the parser specialized by the scanned declarations, the init parser and the
+        pre-walk only run when that fails, so the error messages are the same as before. The phases of the failed
+        attempt are profiled as one scan_fallback phase
+        :return: type_walker, start_node
+        """
+        from tatsu.exceptions import FailedParse
+        start = len(self.profiler.phases) if self.profiler is not None else 0
+        try:
+            return self.parse_ir_node_scanned(content)
+        except (FailedParse, AssertionError):
+            log_la("scanned parse failed, falling back to the init parser")
+            if self.profiler is not None:
+                self.profiler.fold(start, "scan_fallback")
+        self.begin_phase("init_parse")
+        parser = self.get_default_parser()
+        model = parser.parse(content, parseinfo=True)
+        return self.parse_ir_node(content, model)
+
+    def parse_ir_node_scanned(self, content):
+        """
+        single parse: the symbols come from scan_declarations instead of the init parser
+        """
+        self.begin_phase("scan")
+        from .decl_scanner import scan_declarations
+        decls = scan_declarations(content)
+        self.begin_phase("specialization")
+        parser = self.get_specialized_parser(decls.parameters, decls.multi_lhs_list, decls.func_dict, decls.package_dict)
+        return self.walk_specialized(content, parser)
+
+    def walk_specialized(self, content, parser):
+        self.begin_phase("second_parse")
+        model = parser.parse(content, parseinfo=True)
+        # second parsing
+        self.begin_phase("type_walk")
+        type_walker = self.get_type_walker()
+        type_walker.reset_state(content)  # reset
+        start_node = type_walker.walk(model)
+        return type_walker, start_node
+
+    def get_specialized_parser(self, parameters, multi_lhs_list, func_dict, package_name_dict):
+        """
+        :return: the default parser extended with the multi-letter identifiers, the functions and the packages
+        """
+        current_content = _grammar_content
+        multi_list = []
+        extra_dict = {}
+        parse_key = _default_key
+        for parameter in parameters:
+            if _id_pattern.fullmatch(parameter):
+                continue  # valid single identifier
+            if len(parameter) > 1 and '_' not in parameter and '`' not in parameter:
+                multi_list.append(parameter)
+        # multi_list += type_walker.multi_lhs_list
+        for multi_lhs in multi_lhs_list:
+            if _id_pattern.fullmatch(multi_lhs):
+                continue  # valid single identifier
+            multi_list.append(multi_lhs)
+        # not add backticks
+        new_list = []
+        for key in multi_list:
+            if '`' not in key:
+                new_list.append(key)
+        multi_list = new_list
+        if len(multi_list) > 0:
+            multi_list = [re.escape(item).replace('/', '\\/') for item in multi_list]
+            multi_list = sorted(multi_list, key=len, reverse=True)
+            extra_dict['ids'] = multi_list
+            keys_rule = "/" + "/|/".join(multi_list) + "/"
+            log_la("keys_rule:" + keys_rule)
+            parse_key += "keys_rule:{};".format(keys_rule)
+            if DEBUG_PARSER:
+                current_content = current_content.replace("= !KEYWORDS(",
+                                                          "= const:({}) | (!(KEYWORDS | {} )".format(keys_rule, keys_rule))
+        if len(func_dict.keys()) > 0:
+            key_list = list(func_dict.keys())
+            extra_list = []
+            for key in key_list:
+                if '`' not in key:
+                    extra_list.append('`{}`'.format(key))
+            key_list += extra_list
+            key_list = [re.escape(item).replace('/', '\\/') for item in key_list]
+            func_rule = "/" + "/|/".join(key_list) + "/"
+            extra_dict['funcs'] = key_list
+            log_la("func_rule:" + func_rule)
+            if DEBUG_PARSER:
+                current_content = current_content.replace("func_id='!!!';", "func_id={};".format(func_rule))
+            parse_key += "func symbol:{}, func sig:{}".format(','.join(func_dict.keys()), ";".join(func_dict.values()))
+        # deal with packages
+        if len(package_name_dict) > 0:
+            # include directives
+            package_name_list = []
+            key_names = []
+            for package in package_name_dict:
+                name_list = package_name_dict[package]
+                if 'e' in name_list:
+                    if DEBUG_PARSER:
+                        current_content = current_content.replace("pi;", "pi|e;")
+                        current_content = current_content.replace("BUILTIN_KEYWORDS;", "BUILTIN_KEYWORDS|e;")
+                    name_list.remove('e')
+                    parse_key += 'e;'
+                    package_name_list.append('e')
+                for name in name_list:
+                    key_names.append("{}_func".format(name))
+            package_name_list += key_names
+            if len(key_names) > 0:
+                # add new rules
+                if DEBUG_PARSER:
+                    keyword_index = current_content.find('predefined_built_operators;')
+                    current_content = current_content[:keyword_index] + '|'.join(key_names) + '|' + current_content[
+                                                                                                    keyword_index:]
+                parse_key += ';'.join(key_names)
+            extra_dict['pkg'] = package_name_list
+        # get new parser
+        return self.get_compiled_parser(current_content, parse_key, extra_dict)
+
+    def compile(self, la_content, parser_type, func_name=None):
+        """
+        :return: the generated contents in the order numpy, eigen, latex, mathjax, numba (only for the types in parser_type)
+        """
+        type_walker, start_node = self.parse_content(la_content)
+        ret = []
+        for cur_type in [ParserTypeEnum.NUMPY, ParserTypeEnum.EIGEN, ParserTypeEnum.LATEX, ParserTypeEnum.MATHJAX,
+                         ParserTypeEnum.NUMBA]:
+            if parser_type & cur_type:
+                self.begin_phase("codegen_{}".format(cur_type.name.lower()))
+                ret.append(self.walk_model(cur_type, type_walker, start_node, func_name=func_name))
+        if self.profiler is not None:
+            self.profiler.end()
+        return ret
 
 
-_type_walker = None
+# the session used by the module-level functions below, created on first use
+_default_session = None
+_default_session_lock = threading.Lock()
 
 
-def get_type_walker():
-    global _type_walker
-    if _type_walker:
-        _type_walker.reset()
-    else:
-        _type_walker = TypeWalker()
-    return _type_walker
+def get_default_session():
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = CompilerSession(ParserManager(GRAMMAR_DIR))
+    return _default_session
 
 
-def log_la(content):
-    LaLogger.getInstance().get_logger(LoggerTypeEnum.DEFAULT).debug(content)
+def get_codegen(parser_type):
+    return get_default_session().get_codegen(parser_type)
+
+
+def walk_model(parser_type, type_walker, node_info, func_name=None):
+    return get_default_session().walk_model(parser_type, type_walker, node_info, func_name)
+
+
+def get_compiled_parser(grammar, keys='init', extra_dict={}):
+    return get_default_session().get_compiled_parser(grammar, keys, extra_dict)
+
+
+def get_type_walker():
+    return get_default_session().get_type_walker()
 
 
 def create_parser():
-    parser = None
-    try:
-        # file = open(GRAMMAR_DIR/'LA.ebnf')
-        # simplified_file = open(GRAMMAR_DIR/'simplified_grammar.ebnf')
-        # grammar = file.read()
-        grammar = LA
-        # simplified_grammar = simplified_file.read()
-        simplified_grammar = SIMPLIFIED
-        global _grammar_content
-        _grammar_content = grammar
-        # get init parser
-        parser = get_compiled_parser(simplified_grammar)
-        # file.close()
-        # simplified_file.close()
-        # get default parser
-        get_compiled_parser(_grammar_content, _default_key)
-    except IOError:
-        print("IO Error!")
-    return parser
+    return get_default_session().create_parser()
 
 
 def get_default_parser():
-    return create_parser()
+    return get_default_session().get_default_parser()
 
 
 def generate_latex_code(type_walker, node_info, frame):
+    from tatsu.exceptions import FailedParse, FailedCut
     tex_content = ''
     show_pdf = None
 
@@ -175,7 +366,7 @@ def generate_latex_code(type_walker, node_info, frame):
     with tempfile.TemporaryDirectory() as tmpdir:
         if DEBUG_MODE:
             tex_content, show_pdf = get_pdf(tmpdir)
-            wx.CallAfter(frame.UpdateTexPanel, tex_content, show_pdf)
+            call_after(frame.UpdateTexPanel, tex_content, show_pdf)
         else:
             try:
                 tex_content, show_pdf = get_pdf(tmpdir)
@@ -191,106 +382,22 @@ def generate_latex_code(type_walker, node_info, frame):
                 traceback.print_exc()
                 tex_content = str(exc_info[2])
             finally:
-                wx.CallAfter(frame.UpdateTexPanel, tex_content, show_pdf)
+                call_after(frame.UpdateTexPanel, tex_content, show_pdf)
 
 
 def parse_ir_node(content, model):
-    global _grammar_content
-    current_content = _grammar_content
-    # type walker
-    type_walker = get_type_walker()
-    start_node = type_walker.walk(model, pre_walk=True)
-    # deal with function
-    func_dict = type_walker.get_func_symbols()
-    multi_list = []
-    extra_dict = {}
-    parse_key = _default_key
-    for parameter in type_walker.parameters:
-        if _id_pattern.fullmatch(parameter):
-            continue  # valid single identifier
-        if len(parameter) > 1 and '_' not in parameter and '`' not in parameter:
-            multi_list.append(parameter)
-    # multi_list += type_walker.multi_lhs_list
-    for multi_lhs in type_walker.multi_lhs_list:
-        if _id_pattern.fullmatch(multi_lhs):
-            continue  # valid single identifier
-        multi_list.append(multi_lhs)
-    # not add backticks
-    new_list = []
-    for key in multi_list:
-        if '`' not in key:
-            new_list.append(key)
-    multi_list = new_list
-    if len(multi_list) > 0:
-        multi_list = [re.escape(item).replace('/', '\\/') for item in multi_list]
-        multi_list = sorted(multi_list, key=len, reverse=True)
-        extra_dict['ids'] = multi_list
-        keys_rule = "/" + "/|/".join(multi_list) + "/"
-        log_la("keys_rule:" + keys_rule)
-        parse_key += "keys_rule:{};".format(keys_rule)
-        if DEBUG_PARSER:
-            current_content = current_content.replace("= !KEYWORDS(",
-                                                      "= const:({}) | (!(KEYWORDS | {} )".format(keys_rule, keys_rule))
-    if len(func_dict.keys()) > 0:
-        key_list = list(func_dict.keys())
-        extra_list = []
-        for key in key_list:
-            if '`' not in key:
-                extra_list.append('`{}`'.format(key))
-        key_list += extra_list
-        key_list = [re.escape(item).replace('/', '\\/') for item in key_list]
-        func_rule = "/" + "/|/".join(key_list) + "/"
-        extra_dict['funcs'] = key_list
-        log_la("func_rule:" + func_rule)
-        if DEBUG_PARSER:
-            current_content = current_content.replace("func_id='!!!';", "func_id={};".format(func_rule))
-        parse_key += "func symbol:{}, func sig:{}".format(','.join(func_dict.keys()), ";".join(func_dict.values()))
-    # deal with packages
-    if len(start_node.directives) > 0:
-        # include directives
-        package_name_dict = start_node.get_package_dict()
-        package_name_list = []
-        key_names = []
-        for package in package_name_dict:
-            name_list = package_name_dict[package]
-            if 'e' in name_list:
-                if DEBUG_PARSER:
-                    current_content = current_content.replace("pi;", "pi|e;")
-                    current_content = current_content.replace("BUILTIN_KEYWORDS;", "BUILTIN_KEYWORDS|e;")
-                name_list.remove('e')
-                parse_key += 'e;'
-                package_name_list.append('e')
-            for name in name_list:
-                key_names.append("{}_func".format(name))
-        package_name_list += key_names
-        if len(key_names) > 0:
-            # add new rules
-            if DEBUG_PARSER:
-                keyword_index = current_content.find('predefined_built_operators;')
-                current_content = current_content[:keyword_index] + '|'.join(key_names) + '|' + current_content[
-                                                                                                keyword_index:]
-            parse_key += ';'.join(key_names)
-        extra_dict['pkg'] = package_name_list
-    # get new parser
-    parser = get_compiled_parser(current_content, parse_key, extra_dict)
-    model = parser.parse(content, parseinfo=True)
-    # second parsing
-    type_walker.reset_state(content)  # reset
-    start_node = type_walker.walk(model)
-    return type_walker, start_node
+    return get_default_session().parse_ir_node(content, model)
 
 
 def clean_parsers():
-    _parser_manager.clean_parsers()
+    get_default_session().parser_manager.clean_parsers()
 
 
 def parse_and_translate(content, frame, parser_type=None, func_name=None):
     start_time = time.time()
     def get_parse_result(parser_type):
-        parser = get_default_parser()
-        model = parser.parse(content, parseinfo=True)
         # type walker
-        type_walker, start_node = parse_ir_node(content, model)
+        type_walker, start_node = get_default_session().parse_content(content)
         # parsing Latex at the same time
         latex_thread = threading.Thread(target=generate_latex_code, args=(type_walker, start_node, frame,))
         latex_thread.start()
@@ -301,115 +408,262 @@ def parse_and_translate(content, frame, parser_type=None, func_name=None):
         return res, 0
     if DEBUG_MODE:
         result = get_parse_result(parser_type)
-        wx.CallAfter(frame.UpdateMidPanel, result)
+        call_after(frame.UpdateMidPanel, result)
         print("------------ %.2f seconds ------------" % (time.time() - start_time))
     else:
         try:
             result = get_parse_result(parser_type)
-        except FailedParse as e:
-            tex = LaMsg.getInstance().get_parse_error(e)
-            log_la("FailedParse:" + str(e))
-            result = (tex, 1)
-        except FailedCut as e:
-            tex = "FailedCut: {}".format(str(e))
-            result = (tex, 1)
-        except AssertionError as e:
-            tex = "{}".format(e.args[0])
-            result = (tex, 1)
         except Exception as e:
-            tex = "Exception: {}".format(str(e))
+            tex = get_compile_error_msg(e)
+            log_la("{}:{}".format(type(e).__name__, str(e)))
             result = (tex, 1)
         except:
             tex = str(sys.exc_info()[0])
             result = (tex, 1)
         finally:
-            wx.CallAfter(frame.UpdateMidPanel, result)
+            call_after(frame.UpdateMidPanel, result)
             print("------------ %.2f seconds ------------" % (time.time() - start_time))
             if result[1] != 0:
                 print(result[0])
     return result
 
 
+def call_after(func, *args):
+    """
+    forward to wx.CallAfter, we don't need wx to run in command-line mode
+    """
+    try:
+        import wx
+    except ImportError:
+        return
+    wx.CallAfter(func, *args)
+
+
+def get_compile_error_msg(e):
+    """
+    :param e: exception raised while compiling
+    :return: the message shown to the user
+    """
+    from tatsu.exceptions import FailedParse, FailedCut
+    if isinstance(e, FailedParse):
+        return LaMsg.getInstance().get_parse_error(e)
+    elif isinstance(e, FailedCut):
+        return "FailedCut: {}".format(str(e))
+    elif isinstance(e, AssertionError):
+        return "{}".format(e.args[0])
+    return "Exception: {}".format(str(e))
+
+
 def get_file_name(path_name):
     return Path(path_name).stem
 
 
+_compile_cache = None
+_compile_cache_lock = threading.Lock()
+
+
+def get_compile_cache():
+    global _compile_cache
+    with _compile_cache_lock:
+        if _compile_cache is None:
+            _compile_cache = CompileCache()
+    return _compile_cache
+
+
+def get_compiled_outputs(la_content, parser_type, func_name=None, use_cache=True, session=None):
+    """
+    :return: the generated contents in the order numpy, eigen, latex, mathjax (only for the types in parser_type)
+    """
+    if session is not None and not session.has_default_options():
+        use_cache = False  # the cache holds the outputs of the default options
+    if use_cache:
+        ret = get_compile_cache().get(la_content, parser_type, func_name)
+        if ret is not None:
+            return ret
+    if session is None:
+        session = get_default_session()
+    ret = session.compile(la_content, parser_type, func_name)
+    if use_cache:
+        get_compile_cache().put(la_content, parser_type, ret, func_name)
+    return ret
+
+
 def compile_la_content(la_content,
-                       parser_type=ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN | ParserTypeEnum.LATEX | ParserTypeEnum.MATHJAX):
-    parser = get_default_parser()
+                       parser_type=ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN | ParserTypeEnum.LATEX | ParserTypeEnum.MATHJAX,
+                       use_cache=True):
     try:
-        model = parser.parse(la_content, parseinfo=True)
-        type_walker, start_node = parse_ir_node(la_content, model)
-        ret = []
-        if parser_type & ParserTypeEnum.NUMPY:
-            numpy_content = walk_model(ParserTypeEnum.NUMPY, type_walker, start_node)
-            ret.append(numpy_content)
-        if parser_type & ParserTypeEnum.EIGEN:
-            eigen_content = walk_model(ParserTypeEnum.EIGEN, type_walker, start_node)
-            ret.append(eigen_content)
-        if parser_type & ParserTypeEnum.LATEX:
-            tex_content = walk_model(ParserTypeEnum.LATEX, type_walker, start_node)
-            ret.append(tex_content)
-        if parser_type & ParserTypeEnum.MATHJAX:
-            tex_content = walk_model(ParserTypeEnum.MATHJAX, type_walker, start_node)
-            ret.append(tex_content)
-    except FailedParse as e:
-        ret = LaMsg.getInstance().get_parse_error(e)
-    except FailedCut as e:
-        ret = "FailedCut: {}".format(str(e))
-    except AssertionError as e:
-        ret = "{}".format(e.args[0])
+        ret = get_compiled_outputs(la_content, parser_type, use_cache=use_cache)
     except Exception as e:
-        ret = "Exception: {}".format(str(e))
+        ret = get_compile_error_msg(e)
     except:
         ret = str(sys.exc_info()[0])
     finally:
         return ret
 
 
-def compile_la_file(la_file, parser_type=ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN | ParserTypeEnum.LATEX):
+# code objects of the generated numpy modules: hash of (function name, source) -> code object
+_code_objects = {}
+_code_objects_lock = threading.Lock()
+
+
+def get_code_object(la_content, func_name=None, use_cache=True, session=None, disk_cache=False):
+    """
+    :param use_cache: keep the code object in memory
+    :param disk_cache: also use the compile cache on disk, for the generated source and the marshalled code object;
+    off by default so that loading kernels never touches the filesystem
+    :return: the code object of the numpy module generated for la_content, from memory or the compile cache
+    when possible
+    """
+    if session is not None and not session.has_default_options():
+        use_cache = False
+    disk_cache = disk_cache and use_cache
+    key = hashlib.sha256("{}\n{}".format(func_name, la_content).encode()).hexdigest()
+    code = None
+    if use_cache:
+        with _code_objects_lock:
+            code = _code_objects.get(key)
+        if code is None and disk_cache:
+            code = get_compile_cache().get_code(la_content, func_name)
+    if code is None:
+        source = get_compiled_outputs(la_content, ParserTypeEnum.NUMPY, func_name, disk_cache, session)[0]
+        code = compile(source, "<iheartla {}>".format(func_name if func_name else 'myExpression'), 'exec')
+        if disk_cache:
+            get_compile_cache().put_code(la_content, code, func_name)
+    if use_cache:
+        with _code_objects_lock:
+            _code_objects[key] = code
+    return code
+
+
+def compile_la_to_function(la_content, func_name=None, use_cache=True, session=None, disk_cache=False):
+    """
+    Build the numpy function in process: no file is written and no module is imported.
+    :param func_name: name of the generated function, myExpression by default
+    :param disk_cache: also read and write the compile cache on disk, see get_code_object
+    :return: the function and its result class
+    """
+    if func_name is None:
+        func_name = 'myExpression'
+    code = get_code_object(la_content, func_name, use_cache, session, disk_cache)
+    namespace = {'__name__': 'iheartla_{}'.format(func_name)}
+    exec(code, namespace)
+    return namespace[func_name], namespace.get("{}ResultType".format(func_name))
+
+
+def compile_la_file(la_file, parser_type=ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN | ParserTypeEnum.LATEX, use_cache=True):
     """
     used for command line
     """
+    err_msg = save_la_file_outputs(la_file, parser_type, use_cache)
+    if err_msg is not None:
+        print(err_msg)
+
+
+def save_la_file_outputs(la_file, parser_type=ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN | ParserTypeEnum.LATEX, use_cache=True):
+    """
+    :return: None if the outputs were written next to la_file, the error message otherwise
+    """
+    err_msg = None
     content = read_from_file(la_file)
     base_name = get_file_name(la_file)
     # print("head:", head, ", name:", name, "parser_type", parser_type, ", base_name:", base_name)
-    parser = get_default_parser()
+    # mathjax is not written to disk
+    parser_type = parser_type & (ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN | ParserTypeEnum.LATEX | ParserTypeEnum.NUMBA)
     try:
-        model = parser.parse(content, parseinfo=True)
-        type_walker, start_node = parse_ir_node(content, model)
-        if parser_type & ParserTypeEnum.NUMPY:
-            numpy_file = Path(la_file).with_suffix(".py")
-            numpy_content = walk_model(ParserTypeEnum.NUMPY, type_walker, start_node, func_name=base_name)
-            save_to_file(numpy_content, numpy_file)
-        if parser_type & ParserTypeEnum.EIGEN:
-            eigen_file = Path(la_file).with_suffix(".cpp")
-            eigen_content = walk_model(ParserTypeEnum.EIGEN, type_walker, start_node, func_name=base_name)
-            save_to_file(eigen_content, eigen_file)
-        if parser_type & ParserTypeEnum.LATEX:
-            tex_file = Path(la_file).with_suffix(".tex")
-            tex_content = walk_model(ParserTypeEnum.LATEX, type_walker, start_node, func_name=base_name)
-            save_to_file(tex_content, tex_file)
-    except FailedParse as e:
-        print(LaMsg.getInstance().get_parse_error(e))
-    except FailedCut as e:
-        print("FailedCut: {}".format(str(e)))
-    except AssertionError as e:
-        print("{}".format(e.args[0]))
+        ret = get_compiled_outputs(content, parser_type, func_name=base_name, use_cache=use_cache)
+        write_la_file_outputs(la_file, parser_type, ret)
     except Exception as e:
-        print("Exception: {}".format(str(e)))
+        err_msg = get_compile_error_msg(e)
     except:
-        print(str(sys.exc_info()[0]))
+        err_msg = str(sys.exc_info()[0])
+    return err_msg
+
+
+def write_la_file_outputs(la_file, parser_type, outputs):
+    """
+    :param outputs: the generated contents in the order numpy, eigen, latex, numba (only for the types in parser_type)
+    """
+    suffix_list = [(ParserTypeEnum.NUMPY, ".py"), (ParserTypeEnum.EIGEN, ".cpp"), (ParserTypeEnum.LATEX, ".tex"),
+                   (ParserTypeEnum.NUMBA, "_numba.py")]
+    index = 0
+    for cur_type, suffix in suffix_list:
+        if parser_type & cur_type:
+            save_to_file(outputs[index], "{}{}".format(Path(la_file).with_suffix(''), suffix))
+            index += 1
+
+
+def profile_la_content(la_content, parser_type=ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN | ParserTypeEnum.LATEX,
+                       func_name=None, trace_memory=True, session=None):
+    """
+    compile without the cache and time each phase: init_parse, pre_walk, specialization, second_parse,
+    type_walk and one codegen_* phase per backend
+    :return: (outputs or None, report), the report holds the error message when the compilation failed
+    """
+    if session is None:
+        session = get_default_session()
+    outputs = None
+    err_msg = None
+    profiler = CompileProfiler(trace_memory)
+    session.profiler = profiler
+    try:
+        outputs = session.compile(la_content, parser_type, func_name)
+    except Exception as e:
+        err_msg = get_compile_error_msg(e)
+    finally:
+        session.profiler = None
+        profiler.stop()
+    report = profiler.get_report()
+    report["error"] = err_msg
+    return outputs, report
+
+
+def profile_la_file(la_file, parser_type=ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN | ParserTypeEnum.LATEX):
+    """
+    used for command line (--profile), the outputs are written next to la_file
+    :return: the report of profile_la_content with the file name
+    """
+    # mathjax is not written to disk
+    parser_type = parser_type & (ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN | ParserTypeEnum.LATEX | ParserTypeEnum.NUMBA)
+    outputs, report = profile_la_content(read_from_file(la_file), parser_type, get_file_name(la_file))
+    if outputs is not None:
+        write_la_file_outputs(la_file, parser_type, outputs)
+    report["file"] = str(la_file)
+    return report
+
+
+def init_compile_worker():
+    """
+    warm the parsers once per worker process, they are reused for every file the worker gets
+    """
+    create_parser()
+
+
+def compile_la_files(la_files, parser_type=ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN | ParserTypeEnum.LATEX, jobs=1, use_cache=True):
+    """
+    used for command line, compile a batch of files over a process pool
+    :param jobs: number of worker processes, 0 uses all the cores
+    :return: list of (la_file, error message or None), in the same order as la_files
+    """
+    la_files = list(la_files)
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(la_files))
+    if jobs <= 1:
+        return [(la_file, save_la_file_outputs(la_file, parser_type, use_cache)) for la_file in la_files]
+    from concurrent.futures import ProcessPoolExecutor
+    func = functools.partial(save_la_file_outputs, parser_type=parser_type, use_cache=use_cache)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_compile_worker) as executor:
+        err_list = list(executor.map(func, la_files))
+    return list(zip(la_files, err_list))
 
 
 def parse_la(content, parser_type):
     """
     used for testing
     """
-    _parser_manager.set_test_mode()
-    parser = get_default_parser()
-    model = parser.parse(content, parseinfo=True)
-    type_walker, node_info = parse_ir_node(content, model)
+    session = get_default_session()
+    session.parser_manager.set_test_mode()
+    type_walker, node_info = session.parse_content(content)
     res = walk_model(parser_type, type_walker, node_info)
     return res
 
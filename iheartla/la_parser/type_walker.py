@@ -72,6 +72,8 @@ def get_parse_info_buffer(parse_info):
 class TypeWalker(NodeWalker):
     def __init__(self):
         super().__init__()
+        # NodeWalker caches bound walk methods on the class, keep them per instance instead
+        self._walker_cache = {}
         self.symtable = {}
         self.tmp_symtable = {}
         self.parameters = []
@@ -81,6 +83,8 @@ class TypeWalker(NodeWalker):
         self.dim_dict = {}       # parameter used. h:w_i
         self.ids_dict = {}    # identifiers with subscripts
         self.unofficial_method = False
+        self.has_optimization = False  # min, max, argmin, argmax
+        self.has_integral = False
         self.is_param_block = False  # where or given block
         self.visualizer = LaVisualizer()
         self.logger = LaLogger.getInstance().get_logger(LoggerTypeEnum.DEFAULT)
@@ -132,6 +136,8 @@ class TypeWalker(NodeWalker):
         self.ids_dict.clear()
         self.ret_symbol = None
         self.unofficial_method = False
+        self.has_optimization = False
+        self.has_integral = False
         self.sum_subs.clear()
         self.sum_sym_list.clear()
         self.lhs_subs.clear()
@@ -968,6 +974,9 @@ class TypeWalker(NodeWalker):
         assert exp_node.la_type.is_scalar(), self.get_err_msg_info(exp_node.parse_info, "Objective function must return a scalar")
         opt_node = OptimizeNode(opt_type, cond_list, exp_node, base_node, base_type, parse_info=node.parseinfo)
         opt_node.la_type = ScalarType()
+        if opt_type == OptimizeType.OptimizeArgmin or opt_type == OptimizeType.OptimizeArgmax:
+            opt_node.la_type = base_type.la_type
+        self.has_optimization = True
         node_info = NodeInfo(opt_node.la_type, ir=opt_node)
         return node_info
 
@@ -996,6 +1005,7 @@ class TypeWalker(NodeWalker):
         node_info = NodeInfo(ScalarType())
         node_info.ir = int_node
         int_node.la_type = node_info.la_type
+        self.has_integral = True
         #
         del self.symtable[base_id]
         return node_info
@@ -0,0 +1,167 @@
+from .la_helper import *
+from .la_logger import *
+from appdirs import *
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import importlib.util
+import marshal
+import pickle
+import threading
+import os
+
+_compiler_version = None
+
+
+def get_compiler_version():
+    """
+    :return: the package version plus a fingerprint of the compiler sources, so that
+    cached outputs are invalidated whenever the grammar, a backend or the default options change
+    """
+    global _compiler_version
+    if _compiler_version is None:
+        package_dir = Path(__file__).resolve().parent.parent
+        md5 = hashlib.md5(COMPILER_VERSION.encode())
+        for sub_dir in ['la_grammar', 'la_parser']:
+            for f in sorted((package_dir / sub_dir).glob('*.py')):
+                md5.update(f.read_bytes())
+        # DEFAULT_OPT_LEVEL and the other defaults of the cached outputs
+        md5.update((package_dir / 'la_tools' / 'la_helper.py').read_bytes())
+        _compiler_version = "{}-{}".format(COMPILER_VERSION, md5.hexdigest())
+    return _compiler_version
+
+
+class CompileCache(object):
+    """
+    Persistent cache for compiled outputs, keyed by the source text, the ParserTypeEnum mask,
+    the function name and the compiler version. Entries are evicted in LRU order.
+    """
+    def __init__(self, cache_dir=None, max_entries=512, max_bytes=64 * 1024 * 1024):
+        if cache_dir is None:
+            # sibling of the parser cache dir used by ParserFileManager
+            cache_dir = os.path.join(user_cache_dir(), "iheartla", "compiled")
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.logger = LaLogger.getInstance().get_logger(LoggerTypeEnum.DEFAULT)
+        self.suffix = ".pickle"
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.index = OrderedDict()  # key -> file size, least recently used first
+        self.total_bytes = 0
+        self.lock = threading.RLock()  # the index is shared by the threads of a process
+        self.init_cache()
+
+    def init_cache(self):
+        dir_path = Path(self.cache_dir)
+        if not dir_path.exists():
+            dir_path.mkdir(parents=True)
+        entries = []
+        for f in dir_path.glob("*{}".format(self.suffix)):
+            stat = f.stat()
+            entries.append((stat.st_mtime, f.stem, stat.st_size))
+        entries.sort()
+        self.index.clear()
+        self.total_bytes = 0
+        for mtime, key, size in entries:
+            self.index[key] = size
+            self.total_bytes += size
+        self.check_size()
+
+    def get_key(self, content, parser_type, func_name=None):
+        key_str = "\n".join([get_compiler_version(), str(int(parser_type)), str(func_name), content])
+        return hashlib.sha256(key_str.encode()).hexdigest()
+
+    def get_file_name(self, key):
+        return os.path.join(self.cache_dir, "{}{}".format(key, self.suffix))
+
+    def get_code_key(self, content, func_name=None):
+        # marshal data is only valid for the interpreter that wrote it
+        key_str = "\n".join([get_compiler_version(), "code", importlib.util.MAGIC_NUMBER.hex(), str(func_name), content])
+        return hashlib.sha256(key_str.encode()).hexdigest()
+
+    def get(self, content, parser_type, func_name=None):
+        return self.load(self.get_key(content, parser_type, func_name))
+
+    def put(self, content, parser_type, value, func_name=None):
+        self.store(self.get_key(content, parser_type, func_name), value)
+
+    def get_code(self, content, func_name=None):
+        """
+        :return: the code object of the generated numpy module
+        """
+        data = self.load(self.get_code_key(content, func_name))
+        if data is None:
+            return None
+        return marshal.loads(data)
+
+    def put_code(self, content, code, func_name=None):
+        self.store(self.get_code_key(content, func_name), marshal.dumps(code))
+
+    def load(self, key):
+        with self.lock:
+            if key in self.index:
+                file_name = self.get_file_name(key)
+                try:
+                    with open(file_name, 'rb') as f:
+                        value = pickle.load(f)
+                    os.utime(file_name)  # persist the LRU order
+                    self.index.move_to_end(key)
+                    self.hits += 1
+                    return value
+                except Exception as e:
+                    self.logger.debug("CompileCache, invalid entry {}: {}".format(key, e))
+                    self.remove(key)
+            self.misses += 1
+        return None
+
+    def store(self, key, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        try:
+            # write to a temp file first so that a concurrent reader never sees a partial entry
+            file_name = self.get_file_name(key)
+            tmp_name = "{}.{}.tmp".format(file_name, os.getpid())
+            with open(tmp_name, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_name, file_name)
+        except IOError as e:
+            print("IO Error!:{}".format(e))
+            return
+        with self.lock:
+            if key in self.index:
+                self.total_bytes -= self.index[key]
+            self.index[key] = len(data)
+            self.index.move_to_end(key)
+            self.total_bytes += len(data)
+            self.check_size()
+
+    def remove(self, key):
+        with self.lock:
+            if key in self.index:
+                self.total_bytes -= self.index.pop(key)
+            try:
+                os.remove(self.get_file_name(key))
+            except OSError:
+                pass
+
+    def check_size(self):
+        with self.lock:
+            while len(self.index) > 0 and (len(self.index) > self.max_entries or self.total_bytes > self.max_bytes):
+                key = next(iter(self.index))
+                self.remove(key)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.index.keys()):
+                self.remove(key)
+
+    def get_stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.index),
+                "bytes": self.total_bytes}
@@ -1,5 +1,4 @@
-from enum import Enum, IntFlag
-from tatsu._version import __version__
+from enum import Enum, IntEnum, IntFlag
 import sys
 import keyword
 import regex as re
@@ -7,6 +6,7 @@ import regex as re
 
 DEBUG_MODE = False
 DEBUG_PARSER = False  # used for new grammer files
+COMPILER_VERSION = "0.0.1"
 class ParserTypeEnum(IntFlag):
     INVALID = 0
     DEFAULT = 7
@@ -20,6 +20,33 @@ class ParserTypeEnum(IntFlag):
     ARMADILLO = 64
     TENSORFLOW = 128
     MATHJAX = 256
+    NUMBA = 512  # numpy with numba kernels
+
+
+class OptLevelEnum(IntEnum):
+    O0 = 0  # the IR as written
+    O1 = 1  # constant folding
+    O2 = 2  # constant folding, common subexpressions and loop invariants
+
+
+DEFAULT_OPT_LEVEL = OptLevelEnum.O2
+
+
+class ParallelModeEnum(IntEnum):
+    SERIAL = 0
+    OPENMP = 1  # OpenMP loops, the partial sums are added in the order the threads finish
+    OPENMP_DETERMINISTIC = 2  # OpenMP loops, the same result for any number of threads
+
+
+DEFAULT_PARALLEL_MODE = ParallelModeEnum.SERIAL
+
+
+class SequenceStorageEnum(IntEnum):
+    VECTOR = 0  # std::vector with one Eigen object per element
+    CONTIGUOUS = 1  # dense elements stored side by side in one matrix, a sequence of m×n matrices is m×(n·N)
+
+
+DEFAULT_SEQUENCE_STORAGE = SequenceStorageEnum.VECTOR
 
 
 def is_keyword(name, parser_type=ParserTypeEnum.DEFAULT):
@@ -38,6 +65,7 @@ def is_keyword(name, parser_type=ParserTypeEnum.DEFAULT):
 
 
 def is_new_tatsu_version():
+    from tatsu._version import __version__
     return __version__ >= '5.0.0'
 
 
@@ -1,5 +1,5 @@
 from enum import Enum
-from tatsu.util import re
+import regex as re
 
 
 class LaMsgTypeEnum(Enum):
@@ -0,0 +1,73 @@
+import time
+import tracemalloc
+
+
+class CompileProfiler(object):
+    """
+    Times the consecutive phases of a compilation and records the peak memory allocated in each of them.
+    begin() closes the current phase and opens the next one, end() closes the last one.
+    """
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.phases = []
+        self.cur_phase = None
+        self.cur_start = 0
+        self.cur_memory = 0
+        self.started_tracing = False
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    def begin(self, name):
+        self.end()
+        self.cur_phase = name
+        if self.trace_memory:
+            self.reset_peak()
+            self.cur_memory = tracemalloc.get_traced_memory()[0]
+        self.cur_start = time.perf_counter()
+
+    def reset_peak(self):
+        """
+        Start the peak of get_traced_memory() from the current memory. tracemalloc.reset_peak is only in Python 3.9+,
+        before that the tracing is restarted when the profiler started it, otherwise the peak is the one since the
+        tracing started
+        """
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        elif self.started_tracing:
+            tracemalloc.stop()
+            tracemalloc.start()
+
+    def end(self):
+        if self.cur_phase is None:
+            return
+        elapsed = time.perf_counter() - self.cur_start
+        phase = {"name": self.cur_phase, "time_ms": elapsed * 1000}
+        if self.trace_memory:
+            phase["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1] - self.cur_memory
+        self.phases.append(phase)
+        self.cur_phase = None
+
+    def fold(self, start, name):
+        """
+        Close the current phase and replace the phases recorded from index start on by a single phase, e.g. an
+        attempt that was abandoned
+        """
+        self.end()
+        folded = self.phases[start:]
+        if len(folded) == 0:
+            return
+        phase = {"name": name, "time_ms": sum([cur["time_ms"] for cur in folded])}
+        if self.trace_memory:
+            phase["peak_memory_bytes"] = max([cur["peak_memory_bytes"] for cur in folded])
+        self.phases[start:] = [phase]
+
+    def stop(self):
+        self.end()
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def get_report(self):
+        return {"phases": list(self.phases),
+                "total_ms": sum([phase["time_ms"] for phase in self.phases])}
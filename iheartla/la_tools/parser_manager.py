@@ -1,11 +1,8 @@
 from .la_helper import *
 from .la_logger import *
-if not DEBUG_PARSER:
-    from ..la_local_parsers.init_parser import grammarinitParser, grammarinitModelBuilderSemantics
-    from ..la_local_parsers.default_parser import grammardefaultParser, grammardefaultModelBuilderSemantics
 import pickle
-import tatsu
 import time
+from collections import OrderedDict
 from appdirs import *
 from os import listdir
 from pathlib import Path
@@ -19,13 +16,19 @@ from datetime import datetime
 
 
 class ParserManager(object):
-    def __init__(self, grammar_dir):
+    def __init__(self, grammar_dir, parser_file_manager=None):
+        self.grammar_dir = grammar_dir
         if DEBUG_PARSER:
-            self.parser_file_manager = ParserFileManager(grammar_dir)
+            if parser_file_manager is None:
+                parser_file_manager = ParserFileManager(grammar_dir)
+            self.parser_file_manager = parser_file_manager
             self.cache_dir = self.parser_file_manager.cache_dir
             self.grammar_dir = self.parser_file_manager.grammar_dir
             self.save_threads = self.parser_file_manager.save_threads
         else:
+            # the generated parsers are large, only load them once a manager is needed
+            from ..la_local_parsers.init_parser import grammarinitParser, grammarinitModelBuilderSemantics
+            from ..la_local_parsers.default_parser import grammardefaultParser, grammardefaultModelBuilderSemantics
             self.init_parser = grammarinitParser(semantics=grammarinitModelBuilderSemantics())
             self.default_parser = grammardefaultParser(semantics=grammardefaultModelBuilderSemantics())
 
@@ -38,6 +41,15 @@ class ParserManager(object):
             self.modify_default_parser(extra_dict)
             return self.default_parser
 
+    def new_session_manager(self):
+        """
+        :return: a manager with its own parser instances (the default parser carries per-compile
+        state), sharing the parser files in debug mode
+        """
+        if DEBUG_PARSER:
+            return ParserManager(self.grammar_dir, self.parser_file_manager)
+        return ParserManager(self.grammar_dir)
+
     def set_test_mode(self):
         if DEBUG_PARSER:
             self.parser_file_manager.set_test_mode()
@@ -47,47 +59,55 @@ class ParserManager(object):
             self.parser_file_manager.reload()
 
     def modify_default_parser(self, extra_dict):
-        self.default_parser.new_id_list = []
-        self.default_parser.new_func_list = []
-        self.default_parser.builtin_list = []
-        self.default_parser.const_e = False
-        if "ids" in extra_dict:
-            self.default_parser.new_id_list = extra_dict["ids"]
-        if 'funcs' in extra_dict:
-            self.default_parser.new_func_list = extra_dict["funcs"]
-        if 'pkg' in extra_dict:
-            funcs_list = extra_dict["pkg"]
-            if 'e' in funcs_list:
-                self.default_parser.const_e = True
-                funcs_list.remove('e')
-            self.default_parser.builtin_list = funcs_list
+        """
+        Specialize the default parser for the symbols of the current program. The generated rules
+        (identifier_alone, func_id, builtin_operators, constant, KEYWORDS) consult these token tables
+        at parse time, so a new symbol set is a table update instead of a new parser module.
+        :param extra_dict: 'ids': multi-letter identifiers, 'funcs': local functions, 'pkg': imported builtins
+        """
+        self.default_parser.new_id_list = extra_dict.get('ids', [])
+        self.default_parser.new_func_list = extra_dict.get('funcs', [])
+        funcs_list = extra_dict.get('pkg', [])
+        self.default_parser.const_e = 'e' in funcs_list
+        self.default_parser.builtin_list = [name for name in funcs_list if name != 'e']
 
 
 class ParserFileManager(object):
-    def __init__(self, grammar_dir):
+    """
+    Cache of the parsers compiled from edited grammars (DEBUG_PARSER). The parser files live in the user's
+    cache dir, an in-memory LRU index of them is persisted as a single manifest, and the parser modules
+    are only imported on first lookup.
+    """
+    def __init__(self, grammar_dir, cache_dir=None, max_size=12, max_bytes=256 * 1024 * 1024):
         self.grammar_dir = Path(grammar_dir)
-        self.max_size = 12  # 10 + 2 default
+        self.max_size = max_size  # 10 + 2 default
+        self.max_bytes = max_bytes
         self.logger = LaLogger.getInstance().get_logger(LoggerTypeEnum.DEFAULT)
-        self.parser_dict = {}
+        self.parser_dict = {}  # loaded parsers
+        self.index = OrderedDict()  # hash_value -> (file name, size), least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()  # parsers are saved from background threads
         self.prefix = "parser"
         self.module_dir = "iheartla"
+        self.manifest_name = "manifest.pickle"
         self.default_hash_value = hashlib.md5("default".encode()).hexdigest()
         self.default_parsers_dict = {hashlib.md5("init".encode()).hexdigest(): 0, self.default_hash_value: 0}
         for f in (self.grammar_dir.parent / 'la_local_parsers').glob('parser*.py'):
             name, hash_value, t = self.separate_parser_file(f.name)
             if hash_value in self.default_parsers_dict:
                 self.default_parsers_dict[hash_value] = t
-                if hash_value == self.default_hash_value:
-                    default_file = open(grammar_dir / f)
-                    self.default_parser_content = default_file.read()
-                    default_file.close()
         self.save_threads = []
-        # create the user's cache directory (pickle)
-        self.cache_dir = os.path.join(user_cache_dir(), self.module_dir)
-        # init the cache and load the default parsers
+        # create the user's cache directory
+        if cache_dir is None:
+            cache_dir = os.path.join(user_cache_dir(), self.module_dir)
+        self.cache_dir = cache_dir
+        # init the cache and load the index of the parsers
         self.init_cache()
         self.load_parsers()
-    
+
     def reload(self):
         self.parser_dict = {}
         self.init_cache()
@@ -126,262 +146,193 @@ class ParserFileManager(object):
                     shutil.copy(f, dir_path)
 
     def valid_parser_file(self, parser_file):
-        return self.prefix in parser_file and '.py' in parser_file and '_' in parser_file
+        return parser_file.startswith(self.prefix) and parser_file.endswith('.py') and '_' in parser_file
 
     def init_cache(self):
-        # cache dir may not exist yet
-        if not Path(user_cache_dir()).exists():
-            Path(user_cache_dir()).mkdir()
-        # real dir
+        # real dir, the user's cache dir may not exist yet
         dir_path = Path(self.cache_dir)
         if not dir_path.exists():
-            dir_path.mkdir()
+            dir_path.mkdir(parents=True)
         self.merge_default_parsers()
-        # self.cache_file = Path(self.cache_dir + '/parsers.pickle')
 
     def clean_parsers(self):
         dir_path = Path(self.cache_dir)
         if dir_path.exists():
             shutil.rmtree(dir_path)
             dir_path.mkdir()
+        with self.lock:
+            self.parser_dict = {}
+            self.index.clear()
+            self.total_bytes = 0
 
-    def load_from_pickle(self):
-        # Load parsers when program launches
-        if self.cache_file.exists():
+    def load_parsers(self):
+        """
+        Build the index from the manifest, or from one scan of the cache dir when the manifest is missing
+        or out of date. No parser module is imported here.
+        """
+        with self.lock:
+            self.index.clear()
+            self.total_bytes = 0
+            file_list = [f for f in listdir(self.cache_dir) if self.valid_parser_file(f)]
+            manifest = self.load_manifest()
+            if manifest is not None and sorted(name for name, size in manifest.values()) == sorted(file_list):
+                self.index.update(manifest)
+            else:
+                entries = []
+                for f in file_list:
+                    name, hash_value, t = self.separate_parser_file(f)
+                    stat = os.stat(os.path.join(self.cache_dir, f))
+                    entries.append((stat.st_mtime, hash_value, f, stat.st_size))
+                entries.sort()
+                for mtime, hash_value, f, size in entries:
+                    self.index[hash_value] = (f, size)
+            for name, size in self.index.values():
+                self.total_bytes += size
+            self.check_parser_cnt()
+            self.save_manifest()
+        self.logger.debug("After loading, self.index:{}".format(self.index))
+        if len(self.index) > 1:
+            print("{} parsers in cache".format(len(self.index)))
+        else:
+            print("{} parser in cache".format(len(self.index)))
+
+    def load_manifest(self):
+        manifest_file = os.path.join(self.cache_dir, self.manifest_name)
+        if os.path.exists(manifest_file):
             try:
-                with open(self.cache_file, 'rb') as f:
-                    self.parser_dict = pickle.load(f)
+                with open(manifest_file, 'rb') as f:
+                    return pickle.load(f)
             except Exception as e:
-                print("IO error:{}".format(e))
+                self.logger.debug("invalid parser manifest:{}".format(e))
+        return None
 
-    def load_parsers(self):
-        for f in listdir(self.cache_dir):
-            if self.valid_parser_file(f):
-                name, hash_value, t = self.separate_parser_file(f)
-                module_name = "{}.{}".format(self.module_dir, name)
-                path_to_file = os.path.join(self.cache_dir, "{}.py".format(name))
-                spec = importlib.util.spec_from_file_location(module_name, path_to_file)
-                module = importlib.util.module_from_spec(spec)
-                spec.loader.exec_module(module)
-                parser_a = getattr(module, "grammar{}Parser".format(hash_value))
-                parser_semantic = getattr(module, "grammar{}ModelBuilderSemantics".format(hash_value))
-                parser = parser_a(semantics=parser_semantic())
-                self.parser_dict[hash_value] = parser
-        self.logger.debug("After loading, self.parser_dict:{}".format(self.parser_dict))
-        if len(self.parser_dict) > 1:
-            print("{} parsers loaded".format(len(self.parser_dict)))
-        else:
-            print("{} parser loaded".format(len(self.parser_dict)))
+    def save_manifest(self):
+        manifest_file = os.path.join(self.cache_dir, self.manifest_name)
+        tmp_file = "{}.{}.tmp".format(manifest_file, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(self.index, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, manifest_file)
+        except Exception as e:
+            print("IO error:{}".format(e))
+
+    def load_parser_module(self, hash_value, parser_file):
+        name = parser_file.split('.')[0]
+        module_name = "{}.{}".format(self.module_dir, name)
+        path_to_file = os.path.join(self.cache_dir, parser_file)
+        spec = importlib.util.spec_from_file_location(module_name, path_to_file)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        parser_a = getattr(module, "grammar{}Parser".format(hash_value))
+        parser_semantic = getattr(module, "grammar{}ModelBuilderSemantics".format(hash_value))
+        return parser_a(semantics=parser_semantic())
+
+    def lookup_parser(self, hash_value):
+        """
+        :return: the cached parser or None, its module is imported on the first lookup
+        """
+        with self.lock:
+            if hash_value in self.index:
+                parser = self.parser_dict.get(hash_value)
+                if parser is None:
+                    parser_file = self.index[hash_value][0]
+                    try:
+                        parser = self.load_parser_module(hash_value, parser_file)
+                    except Exception as e:
+                        self.logger.debug("failed to load {}:{}".format(parser_file, e))
+                        self.remove_parser(hash_value)
+                        self.save_manifest()
+                        return None
+                    self.parser_dict[hash_value] = parser
+                if next(reversed(self.index)) != hash_value:
+                    self.index.move_to_end(hash_value)
+                    self.save_manifest()
+                self.hits += 1
+                return parser
+            return self.parser_dict.get(hash_value)  # compiled, still being saved
 
     def get_parser(self, key, grammar, extra_dict={}):
         hash_value = hashlib.md5(key.encode()).hexdigest()
-        if hash_value in self.parser_dict:
-            return self.parser_dict[hash_value]
-        if not DEBUG_PARSER:
-            # create new parser from default parser
-            rule_content = self.gen_parser_code(hash_value, extra_dict)
-            module_name = "{}_{}_{}".format(self.prefix, hash_value, datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
-            new_file_name = os.path.join(self.cache_dir, "{}.py".format(module_name))
-            save_to_file(rule_content, new_file_name)
-            # load new parser
-            spec = importlib.util.spec_from_file_location(module_name, new_file_name)
-            module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(module)
-            parser_a = getattr(module, "grammar{}Parser".format(hash_value))
-            parser_semantic = getattr(module, "grammar{}ModelBuilderSemantics".format(hash_value))
-            parser = parser_a(semantics=parser_semantic())
-            self.parser_dict[hash_value] = parser
-            return parser
-        else:
-            # os.path.dirname(filename) is used as the prefix for relative #include commands
-            # It just needs to be a path inside the directory where all the grammar files are.
-            parser = tatsu.compile(grammar, asmodel=True)
-            self.parser_dict[hash_value] = parser
-            try:
-                # save to file asynchronously
-                print("hash_value is:{}, grammar:{}".format(hash_value, grammar))
-                save_thread = threading.Thread(target=self.save_grammar, args=(hash_value, grammar,))
-                save_thread.start()
-                self.save_threads.append( save_thread )
-            except:
-                self.save_grammar(hash_value, grammar)
-            # self.save_dict()
+        parser = self.lookup_parser(hash_value)
+        if parser is not None:
             return parser
+        self.misses += 1
+        # os.path.dirname(filename) is used as the prefix for relative #include commands
+        # It just needs to be a path inside the directory where all the grammar files are.
+        import tatsu
+        parser = tatsu.compile(grammar, asmodel=True)
+        self.parser_dict[hash_value] = parser
+        try:
+            # save to file asynchronously
+            print("hash_value is:{}, grammar:{}".format(hash_value, grammar))
+            save_thread = threading.Thread(target=self.save_grammar, args=(hash_value, grammar,))
+            save_thread.start()
+            self.save_threads.append( save_thread )
+        except:
+            self.save_grammar(hash_value, grammar)
+        return parser
 
     def save_grammar(self, hash_value, grammar):
-        self.check_parser_cnt()
+        import tatsu
         code = tatsu.to_python_sourcecode(grammar, name="grammar{}".format(hash_value), filename=os.path.join('la_grammar', 'here'))
         code_model = tatsu.to_python_model(grammar, name="grammar{}".format(hash_value), filename=os.path.join('la_grammar', 'here'))
         code_model = code_model.replace("from __future__ import print_function, division, absolute_import, unicode_literals", "")
         code += code_model
-        save_to_file(code, os.path.join(self.cache_dir, "{}_{}_{}.py".format(self.prefix, hash_value, datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))))
+        self.save_parser_code(hash_value, code)
+
+    def save_parser_code(self, hash_value, code):
+        parser_file = "{}_{}_{}.py".format(self.prefix, hash_value, datetime.now().strftime("%Y-%m-%d-%H-%M-%S"))
+        with self.lock:
+            if hash_value in self.index:
+                self.remove_parser(hash_value, keep_loaded=True)
+            save_to_file(code, os.path.join(self.cache_dir, parser_file))
+            self.index[hash_value] = (parser_file, len(code.encode()))
+            self.total_bytes += self.index[hash_value][1]
+            self.check_parser_cnt()
+            self.save_manifest()
+
+    def remove_parser(self, hash_value, keep_loaded=False):
+        with self.lock:
+            parser_file, size = self.index.pop(hash_value)
+            self.total_bytes -= size
+            if not keep_loaded and hash_value in self.parser_dict:
+                del self.parser_dict[hash_value]
+            try:
+                os.remove(os.path.join(self.cache_dir, parser_file))
+            except OSError:
+                pass
 
     def check_parser_cnt(self):
-        parser_size = len(self.parser_dict)
-        self.logger.debug("check_parser_cnt, self.parser_dict:{}, max:{}".format(self.parser_dict, self.max_size))
-        while parser_size > self.max_size:
-            earliest_time = time.time()
-            earliest_file = None
-            earliest_hash = None
-            for f in listdir(self.cache_dir):
-                if self.valid_parser_file(f):
-                    name, hash_value, t = self.separate_parser_file(f)
+        """
+        evict the least recently used parsers (never the default ones) until the budget is met
+        """
+        with self.lock:
+            while len(self.index) > self.max_size or self.total_bytes > self.max_bytes:
+                earliest_hash = None
+                for hash_value in self.index:
                     if hash_value not in self.default_parsers_dict:
-                        cur_time = os.path.getmtime(os.path.join(self.cache_dir, f))
-                        if cur_time < earliest_time:
-                            earliest_time = cur_time
-                            earliest_file = f
-                            earliest_hash = hash_value
-            if earliest_file is not None and earliest_hash in self.parser_dict:
-                del self.parser_dict[earliest_hash]
-                os.remove(os.path.join(self.cache_dir, earliest_file))
-                parser_size = len(self.parser_dict)
-            else:
-                # avoid dead loop
-                break
-        self.logger.debug("check_parser_cnt, self.parser_dict:{}".format(self.parser_dict))
-
-    def save_dict(self):
-        self.logger.debug("self.parser_dict:{}".format(self.parser_dict))
-        try:
-            with open(self.cache_file, 'wb') as f:
-                pickle.dump(self.parser_dict, f, pickle.HIGHEST_PROTOCOL)
-        except Exception as e:
-            print("IO error:{}".format(e))
+                        earliest_hash = hash_value
+                        break
+                if earliest_hash is None:
+                    # avoid dead loop
+                    break
+                self.remove_parser(earliest_hash)
+                self.evictions += 1
+        self.logger.debug("check_parser_cnt, self.index:{}".format(self.index))
 
-    def gen_parser_code(self, hash_value, extra_dict):
-        cur_content = self.default_parser_content.replace(self.default_hash_value, hash_value)
-        if "ids" in extra_dict:
-            id_list = extra_dict["ids"]
-            id_alone_original_rule = r"""class IdentifierAlone(ModelBase):
-    id = None
-    value = None"""
-            id_alone_cur_rule = r"""class IdentifierAlone(ModelBase):
-    const = None
-    id = None
-    value = None"""
-            cur_content = cur_content.replace(id_alone_original_rule, id_alone_cur_rule)
-            id_original_rule = r"""@tatsumasu('IdentifierAlone')
-    def _identifier_alone_(self):  # noqa
-        with self._ifnot():
-            self._KEYWORDS_()
-        with self._group():
-            with self._choice():
-                with self._option():
-                    self._pattern('[A-Za-z\\p{Ll}\\p{Lu}\\p{Lo}]\\p{M}*')
-                    self.name_last_node('value')
-                with self._option():
-                    self._token('`')
-                    self._pattern('[^`]*')
-                    self.name_last_node('id')
-                    self._token('`')
-                self._error('no available options')
-        self.ast._define(
-            ['id', 'value'],
-            []
-        )"""
-            choice_list = [f"""
-                        with self._option():
-                            self._pattern('{item}')""".format(item)[1:] for item in id_list]
-            option_list = [f"""
-                                        with self._option():
-                                            self._pattern('{item}')""".format(item)[1:] for item in id_list]
-            id_rule = """@tatsumasu('IdentifierAlone')
-    def _identifier_alone_(self):  # noqa
-        with self._choice():
-            with self._option():
-                with self._group():
-                    with self._choice():""" + '\n' + '\n'.join(choice_list) + r"""
-                        self._error('no available options')
-                self.name_last_node('const')
-            with self._option():
-                with self._group():
-                    with self._choice():
-                        with self._option():
-                            with self._ifnot():
-                                with self._group():
-                                    with self._choice():
-                                        with self._option():
-                                            self._KEYWORDS_()""" + '\n' + '\n'.join(option_list) + r"""
-                                        self._error('no available options')
-                            self._pattern('[A-Za-z\\p{Ll}\\p{Lu}\\p{Lo}]\\p{M}*')
-                            self.name_last_node('value')
-                        with self._option():
-                            self._token('`')
-                            self._pattern('[^`]*')
-                            self.name_last_node('id')
-                            self._token('`')
-                        self._error('no available options')
-            self._error('no available options')
-        self.ast._define(
-            ['const', 'id', 'value'],
-            []
-        )"""
-            cur_content = cur_content.replace(id_original_rule, id_rule)
-        # new function rules
-        if 'funcs' in extra_dict:
-            funcs_list = extra_dict["funcs"]
-            choice_list = [f"""
-            with self._option():
-                self._pattern('{item}')""".format(item)[1:] for item in funcs_list]
-            funcs_original_rule = r"""@tatsumasu()
-    def _func_id_(self):  # noqa
-        self._token('!!!')"""
-            funcs_rule = """@tatsumasu()
-    def _func_id_(self):  # noqa
-        with self._choice():""" + '\n' + '\n'.join(choice_list) + r"""
-            self._error('no available options')"""
-            cur_content = cur_content.replace(funcs_original_rule, funcs_rule)
-        # new packages
-        if 'pkg' in extra_dict:
-            funcs_list = extra_dict["pkg"]
-            if 'e' in funcs_list:
-                funcs_list.remove('e')
-                constant_original = r"""@tatsumasu()
-    def _constant_(self):  # noqa
-        self._pi_()"""
-                constant_new = r"""@tatsumasu()
-    def _constant_(self):  # noqa
-        with self._choice():
-            with self._option():
-                self._pi_()
-            with self._option():
-                self._e_()
-            self._error('no available options')"""
-                cur_content = cur_content.replace(constant_original, constant_new)
-                keywords_original = r"""@tatsumasu()
-    def _KEYWORDS_(self):  # noqa
-        self._BUILTIN_KEYWORDS_()"""
-                keywords_new = r"""@tatsumasu()
-    def _KEYWORDS_(self):  # noqa
-        with self._choice():
-            with self._option():
-                self._BUILTIN_KEYWORDS_()
-            with self._option():
-                self._e_()
-            self._error('no available options')"""
-                cur_content = cur_content.replace(keywords_original, keywords_new)
-            # normal builtin functions
-            builtin_original_rule = r"""@tatsumasu()
-    def _builtin_operators_(self):  # noqa
-        self._predefined_built_operators_()"""
-            choice_list = [f"""
-            with self._option():
-                self._{item}_()""".format(item)[1:] for item in funcs_list]
-            funcs_rule = """@tatsumasu()
-    def _builtin_operators_(self):  # noqa
-        with self._choice():""" + '\n' + '\n'.join(choice_list) + r"""
-            with self._option():
-                self._predefined_built_operators_()
-            self._error('no available options')"""
-            cur_content = cur_content.replace(builtin_original_rule, funcs_rule)
-        return cur_content
+    def get_stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.index),
+                "loaded": len(self.parser_dict),
+                "bytes": self.total_bytes}
 
 
 def recreate_local_parser_cache():
     ### WARNING: This will delete and re-create the cache and 'la_local_parsers' directories.
     import iheartla.la_parser.parser
-    PM = iheartla.la_parser.parser._parser_manager
+    PM = iheartla.la_parser.parser.get_default_session().parser_manager
     
     print( '## Clearing the cache dir:', PM.cache_dir )
     shutil.rmtree( PM.cache_dir )
@@ -0,0 +1,728 @@
+import sys
+sys.path.append('./')
+from test.base_python_test import BasePythonTest, eigen_path
+from iheartla.la_parser.parser import compile_la_content, get_compiled_outputs, ParserTypeEnum, CompilerSession, compile_la_files, profile_la_content, compile_la_to_function, write_la_file_outputs
+from iheartla.la_tools.compile_cache import CompileCache
+from iheartla.la_tools.parser_manager import ParserFileManager
+from iheartla.la_parser.parser import GRAMMAR_DIR
+from iheartla.la_parser.compile_server import CompileServer, compile_la_content_remote, send_request
+from iheartla.la_parser.decl_scanner import scan_declarations
+from iheartla.la_tools.la_helper import OptLevelEnum, ParallelModeEnum, SequenceStorageEnum
+from tatsu.exceptions import FailedParse
+import tempfile
+import threading
+import unittest
+import importlib.util
+import tracemalloc
+import os
+import subprocess
+import hashlib
+import numpy as np
+import cppyy
+cppyy.add_include_path(eigen_path)
+from pathlib import Path
+
+has_numba = importlib.util.find_spec('numba') is not None
+
+
+class TestCompile(BasePythonTest):
+    def test_compile_cache(self):
+        la_str = """y = A x
+        where
+        A: ℝ^(2×2)
+        x: ℝ^2"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = CompileCache(cache_dir=tmpdir)
+            self.assertIsNone(cache.get(la_str, ParserTypeEnum.NUMPY))
+            ret = get_compiled_outputs(la_str, ParserTypeEnum.NUMPY | ParserTypeEnum.LATEX, use_cache=False)
+            cache.put(la_str, ParserTypeEnum.NUMPY | ParserTypeEnum.LATEX, ret)
+            self.assertEqual(cache.get(la_str, ParserTypeEnum.NUMPY | ParserTypeEnum.LATEX), ret)
+            # different mask or function name
+            self.assertIsNone(cache.get(la_str, ParserTypeEnum.NUMPY))
+            self.assertIsNone(cache.get(la_str, ParserTypeEnum.NUMPY | ParserTypeEnum.LATEX, 'func'))
+            self.assertEqual(cache.get_stats()['hits'], 1)
+            self.assertEqual(cache.get_stats()['misses'], 3)
+            # persistent
+            self.assertEqual(CompileCache(cache_dir=tmpdir).get(la_str, ParserTypeEnum.NUMPY | ParserTypeEnum.LATEX), ret)
+
+    def test_compile_cache_code(self):
+        la_str = """y = A x
+        where
+        A: ℝ^(2×2)
+        x: ℝ^2"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = CompileCache(cache_dir=tmpdir)
+            self.assertIsNone(cache.get_code(la_str, 'f'))
+            code = compile(get_compiled_outputs(la_str, ParserTypeEnum.NUMPY, 'f', use_cache=False)[0], 'f', 'exec')
+            cache.put_code(la_str, code, 'f')
+            self.assertEqual(CompileCache(cache_dir=tmpdir).get_code(la_str, 'f'), code)
+            self.assertIsNone(cache.get_code(la_str, 'g'))
+
+    def test_compile_to_function_disk_cache(self):
+        import iheartla.la_parser.parser as parser
+        la_str = """y = A x + b
+        where
+        A: ℝ^(2×2)
+        x: ℝ^2
+        b: ℝ^2"""
+        saved_cache = parser._compile_cache
+        with tempfile.TemporaryDirectory() as tmpdir:
+            parser._compile_cache = CompileCache(cache_dir=tmpdir)
+            try:
+                # in memory only by default
+                func, result_type = compile_la_to_function(la_str, 'memory_kernel')
+                self.assertEqual(os.listdir(tmpdir), [])
+                self.assertDMatrixEqual(func(np.eye(2), np.array([1, 2]), np.array([1, 1])).y, np.array([2, 3]))
+                func, result_type = compile_la_to_function(la_str, 'disk_kernel', disk_cache=True)
+                self.assertIsNotNone(parser._compile_cache.get_code(la_str, 'disk_kernel'))
+                self.assertDMatrixEqual(func(np.eye(2), np.array([1, 2]), np.array([1, 1])).y, np.array([2, 3]))
+            finally:
+                parser._compile_cache = saved_cache
+
+    def test_compile_to_function(self):
+        la_str = """y = A x
+        where
+        A: ℝ^(2×2)
+        x: ℝ^2"""
+        func, result_type = compile_la_to_function(la_str, 'kernel', use_cache=False)
+        self.assertEqual(func.__name__, 'kernel')
+        ret = func(np.array([[1, 2], [3, 4]]), np.array([1, 1]))
+        self.assertTrue(isinstance(ret, result_type))
+        self.assertDMatrixEqual(ret.y, np.array([3, 7]))
+        modules = set(sys.modules.keys())
+        func, result_type = compile_la_to_function(la_str, use_cache=False)
+        self.assertEqual(func.__name__, 'myExpression')
+        self.assertEqual(result_type.__name__, 'myExpressionResultType')
+        self.assertEqual(set(sys.modules.keys()) - modules, set())
+        # same results as the generated file the other tests import
+        la_str = """y = ∑_i A_i x_i + B x_1
+        G_ij = { B_ij if ( i , j ) ∈ E
+        0 otherwise
+        where
+        A_i: ℝ^(2×2)
+        x_i: ℝ^2
+        B: ℝ^(2×2)
+        G: ℝ^(2×2): a sparse matrix
+        E: { ℤ × ℤ } index"""
+        func, result_type = compile_la_to_function(la_str, use_cache=False)
+        file_func = self.gen_func_info(la_str).numpy_func
+        A = np.array([[[1., 2.], [3., 4.]], [[0., 1.], [1., 0.]]])
+        x = np.array([[1., -1.], [2., 3.]])
+        B = np.array([[2., 0.], [1., 5.]])
+        E = [(0, 0), (1, 1)]
+        ret = func(A, x, B, E)
+        file_ret = file_func(A, x, B, E)
+        self.assertDMatrixApproximateEqual(ret.y, file_ret.y)
+        self.assertSMatrixEqual(ret.G, file_ret.G)
+
+    def test_unchecked_function(self):
+        la_str = """y = A x
+        where
+        A: ℝ^(2×2)
+        x: ℝ^2"""
+        func, result_type = compile_la_to_function(la_str, use_cache=False)
+        unchecked_func = func.__globals__['myExpression_unchecked']
+        A = np.array([[1., 2.], [3., 4.]])
+        x = np.array([1., 1.])
+        self.assertDMatrixEqual(unchecked_func(A, x).y, np.array([3, 7]))
+        # the checks stay in the checked entry point
+        with self.assertRaises(AssertionError):
+            func(A, np.array([1, 1, 1]))
+
+    def test_batched_function(self):
+        la_str = """x = A^(-1) b
+        y = ||x|| + tr(A Aᵀ)
+        z = sin(c) A b + x/c
+        where
+        A: ℝ^(3×3)
+        b: ℝ^3
+        c: ℝ"""
+        func, result_type = compile_la_to_function(self.import_trig + la_str, use_cache=False)
+        batched_func = func.__globals__['myExpression_batched']
+        A = np.array([[[2, 1, 0], [0, 3, 1], [1, 0, 4]], [[1, 0, 0], [0, 2, 0], [0, 0, 3]]])
+        b = np.array([[1, 2, 3], [3, 2, 1]])
+        c = np.array([1.5, 2])
+        ret = batched_func(A, b, c)
+        self.assertTrue(isinstance(ret, result_type))
+        for index in range(2):
+            item = func(A[index], b[index], c[index])
+            self.assertDMatrixApproximateEqual(ret.x[index], item.x)
+            self.assertAlmostEqual(ret.y[index], item.y)
+            self.assertDMatrixApproximateEqual(ret.z[index], item.z)
+        # lowered to operations on the stacks
+        self.assertNotIn("zip(", get_compiled_outputs(self.import_trig + la_str, ParserTypeEnum.NUMPY, use_cache=False)[0])
+
+    def test_batched_function_loop(self):
+        # subscripts: each set of parameters is evaluated on its own
+        la_str = """y_i = sum_j A_i,j b_j
+        where
+        A: ℝ^(2×2)
+        b: ℝ^2"""
+        func, result_type = compile_la_to_function(la_str, use_cache=False)
+        A = np.array([[[1, 2], [3, 4]], [[0, 1], [1, 0]]])
+        b = np.array([[1, 1], [2, 3]])
+        ret = func.__globals__['myExpression_batched'](A, b)
+        self.assertDMatrixEqual(ret.y, np.array([[3, 7], [3, 2]]))
+
+    numba_la_str = """y_i = sum_(j for j > i) A_i,j x_j
+    z = sum_i y_i
+    where
+    A: ℝ^(3×3)
+    x: ℝ^3"""
+
+    def load_numba_module(self, tmpdir):
+        # imported from a file like the shipped output, numba caches the kernels next to it
+        content = get_compiled_outputs(self.numba_la_str, ParserTypeEnum.NUMBA, use_cache=False)[0]
+        write_la_file_outputs(os.path.join(tmpdir, 'kernels.la'), ParserTypeEnum.NUMBA, [content])
+        spec = importlib.util.spec_from_file_location('kernels_numba', os.path.join(tmpdir, 'kernels_numba.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return content, module
+
+    def test_numba_output(self):
+        A = np.array([[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+        x = np.array([1, 2, 3])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            content, module = self.load_numba_module(tmpdir)
+            self.assertIn("@njit(cache=True)", content)
+            ret = module.myExpression(A, x)
+            self.assertDMatrixEqual(ret.y, np.array([13, 18, 0]))
+            self.assertEqual(ret.z, 31)
+        if not has_numba:
+            # exec'd output runs as plain NumPy when numba isn't installed
+            namespace = {}
+            exec(content, namespace)
+            ret = namespace['myExpression'](A, x)
+            self.assertDMatrixEqual(ret.y, np.array([13, 18, 0]))
+            self.assertEqual(ret.z, 31)
+
+    @unittest.skipIf(not has_numba, "numba isn't installed")
+    def test_numba_kernel(self):
+        import numba
+        A = np.array([[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+        x = np.array([1, 2, 3])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            content, module = self.load_numba_module(tmpdir)
+            kernel = module.myExpression_kernel_0
+            self.assertIsInstance(kernel, numba.core.registry.CPUDispatcher)
+            ret = module.myExpression(A, x)
+            self.assertEqual(len(kernel.signatures), 1)
+            self.assertDMatrixEqual(ret.y, np.array([13, 18, 0]))
+            self.assertEqual(ret.z, 31)
+        # exec'd output has no file to cache to, the kernels are compiled without the cache
+        namespace = {}
+        exec(content, namespace)
+        ret = namespace['myExpression'](A, x)
+        self.assertTrue(len(namespace['myExpression_kernel_0'].signatures) > 0)
+        self.assertDMatrixEqual(ret.y, np.array([13, 18, 0]))
+
+    def test_optimizer(self):
+        la_str = """y = (A B) x + (A B)ᵀ x
+        z = ∑_i ((A B) w_i + 1/2 w_i)
+        where
+        A: ℝ^(2×2)
+        B: ℝ^(2×2)
+        x: ℝ^2
+        w_i: ℝ^2"""
+        outputs = [CompilerSession(opt_level=level).compile(la_str, ParserTypeEnum.NUMPY | ParserTypeEnum.LATEX)
+                   for level in [OptLevelEnum.O0, OptLevelEnum.O1, OptLevelEnum.O2]]
+        # the latex is printed as written
+        self.assertEqual(outputs[0][1], outputs[2][1])
+        self.assertFalse('0.5' in outputs[0][0])
+        self.assertTrue('0.5' in outputs[1][0])
+        self.assertFalse('tmp_0' in outputs[1][0])
+        # A B is computed once, before the summation
+        source = outputs[2][0]
+        self.assertEqual(source.count('A @ B'), 1)
+        self.assertTrue(source.find('tmp_0 = A @ B') < source.find('sum_0'))
+        A = np.array([[1., 2.], [3., 4.]])
+        B = np.array([[0., 1.], [1., 2.]])
+        x = np.array([1., -1.])
+        x_seq = np.array([[1., 2.], [3., 4.], [5., 6.]])
+        results = []
+        for index in range(3):
+            namespace = {}
+            exec(compile(outputs[index][0], '<optimizer>', 'exec'), namespace)
+            results.append(namespace['myExpression'](A, B, x, x_seq))
+        for ret in results[1:]:
+            self.assertDMatrixEqual(ret.y, results[0].y)
+            self.assertDMatrixEqual(ret.z, results[0].z)
+            self.assertFalse(hasattr(ret, 'tmp_0'))
+
+    def test_optimizer_stale(self):
+        la_str = """L = 2B
+        s = (L + B) c + (L + B) c + (L + B)
+        L_ii = 5
+        t = (L + B) c
+        where
+        B: ℝ^(2×2)
+        c: ℝ"""
+        B = np.array([[1., 2.], [3., 4.]])
+        results = []
+        for level in [OptLevelEnum.O0, OptLevelEnum.O2]:
+            source = CompilerSession(opt_level=level).compile(la_str, ParserTypeEnum.NUMPY)[0]
+            namespace = {}
+            exec(compile(source, '<optimizer>', 'exec'), namespace)
+            results.append(namespace['myExpression'](B, 2))
+        # the temporaries of L + B and (L + B) c are both recomputed after L changes
+        self.assertDMatrixEqual(results[1].t, np.array([[12., 12.], [18., 18.]]))
+        self.assertDMatrixEqual(results[1].t, results[0].t)
+        self.assertDMatrixEqual(results[1].s, results[0].s)
+
+    def test_optimizer_summation_local(self):
+        la_str = """y = ∑_i [x_i×n̂_i; n̂_i][(x_i×n̂_i)ᵀ n̂_iᵀ]
+        z = ∑_i (p_i-x_i)ᵀn̂_i n̂_iᵀ(p_i-x_i)
+        where
+        x_i: ℝ^3
+        n̂_i: ℝ^3
+        p_i: ℝ^3"""
+        outputs = [CompilerSession(opt_level=level).compile(la_str, ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN)
+                   for level in [OptLevelEnum.O0, OptLevelEnum.O2]]
+        # the repeated terms are computed once in each iteration
+        source = outputs[1][0]
+        self.assertEqual(source.count('np.cross(x[i-1], n̂[i-1])'), 1)
+        self.assertEqual(source.count('p[i-1] - x[i-1]'), 1)
+        self.assertTrue(source.find('for i in range') < source.find('np.cross('))
+        self.assertEqual(outputs[1][1].count('(x[i-1]).cross(n̂[i-1])'), 1)
+        x = np.array([[1., 0., 2.], [0., 1., 1.], [3., 1., 0.]])
+        n = np.array([[0., 1., 0.], [1., 1., 0.], [0., 0., 1.]])
+        p = np.array([[1., 1., 1.], [2., 0., 1.], [0., 3., 1.]])
+        results = []
+        for source in [outputs[0][0], outputs[1][0]]:
+            namespace = {}
+            exec(compile(source, '<optimizer>', 'exec'), namespace)
+            results.append(namespace['myExpression'](x, n, p))
+        self.assertDMatrixApproximateEqual(results[0].y, results[1].y)
+        self.assertAlmostEqual(results[0].z, results[1].z)
+
+    def test_optimizer_solve(self):
+        la_str = """y = A⁻¹ b
+        z_i = A⁻¹ x_i
+        B = A⁻¹
+        where
+        A: ℝ^(2×2)
+        b: ℝ^2
+        x_i: ℝ^2"""
+        outputs = [CompilerSession(opt_level=level).compile(la_str, ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN)
+                   for level in [OptLevelEnum.O1, OptLevelEnum.O2]]
+        # the inverse is only computed for B
+        self.assertEqual(outputs[0][0].count('np.linalg.inv('), 1)
+        self.assertEqual(outputs[0][0].count('np.linalg.solve(A, '), 2)
+        # one factorization for the solves
+        source = outputs[1][0]
+        self.assertEqual(source.count('scipy.linalg.lu_factor(A)'), 1)
+        self.assertTrue(source.find('lu_factor') < source.find('for i in range'))
+        self.assertEqual(source.count('scipy.linalg.lu_solve(lu_0, '), 2)
+        self.assertEqual(outputs[1][1].count('Eigen::PartialPivLU<Eigen::Matrix<double, 2, 2>> lu_0(A);'), 1)
+        self.assertEqual(outputs[1][1].count('lu_0.solve('), 2)
+        A = np.array([[4., 1.], [2., 3.]])
+        b = np.array([1., 2.])
+        x = np.array([[1., 0.], [0., 1.], [2., 2.]])
+        results = []
+        for level, source in [(OptLevelEnum.O0, None), (OptLevelEnum.O2, source)]:
+            if source is None:
+                source = CompilerSession(opt_level=level).compile(la_str, ParserTypeEnum.NUMPY)[0]
+            namespace = {}
+            exec(compile(source, '<optimizer>', 'exec'), namespace)
+            results.append(namespace['myExpression'](A, b, x))
+        self.assertDMatrixApproximateEqual(results[0].y, results[1].y)
+        self.assertDMatrixApproximateEqual(results[0].z, results[1].z)
+        self.assertDMatrixApproximateEqual(results[0].B, results[1].B)
+
+    def test_optimizer_solve_singular(self):
+        la_str = """x = A⁻¹b
+        y = A⁻¹c
+        where
+        A: ℝ^(2×2)
+        b: ℝ^2
+        c: ℝ^2"""
+        A = np.array([[1., 2.], [2., 4.]])
+        b = np.array([1., 2.])
+        c = np.array([0., 1.])
+        # the shared factorization raises like np.linalg.solve
+        for level in [OptLevelEnum.O0, OptLevelEnum.O1, OptLevelEnum.O2]:
+            source = CompilerSession(opt_level=level).compile(la_str, ParserTypeEnum.NUMPY)[0]
+            self.assertEqual(source.count('lu_factor'), 1 if level == OptLevelEnum.O2 else 0)
+            namespace = {}
+            exec(compile(source, '<optimizer>', 'exec'), namespace)
+            with self.assertRaises(np.linalg.LinAlgError):
+                namespace['myExpression'](A, b, c)
+
+    def test_optimizer_conditional_summation(self):
+        la_str = """y = ∑_(i for c_i > 0) c_i A⁻¹ b
+        where
+        c_i: ℝ
+        A: ℝ^(2×2)
+        b: ℝ^2"""
+        A = np.array([[1., 2.], [2., 4.]])
+        b = np.array([1., 2.])
+        for level in [OptLevelEnum.O0, OptLevelEnum.O1, OptLevelEnum.O2]:
+            source = CompilerSession(opt_level=level).compile(la_str, ParserTypeEnum.NUMPY)[0]
+            # the solve stays in the body, it only runs when a term is summed
+            self.assertTrue(source.find('for i in range') < source.find('np.linalg.'))
+            self.assertFalse('lu_factor' in source)
+            namespace = {}
+            exec(compile(source, '<optimizer>', 'exec'), namespace)
+            self.assertDMatrixEqual(namespace['myExpression'](np.array([-1., -2.]), A, b).y, np.zeros(2))
+            self.assertDMatrixEqual(namespace['myExpression'](np.zeros(0), A, b).y, np.zeros(2))
+            with self.assertRaises(np.linalg.LinAlgError):
+                namespace['myExpression'](np.array([-1., 2.]), A, b)
+
+    def test_parallel_output(self):
+        la_str = """y = ∑_(i for i ≠ 1) ‖x_i - c‖
+        z = ∑_i B_i (x_i - c)
+        v_i = x_i ⋅ c
+        M_ij = { i j if i > j
+        where
+        x_i: ℝ^3
+        c: ℝ^3
+        B_i: ℝ^(3×3)
+        M: ℝ^(4×4) sparse"""
+        outputs = [CompilerSession(parallel_mode=mode).compile(la_str, ParserTypeEnum.EIGEN)[0]
+                   for mode in [ParallelModeEnum.SERIAL, ParallelModeEnum.OPENMP, ParallelModeEnum.OPENMP_DETERMINISTIC]]
+        self.assertFalse('#pragma omp' in outputs[0])
+        self.assertEqual(outputs[1].count('#pragma omp parallel\n'), 2)
+        self.assertEqual(outputs[1].count('#pragma omp critical'), 2)
+        # fixed blocks, the partial sums and the triplets are joined in order
+        self.assertEqual(outputs[2].count('#pragma omp parallel for schedule(dynamic)'), 3)
+        self.assertTrue('sum_0 += sum_0_blocks[sum_0_block];' in outputs[2])
+        self.assertTrue('tripletList_M_local.push_back(' in outputs[2])
+        # without -fopenmp the pragmas are ignored and the loops give the serial results
+        func_list = []
+        for index in range(len(outputs)):
+            namespace = "parallel_code{}".format(index)
+            pos = outputs[index].rfind("#include")
+            pos += outputs[index][pos:].find('\n')
+            cppyy.cppdef(outputs[index][:pos+1] + 'namespace {}{{\n'.format(namespace) + outputs[index][pos+1:] + '\n}')
+            func_list.append("    auto ret_{} = {}::myExpression(x, c, B);".format(index, namespace))
+            func_list.append("    same = same && std::abs(ret_{}.y - ret_0.y) < 1e-9 && (ret_{}.z - ret_0.z).norm() < 1e-9;".format(index, index))
+            func_list.append("    same = same && (ret_{}.v - ret_0.v).norm() == 0 && (ret_{}.M - ret_0.M).norm() == 0;".format(index, index))
+        func_list = ["bool test_parallel_output(){",
+                     "    std::vector<Eigen::Matrix<double, 3, 1>> x(1000);",
+                     "    std::vector<Eigen::Matrix<double, 3, 3>> B(1000);",
+                     "    for(int i=0; i<1000; i++){",
+                     "        x[i] << sin(i), cos(i), 0.5;",
+                     "        B[i] = (1 + i % 7) * Eigen::Matrix<double, 3, 3>::Identity();",
+                     "    }",
+                     "    Eigen::Matrix<double, 3, 1> c;",
+                     "    c << 0.1, 0.2, 0.3;",
+                     "    bool same = true;"] + func_list + \
+                    ["    return same && ret_0.M.nonZeros() == 6;",
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(cppyy.gbl.test_parallel_output())
+
+    def test_contiguous_sequences(self):
+        la_str = """y = ∑_(i for i ≠ 1) ‖x_i - c‖
+        z = ∑_i B_i x_i
+        w = ∑_i x_i
+        u = B_2,1,2 + ∑_i A_i,2,1 x_i,3
+        where
+        x_i: ℝ^3
+        c: ℝ^3
+        B_i: ℝ^(3×3)
+        A_i: ℝ^(m×2)"""
+        outputs = [CompilerSession(sequence_storage=storage).compile(la_str, ParserTypeEnum.EIGEN)[0]
+                   for storage in [SequenceStorageEnum.VECTOR, SequenceStorageEnum.CONTIGUOUS]]
+        self.assertTrue('std::vector<Eigen::Matrix<double, 3, 3>> & B' in outputs[0])
+        self.assertFalse('std::vector' in outputs[1][outputs[1].find('myExpressionResultType myExpression('):])
+        self.assertTrue('const Eigen::Ref<const Eigen::Matrix<double, 3, Eigen::Dynamic> > & B' in outputs[1])
+        # the products of the elements are one product of the whole sequences
+        self.assertTrue('B * x.reshaped()' in outputs[1])
+        self.assertTrue('A.middleCols((i-1)*2, 2)(2-1, 1-1)' in outputs[1])
+        # the buffer overload passes the sequences as they are
+        self.assertTrue('Eigen::Map<const Eigen::MatrixXd >(A, m, dim_0*2)' in outputs[1])
+        for index in range(len(outputs)):
+            namespace = "sequence_code{}".format(index)
+            pos = outputs[index].rfind("#include")
+            pos += outputs[index][pos:].find('\n')
+            cppyy.cppdef(outputs[index][:pos+1] + 'namespace {}{{\n'.format(namespace) + outputs[index][pos+1:] + '\n}')
+        func_list = ["bool test_contiguous_sequences(){",
+                     "    std::vector<Eigen::Matrix<double, 3, 1>> x(100);",
+                     "    std::vector<Eigen::Matrix<double, 3, 3>> B(100);",
+                     "    std::vector<Eigen::MatrixXd> A(100);",
+                     "    Eigen::Matrix<double, 3, Eigen::Dynamic> x_s(3, 100);",
+                     "    Eigen::Matrix<double, 3, Eigen::Dynamic> B_s(3, 300);",
+                     "    Eigen::MatrixXd A_s(4, 200);",
+                     "    for(int i=0; i<100; i++){",
+                     "        x[i] << sin(i), cos(i), 0.5;",
+                     "        B[i] = Eigen::Matrix<double, 3, 3>::Random();",
+                     "        A[i] = Eigen::MatrixXd::Random(4, 2);",
+                     "        x_s.col(i) = x[i];",
+                     "        B_s.middleCols(3*i, 3) = B[i];",
+                     "        A_s.middleCols(2*i, 2) = A[i];",
+                     "    }",
+                     "    Eigen::Matrix<double, 3, 1> c;",
+                     "    c << 0.1, 0.2, 0.3;",
+                     "    auto ret_0 = sequence_code0::myExpression(x, c, B, A);",
+                     "    auto ret_1 = sequence_code1::myExpression(x_s, c, B_s, A_s);",
+                     "    auto ret_2 = sequence_code1::myExpression(x_s.data(), c.data(), B_s.data(), A_s.data(), 100, 4);",
+                     "    bool same = std::abs(ret_0.y - ret_1.y) < 1e-12 && (ret_0.z - ret_1.z).norm() < 1e-12;",
+                     "    same = same && (ret_0.w - ret_1.w).norm() < 1e-12 && std::abs(ret_0.u - ret_1.u) < 1e-12;",
+                     "    return same && ret_2.y == ret_1.y && ret_2.z == ret_1.z && ret_2.u == ret_1.u;",
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(cppyy.gbl.test_contiguous_sequences())
+
+    def test_compile_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = CompileCache(cache_dir=tmpdir, max_entries=2)
+            cache.put('a', ParserTypeEnum.NUMPY, ['a'])
+            cache.put('b', ParserTypeEnum.NUMPY, ['b'])
+            self.assertEqual(cache.get('a', ParserTypeEnum.NUMPY), ['a'])
+            cache.put('c', ParserTypeEnum.NUMPY, ['c'])
+            # b is the least recently used entry
+            self.assertIsNone(cache.get('b', ParserTypeEnum.NUMPY))
+            self.assertEqual(cache.get('a', ParserTypeEnum.NUMPY), ['a'])
+            self.assertEqual(cache.get('c', ParserTypeEnum.NUMPY), ['c'])
+            self.assertEqual(cache.get_stats()['evictions'], 1)
+            self.assertEqual(len(CompileCache(cache_dir=tmpdir).index), 2)
+
+    def test_compile_content(self):
+        la_str = """y = A x
+        where
+        A: ℝ^(2×2)
+        x: ℝ^2"""
+        ret = compile_la_content(la_str, ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN, use_cache=False)
+        self.assertEqual(len(ret), 2)
+        self.assertTrue('def myExpression(A, x)' in ret[0])
+        self.assertTrue('myExpressionResultType myExpression(' in ret[1])
+
+    def test_compile_session_threads(self):
+        la_list = ["""y = A x
+        where
+        A: ℝ^(2×2)
+        x: ℝ^2""", """y = ∑_i A_i,i b_i
+        where
+        A: ℝ^(4×4)
+        b: ℝ^4""", """from trigonometry: sin
+        y = f(x) + sin(x)
+        where
+        x: ℝ
+        f: ℝ → ℝ"""]
+        expected = [get_compiled_outputs(la_str, ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN, use_cache=False) for la_str in la_list]
+        results = {}
+
+        def compile_all(index):
+            session = CompilerSession()
+            results[index] = [get_compiled_outputs(la_str, ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN, use_cache=False, session=session) for la_str in la_list]
+        threads = [threading.Thread(target=compile_all, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for i in range(4):
+            self.assertEqual(results[i], expected)
+
+    def test_compile_files_jobs(self):
+        la_list = ["""y = A x
+        where
+        A: ℝ^(2×2)
+        x: ℝ^2""", """y = A + B
+        where
+        A: ℝ^(2×2)""", """y = x + 1
+        where
+        x: ℝ"""]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            la_files = []
+            for index in range(len(la_list)):
+                la_file = os.path.join(tmpdir, "kernel{}.la".format(index))
+                with open(la_file, 'w') as f:
+                    f.write(la_list[index])
+                la_files.append(la_file)
+            ret = compile_la_files(la_files, ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN, jobs=2, use_cache=False)
+            self.assertEqual([la_file for la_file, err_msg in ret], la_files)
+            self.assertIsNone(ret[0][1])
+            self.assertIsNotNone(ret[1][1])
+            self.assertIsNone(ret[2][1])
+            for index in [0, 2]:
+                with open(os.path.join(tmpdir, "kernel{}.py".format(index))) as f:
+                    self.assertTrue('def kernel{}('.format(index) in f.read())
+                self.assertTrue(os.path.exists(os.path.join(tmpdir, "kernel{}.cpp".format(index))))
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, "kernel1.py")))
+
+    def test_lazy_imports(self):
+        code = """import sys
+from iheartla.la_parser.parser import compile_la_content, ParserTypeEnum
+assert 'tatsu' not in sys.modules
+assert 'iheartla.la_local_parsers.default_parser' not in sys.modules
+assert not [m for m in sys.modules if 'codegen' in m]
+assert 'wx' not in sys.modules
+compile_la_content('y = A x\\nwhere\\nA: ℝ^(2×2)\\nx: ℝ^2', ParserTypeEnum.NUMPY, use_cache=False)
+assert 'iheartla.la_parser.codegen_numpy' in sys.modules
+assert 'iheartla.la_parser.codegen_eigen' not in sys.modules
+"""
+        ret = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+        self.assertEqual(ret.returncode, 0, ret.stderr)
+
+    def test_parser_token_table(self):
+        session = CompilerSession()
+        default_parser = session.parser_manager.default_parser
+        modules = set(sys.modules.keys())
+        la_str = """from trigonometry: sin, e
+        `x_new` = f(`x_old`) + sin(e)
+        where
+        `x_old`: ℝ
+        f: ℝ → ℝ"""
+        ret = get_compiled_outputs(la_str, ParserTypeEnum.NUMPY, use_cache=False, session=session)
+        self.assertTrue('def myExpression(x_old, f)' in ret[0])
+        # specialized in place
+        self.assertIs(session.parser_manager.default_parser, default_parser)
+        self.assertTrue(len(default_parser.new_func_list) > 0)
+        self.assertEqual(default_parser.builtin_list, ['sin_func'])
+        self.assertTrue(default_parser.const_e)
+        self.assertEqual(set(sys.modules.keys()) - modules, set())
+        # the tables are reset for the next program
+        get_compiled_outputs("""y = e + 1
+        where
+        e: ℝ""", ParserTypeEnum.NUMPY, use_cache=False, session=session)
+        self.assertEqual(default_parser.new_func_list, [])
+        self.assertEqual(default_parser.builtin_list, [])
+        self.assertFalse(default_parser.const_e)
+
+    def test_parser_file_cache(self):
+        def parser_code(hash_value):
+            return "class grammar{0}Parser(object):\n    def __init__(self, semantics=None):\n        self.name = '{0}'\n" \
+                   "class grammar{0}ModelBuilderSemantics(object):\n    pass\n".format(hash_value)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manager = ParserFileManager(GRAMMAR_DIR, cache_dir=tmpdir)
+            # room for the default parsers plus two
+            manager.max_size = len(manager.index) + 2
+            key_list = ['a', 'b', 'c']
+            hash_list = [hashlib.md5(key.encode()).hexdigest() for key in key_list]
+            manager.save_parser_code(hash_list[0], parser_code(hash_list[0]))
+            manager.save_parser_code(hash_list[1], parser_code(hash_list[1]))
+            # nothing is imported until the first lookup
+            self.assertEqual(len(manager.parser_dict), 0)
+            self.assertEqual(manager.get_parser('a', '').name, hash_list[0])
+            self.assertEqual(manager.get_stats()['hits'], 1)
+            self.assertEqual(manager.get_stats()['loaded'], 1)
+            # b is the least recently used one
+            manager.save_parser_code(hash_list[2], parser_code(hash_list[2]))
+            self.assertEqual(manager.get_stats()['evictions'], 1)
+            self.assertFalse(hash_list[1] in manager.index)
+            self.assertTrue(hash_list[0] in manager.index)
+            self.assertEqual(len(list(Path(tmpdir).glob('parser_{}_*.py'.format(hash_list[1])))), 0)
+            # the index is restored from the manifest
+            new_manager = ParserFileManager(GRAMMAR_DIR, cache_dir=tmpdir)
+            self.assertEqual(list(new_manager.index.items()), list(manager.index.items()))
+            self.assertEqual(new_manager.get_parser('c', '').name, hash_list[2])
+
+    def test_compile_server(self):
+        server = CompileServer(port=0, sessions=2, use_cache=False)
+        port = server.server_address[1]
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        try:
+            la_str = """y = A x
+            where
+            A: ℝ^(2×2)
+            x: ℝ^2"""
+            expected = get_compiled_outputs(la_str, ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN, func_name='f', use_cache=False)
+            results = {}
+
+            def send(index):
+                results[index] = compile_la_content_remote(la_str, ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN, 'f', port=port)
+            threads = [threading.Thread(target=send, args=(i,)) for i in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            for i in range(4):
+                self.assertEqual(results[i], (expected, None))
+            outputs, err_msg = compile_la_content_remote("y = A + B\nwhere\nA: ℝ^(2×2)", ParserTypeEnum.NUMPY, port=port)
+            self.assertIsNone(outputs)
+            self.assertTrue('Symbol B is not defined' in err_msg)
+            status = send_request('/status', port=port)
+            self.assertEqual(status['served'], 5)
+            self.assertEqual(status['errors'], 1)
+            self.assertEqual(status['pending'], 0)
+            self.assertTrue(status['latency_ms']['p50'] > 0)
+            send_request('/shutdown', {}, port=port)
+            server_thread.join(10)
+            self.assertFalse(server_thread.is_alive())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_profile(self):
+        la_str = """y = A x
+        where
+        A: ℝ^(2×2)
+        x: ℝ^2"""
+        outputs, report = profile_la_content(la_str, ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN)
+        self.assertEqual(outputs, get_compiled_outputs(la_str, ParserTypeEnum.NUMPY | ParserTypeEnum.EIGEN, use_cache=False))
+        self.assertEqual([phase['name'] for phase in report['phases']],
+                         ['scan', 'specialization', 'second_parse', 'type_walk', 'codegen_numpy', 'codegen_eigen'])
+        self.assertTrue(all(phase['time_ms'] >= 0 and phase['peak_memory_bytes'] >= 0 for phase in report['phases']))
+        self.assertIsNone(report['error'])
+        outputs, report = profile_la_content("y = A + B\nwhere\nA: ℝ^(2×2)", ParserTypeEnum.NUMPY, trace_memory=False)
+        self.assertIsNone(outputs)
+        self.assertTrue('Symbol B is not defined' in report['error'])
+        self.assertEqual([phase['name'] for phase in report['phases']][:2], ['scan_fallback', 'init_parse'])
+        self.assertFalse('peak_memory_bytes' in report['phases'][0])
+        # Python 3.7 and 3.8 have no tracemalloc.reset_peak
+        reset_peak = getattr(tracemalloc, 'reset_peak', None)
+        if reset_peak is not None:
+            del tracemalloc.reset_peak
+        try:
+            outputs, report = profile_la_content(la_str, ParserTypeEnum.NUMPY)
+        finally:
+            if reset_peak is not None:
+                tracemalloc.reset_peak = reset_peak
+        self.assertIsNone(report['error'])
+        self.assertTrue(all(phase['peak_memory_bytes'] >= 0 for phase in report['phases']))
+
+    def test_decl_scanner(self):
+        la_str = """from trigonometry: sin, e
+        `x_new` = f(`x_old`) + sin(e) + ∑_i g_i(x_i) + h(old)
+        wd = min_(x ∈ ℝ^2) ‖x‖
+        h = f
+        where
+        `x_old`: ℝ
+        old: ℝ
+        x_i: ℝ^2 : a description
+        g_i: ℝ^2 → ℝ
+        f: ℝ → ℝ"""
+        decls = scan_declarations(la_str)
+        self.assertEqual(decls.parameters, ['`x_old`', 'old', 'x', 'g', 'f'])
+        self.assertEqual(decls.multi_lhs_list, ['`x_new`', 'wd'])
+        self.assertEqual(decls.func_dict, {'g_i': 'g_i', 'f': 'ℝ → ℝ', 'h': 'ℝ → ℝ'})
+        self.assertEqual(decls.package_dict, {'trigonometry': ['e', 'sin']})
+        # a single parse of the specialized grammar
+        outputs, report = profile_la_content("""y = A x
+        where
+        A: ℝ^(2×2)
+        x: ℝ^2""", ParserTypeEnum.NUMPY, trace_memory=False)
+        self.assertFalse('init_parse' in [phase['name'] for phase in report['phases']])
+        # ';' separates statements as well as lines
+        la_str = """y = A x + f(x; c)
+        where
+        A: ℝ^(3×3); x: ℝ^3; c: ℝ
+        f: ℝ^3; ℝ → ℝ^3"""
+        decls = scan_declarations(la_str)
+        self.assertEqual(decls.parameters, ['A', 'x', 'c', 'f'])
+        self.assertEqual(decls.func_dict, {'f': 'ℝ^3; ℝ → ℝ^3'})
+        outputs, report = profile_la_content(la_str, ParserTypeEnum.NUMPY, trace_memory=False)
+        self.assertIsNone(report['error'])
+        self.assertEqual([phase['name'] for phase in report['phases']],
+                         ['scan', 'specialization', 'second_parse', 'type_walk', 'codegen_numpy'])
+        # the constraints after s.t. aren't declarations, the scanned and the init parse accept the same programs
+        la_str = """b = argmin_(ab ∈ ℝ) ab + 1
+        s.t.
+        ab ∈ s
+        where
+        s: ℝ"""
+        self.assertEqual(scan_declarations(la_str).parameters, ['s'])
+        with self.assertRaises(FailedParse):
+            CompilerSession().compile(la_str, ParserTypeEnum.NUMPY)
+        la_str = """b = argmin_(x ∈ ℝ^2) ‖x‖ + s
+        s.t.
+        x ∈ C
+        where
+        s: ℝ
+        C: {ℝ^2}"""
+        self.assertEqual(scan_declarations(la_str).parameters, ['s', 'C'])
+        outputs, report = profile_la_content(la_str, ParserTypeEnum.NUMPY, trace_memory=False)
+        self.assertIsNone(report['error'])
+        self.assertFalse('init_parse' in [phase['name'] for phase in report['phases']])
@@ -45,6 +45,21 @@ class TestGallery(BasePythonTest):
         x0 = [1, 2]
         b = np.array([[1, 2], [4, 3]])
         self.assertTrue(np.isclose(func_info.numpy_func(A, x0, b).ret, 6.76227768454))
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    std::vector<Eigen::MatrixXd> A(2, Eigen::MatrixXd(2, 2));",
+                     "    A[0] << 1, 2, 4, 3;",
+                     "    A[1] << 1, 2, 4, 3;",
+                     "    Eigen::VectorXd x0(2);",
+                     "    x0 << 1, 2;",
+                     "    std::vector<Eigen::VectorXd> b(2, Eigen::VectorXd(2));",
+                     "    b[0] << 1, 2;",
+                     "    b[1] << 4, 3;",
+                     "    return std::abs({}(A, x0, b).ret - 6.76227766017) < {};".format(func_info.eig_func_name, 1e-6),
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
 
     def test_gallery_1_1(self):
         # sequence
@@ -69,6 +84,19 @@ class TestGallery(BasePythonTest):
         x = np.array([[1, 2, 3], [3, 6, 5]])
         R = np.array([[[1, 2, 3], [3, 6, 5], [6, 3, 2]], [[2, 2, 1], [2, 3, 5], [9, 3, 1]]])
         self.assertTrue(np.isclose(func_info.numpy_func(x, R).ret, 11.123203285420))
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    std::vector<Eigen::Matrix<double, 3, 1> > x(2);",
+                     "    x[0] << 1, 2, 3;",
+                     "    x[1] << 3, 6, 5;",
+                     "    std::vector<Eigen::Matrix<double, 3, 3> > R(2);",
+                     "    R[0] << 1, 2, 3, 3, 6, 5, 6, 3, 2;",
+                     "    R[1] << 2, 2, 1, 2, 3, 5, 9, 3, 1;",
+                     "    return std::abs({}(x, R).ret - 11.123203285420) < {};".format(func_info.eig_func_name, 1e-6),
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
 
     def test_gallery_2(self):
         # sequence
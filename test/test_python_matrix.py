@@ -1,6 +1,7 @@
 import sys
 sys.path.append('./')
 from test.base_python_test import BasePythonTest, eigen_path
+from iheartla.la_parser.parser import parse_la, ParserTypeEnum
 import numpy as np
 import scipy
 from scipy import sparse
@@ -96,6 +97,75 @@ class TestMatrix(BasePythonTest):
         cppyy.cppdef('\n'.join(func_list))
         self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
 
+    def test_inverse_solve(self):
+        # solved with a shared factorization
+        la_str = """y = A⁻¹ b + A⁻¹ c
+        B = A⁻¹
+        where
+        A: ℝ ^ (2 × 2): a matrix
+        b: ℝ ^ 2
+        c: ℝ ^ 2"""
+        func_info = self.gen_func_info(la_str)
+        A = np.array([[4, 1], [2, 3]])
+        b = np.array([1, 2])
+        c = np.array([3, -1])
+        ret = func_info.numpy_func(A, b, c)
+        self.assertDMatrixApproximateEqual(ret.y, np.array([1.1, -0.4]))
+        self.assertDMatrixApproximateEqual(ret.B, np.array([[0.3, -0.1], [-0.2, 0.4]]))
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    Eigen::Matrix<double, 2, 2> A;",
+                     "    A << 4, 1, 2, 3;",
+                     "    Eigen::Matrix<double, 2, 1> b;",
+                     "    b << 1, 2;",
+                     "    Eigen::Matrix<double, 2, 1> c;",
+                     "    c << 3, -1;",
+                     "    Eigen::Matrix<double, 2, 1> y;",
+                     "    y << 1.1, -0.4;",
+                     "    Eigen::Matrix<double, 2, 1> C = {}(A, b, c).y;".format(func_info.eig_func_name),
+                     "    return ((y - C).norm() < {});".format(self.eps),
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
+
+    def test_buffer_parameters(self):
+        la_str = """y = A b + ∑_i x_i
+        where
+        A: ℝ ^ (2 × 2): a matrix
+        b: ℝ ^ 2
+        x_i: ℝ ^ 2"""
+        func_info = self.gen_func_info(la_str)
+        A = np.array([[1, 2], [3, 4]])
+        b = np.array([1, 1])
+        x = np.array([[1, 0], [0, 1], [1, 1]])
+        self.assertDMatrixEqual(func_info.numpy_func(A, b, x).y, np.array([5, 9]))
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    Eigen::Matrix<double, 4, 4> M = Eigen::Matrix<double, 4, 4>::Zero();",
+                     "    M.block<2, 2>(1, 1) << 1, 2, 3, 4;",
+                     "    Eigen::Matrix<double, 2, 1> b;",
+                     "    b << 1, 1;",
+                     "    std::vector<Eigen::Matrix<double, 2, 1>> x(3);",
+                     "    x[0] << 1, 0;",
+                     "    x[1] << 0, 1;",
+                     "    x[2] << 1, 1;",
+                     "    Eigen::Matrix<double, 2, 1> y;",
+                     "    y << 5, 9;",
+                     "    Eigen::Matrix<double, 2, 1> C = {}(M.block<2, 2>(1, 1), b, x).y;".format(func_info.eig_func_name),
+                     # column-major buffers, the sequence stored element after element
+                     "    double A_data[] = {1, 3, 2, 4};",
+                     "    double b_data[] = {1, 1};",
+                     "    double x_data[] = {1, 0, 0, 1, 1, 1};",
+                     "    Eigen::Matrix<double, 2, 1> D = {}(A_data, b_data, x_data, 3).y;".format(func_info.eig_func_name),
+                     "    double y_data[2];",
+                     "    {}(A_data, b_data, x_data, 3, y_data);".format(func_info.eig_func_name),
+                     "    return ((y - C).norm() == 0) && ((y - D).norm() == 0) && y_data[0] == 5 && y_data[1] == 9;",
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
+
     def test_block_matrix_0(self):
         # normal block
         la_str = """C = [A ; B]
@@ -461,6 +531,87 @@ class TestMatrix(BasePythonTest):
         cppyy.cppdef('\n'.join(func_list))
         self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
 
+    def test_sparse_matrix_band(self):
+        # sparse matrix: nonzeros generated from the conditions
+        la_str = """L_ij = { 2 if i = j
+        -1 if i = j+1
+        -1 if j = i+1
+        x_i if (j, i) ∈ E
+        0 otherwise
+
+        where
+        L: ℝ ^ (n × n): a matrix
+        E: { ℤ × ℤ } index
+        x: ℝ^n
+        n: ℤ"""
+        func_info = self.gen_func_info(la_str)
+        x = np.array([1, 2, 3, 4])
+        E = [(0, 3), (2, 2), (3, 5)]
+        B = np.array([[2, -1, 0, 0], [-1, 2, -1, 0], [0, -1, 5, -1], [4, 0, -1, 2]])
+        self.assertDMatrixEqual(func_info.numpy_func(E, x, 4).L.toarray(), B)
+        # no scan over all the entries
+        self.assertNotIn("for j in range", parse_la(la_str, ParserTypeEnum.NUMPY))
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    Eigen::Matrix<double, 4, 1> x;",
+                     "    x << 1, 2, 3, 4;",
+                     "    std::set< std::tuple< int, int > > E;",
+                     "    E.insert(std::make_tuple(0, 3));",
+                     "    E.insert(std::make_tuple(2, 2));",
+                     "    E.insert(std::make_tuple(3, 5));",
+                     "    Eigen::Matrix<double, 4, 4> C;",
+                     "    C << 2, -1, 0, 0, -1, 2, -1, 0, 0, -1, 5, -1, 4, 0, -1, 2;",
+                     "    Eigen::SparseMatrix<double> B = {}(E, x, 4).L;".format(func_info.eig_func_name),
+                     "    return C.isApprox(Eigen::MatrixXd(B));",
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
+
+    def test_sparse_matrix_element(self):
+        # element reads of a sparse matrix: converted once
+        la_str = """y_i = sum_j A_i,j x_j
+        where
+        A: ℝ^(n×n) sparse
+        x: ℝ^n"""
+        func_info = self.gen_func_info(la_str)
+        A = scipy.sparse.coo_matrix(([3, 4, 5], ([0, 1, 2], [1, 2, 0])), shape=(3, 3))
+        x = np.array([1, 2, 3])
+        self.assertDMatrixEqual(func_info.numpy_func(A, x).y, np.array([6, 12, 5]))
+        content = parse_la(la_str, ParserTypeEnum.NUMPY)
+        self.assertNotIn("tocsr()[", content)
+        self.assertEqual(content.count("A.todok()"), 1)
+
+    def test_sparse_matrix_accumulate(self):
+        # sparse matrix: +=, built once before it's read
+        la_str = """G_ij = { P_ij if ( i , j ) ∈ E
+        0 otherwise
+
+        G_jk += { ( j , k ) ∈ F : P_jk
+        0 otherwise
+
+        y_i = sum_j G_i,j x_j
+
+        G_jk += { ( j , k ) ∈ F : 1
+        0 otherwise
+
+        where
+        P: ℝ ^ (3 × 3): a matrix
+        G: ℝ ^ (3 × 3): a matrix
+        x: ℝ^3
+        E: { ℤ × ℤ } index
+        F: { ℤ × ℤ } index"""
+        func_info = self.gen_func_info(la_str)
+        P = np.array([[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+        x = np.array([1, 1, 1])
+        E = [(0, 1), (2, 2)]
+        F = [(2, 2), (1, 0)]
+        func_value = func_info.numpy_func(P, x, E, F)
+        # duplicates summed, latest contribution first
+        B = scipy.sparse.coo_matrix(([5, 19, 2], ([1, 2, 0], [0, 2, 1])), shape=(3, 3))
+        self.assertSMatrixEqual(func_value.G, B)
+        self.assertDMatrixEqual(func_value.y, np.array([2, 4, 18]))
+
     def test_sparse_diagonal_matrix(self):
         # sparse matrix: =
         la_str = """D_ii = sum_j A_ij
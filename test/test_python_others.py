@@ -14,6 +14,16 @@ class TestOthers(BasePythonTest):
         a: scalar """
         func_info = self.gen_func_info(la_str)
         self.assertEqual(func_info.numpy_func(2).c, 3)
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    if(std::abs({}(2).c - 3) < 1e-12){{".format(func_info.eig_func_name),
+                     "        return true;",
+                     "    }",
+                     "    return false;",
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
 
     def test_integral_2(self):
         # no return symbol
@@ -30,6 +40,16 @@ class TestOthers(BasePythonTest):
         a: scalar """
         func_info = self.gen_func_info(la_str)
         self.assertEqual(func_info.numpy_func(2).c, 9)
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    if(std::abs({}(2).c - 9) < 1e-12){{".format(func_info.eig_func_name),
+                     "        return true;",
+                     "    }",
+                     "    return false;",
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
 
     def test_optimization_argmin(self):
         # no return symbol
@@ -41,6 +61,16 @@ class TestOthers(BasePythonTest):
         a: scalar """
         func_info = self.gen_func_info(la_str)
         self.assertTrue(abs(func_info.numpy_func(2).b - 4) < 0.00001)
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    if(std::abs({}(2).b - 4) < 0.00001){{".format(func_info.eig_func_name),
+                     "        return true;",
+                     "    }",
+                     "    return false;",
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
 
     def test_optimization_min(self):
         # no return symbol
@@ -52,6 +82,16 @@ class TestOthers(BasePythonTest):
         a: scalar """
         func_info = self.gen_func_info(la_str)
         self.assertTrue(abs(func_info.numpy_func(2).b - 14) < 0.00001)
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    if(std::abs({}(2).b - 14) < 0.00001){{".format(func_info.eig_func_name),
+                     "        return true;",
+                     "    }",
+                     "    return false;",
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
 
     def test_optimization_argmax(self):
         # no return symbol
@@ -63,6 +103,16 @@ class TestOthers(BasePythonTest):
         a: scalar """
         func_info = self.gen_func_info(la_str)
         self.assertTrue(abs(func_info.numpy_func(2).b - 9) < 0.00001)
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    if(std::abs({}(2).b - 9) < 0.00001){{".format(func_info.eig_func_name),
+                     "        return true;",
+                     "    }",
+                     "    return false;",
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
 
     def test_optimization_max(self):
         # no return symbol
@@ -74,6 +124,16 @@ class TestOthers(BasePythonTest):
         a: scalar """
         func_info = self.gen_func_info(la_str)
         self.assertTrue(abs(func_info.numpy_func(2).b - 29) < 0.00001)
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    if(std::abs({}(2).b - 29) < 0.00001){{".format(func_info.eig_func_name),
+                     "        return true;",
+                     "    }",
+                     "    return false;",
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
 
     def test_optimization_argmin_no_st(self):
         # no return symbol
@@ -92,3 +152,38 @@ class TestOthers(BasePythonTest):
         s: {ℝ} """
         func_info = self.gen_func_info(la_str)
         self.assertTrue(abs(func_info.numpy_func([2, 1, 4]).b - 1) < 0.00001)
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    std::set<std::tuple< double > > s;",
+                     "    s.insert(std::make_tuple(2));",
+                     "    s.insert(std::make_tuple(1));",
+                     "    s.insert(std::make_tuple(4));",
+                     "    if({}(s).b == 1){{".format(func_info.eig_func_name),
+                     "        return true;",
+                     "    }",
+                     "    return false;",
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
+
+    def test_optimization_argmin_vector(self):
+        la_str = """y = argmin_(x ∈ ℝ^2) ||x - a||^2 + 3x_1
+        s.t.
+        x_1 + x_2 = 1
+        where
+        a: ℝ^2 """
+        func_info = self.gen_func_info(la_str)
+        self.assertTrue(np.allclose(func_info.numpy_func(np.array([1, 2])).y, [-0.75, 1.75], atol=1e-5))
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    Eigen::Matrix<double, 2, 1> a;",
+                     "    a << 1, 2;",
+                     "    Eigen::Matrix<double, 2, 1> B;",
+                     "    B << -0.75, 1.75;",
+                     "    Eigen::Matrix<double, 2, 1> C = {}(a).y;".format(func_info.eig_func_name),
+                     "    return ((B - C).norm() < {});".format(1e-6),
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
@@ -1,6 +1,7 @@
 import sys
 sys.path.append('./')
 from test.base_python_test import BasePythonTest, eigen_path
+from iheartla.la_parser.parser import parse_la, ParserTypeEnum
 import numpy as np
 import cppyy
 cppyy.add_include_path(eigen_path)
@@ -329,6 +330,178 @@ class TestSubscript(BasePythonTest):
         cppyy.cppdef('\n'.join(func_list))
         self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
 
+    def test_vectorized_summation(self):
+        la_str = """y = ∑_i ||A_i x + b_i||
+        z = ∑_i c_i A_i^T b_i
+        w = ∑_i tr(A_i^T A_i) / c_i
+        where
+        A_i: ℝ^(4×3)
+        b_i: ℝ^4
+        c_i: ℝ
+        x: ℝ^3"""
+        content = parse_la(self.import_trig + la_str, ParserTypeEnum.NUMPY)
+        self.assertFalse('for i in range' in content)
+        self.assertTrue('np.einsum' in content)
+        func_info = self.gen_func_info(self.import_trig + la_str)
+        A = np.random.randn(5, 4, 3)
+        b = np.random.randn(5, 4)
+        c = np.random.rand(5) + 1
+        x = np.random.randn(3)
+        ret = func_info.numpy_func(A, b, c, x)
+        self.assertTrue(np.isclose(ret.y, sum([np.linalg.norm(A[i] @ x + b[i]) for i in range(5)])))
+        self.assertDMatrixApproximateEqual(ret.z, sum([c[i] * A[i].T @ b[i] for i in range(5)]))
+        self.assertTrue(np.isclose(ret.w, sum([np.trace(A[i].T @ A[i]) / c[i] for i in range(5)])))
+
+    def test_vectorized_summation_math_func(self):
+        # parenthesized argument of an element-wise function
+        la_str = """y = ∑_i sin((a_i + b))
+        z = ∑_i cos((a_i + b) c_i)
+        where
+        a_i: ℝ
+        c_i: ℝ
+        b: ℝ"""
+        content = parse_la(self.import_trig + la_str, ParserTypeEnum.NUMPY)
+        self.assertFalse('for i in range' in content)
+        func_info = self.gen_func_info(self.import_trig + la_str)
+        a = np.random.randn(5)
+        c = np.random.randn(5)
+        ret = func_info.numpy_func(a, c, 0.5)
+        self.assertTrue(np.isclose(ret.y, np.sum(np.sin(a + 0.5))))
+        self.assertTrue(np.isclose(ret.z, np.sum(np.cos((a + 0.5) * c))))
+
+    def test_broadcast_assignment(self):
+        la_str = """A_ij = x_i y_j + B_j,i
+        v_i = x_i + i
+        L = A
+        L_ii = sin(y_i)
+        where
+        x: ℝ^n
+        y: ℝ^n
+        B: ℝ^(n×n)"""
+        content = parse_la(self.import_trig + la_str, ParserTypeEnum.NUMPY)
+        self.assertFalse('for i in range' in content)
+        func_info = self.gen_func_info(self.import_trig + la_str)
+        x = np.random.randn(4)
+        y = np.random.randn(4)
+        B = np.random.randn(4, 4)
+        ret = func_info.numpy_func(x, y, B)
+        A = np.outer(x, y) + B.T
+        self.assertDMatrixApproximateEqual(ret.v, x + np.arange(1, 5))
+        np.fill_diagonal(A, np.sin(y))
+        self.assertDMatrixApproximateEqual(ret.L, A)
+
+    def test_eigen_vectorized_summation(self):
+        la_str = """s = ∑_i a_i b_i
+        y = ∑_i (M x_i) c_i
+        t = ∑_i |a_i|^2 / d
+        where
+        a: ℝ^n
+        b: ℝ^n
+        M: ℝ^(2×3)
+        x_i: ℝ^3
+        c_i: ℝ
+        d: ℝ"""
+        content = parse_la(la_str, ParserTypeEnum.EIGEN)
+        self.assertFalse('sum_0 +=' in content)
+        self.assertTrue('rowwise().sum()' in content)
+        func_info = self.gen_func_info(la_str)
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    Eigen::Matrix<double, 3, 1> a;",
+                     "    a << 1, -2, 3;",
+                     "    Eigen::Matrix<double, 3, 1> b;",
+                     "    b << 4, 5, 6;",
+                     "    Eigen::Matrix<double, 2, 3> M;",
+                     "    M << 1, 0, 1, 0, 1, 0;",
+                     "    std::vector<Eigen::Matrix<double, 3, 1>> x(2);",
+                     "    x[0] << 1, 2, 3;",
+                     "    x[1] << 0, 1, 1;",
+                     "    std::vector<double> c = {2, 3};",
+                     "    auto ret = {}(a, b, M, x, c, 2);".format(func_info.eig_func_name),
+                     "    Eigen::Matrix<double, 2, 1> y;",
+                     "    y << 11, 7;",
+                     "    return ret.s == 12 && ((ret.y - y).norm() == 0) && ret.t == 7;",
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
+
+    def test_eigen_sequence_product(self):
+        la_str = """y = ∑_i A_i x_i
+        z_i = A_i x_i
+        where
+        A_i: ℝ^(2×3)
+        x_i: ℝ^3"""
+        content = parse_la(la_str, ParserTypeEnum.EIGEN)
+        self.assertFalse('sum_0 +=' in content)
+        self.assertFalse('A.at(' in content or 'x.at(' in content)
+        self.assertTrue('z[i-1] = A[i-1] * x[i-1];' in content)
+        func_info = self.gen_func_info(la_str)
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    std::vector<Eigen::Matrix<double, 2, 3>> A(3);",
+                     "    std::vector<Eigen::Matrix<double, 3, 1>> x(3);",
+                     "    Eigen::Matrix<double, 2, 1> y = Eigen::Matrix<double, 2, 1>::Zero();",
+                     "    for(int i=0; i<3; i++){",
+                     "        A[i] << i, 1, 2, 3, -i, 1;",
+                     "        x[i] << 1, i, 2*i;",
+                     "        y += A[i] * x[i];",
+                     "    }",
+                     "    auto ret = {}(A, x);".format(func_info.eig_func_name),
+                     "    return (ret.y - y).norm() == 0 && (ret.z[2] - A[2] * x[2]).norm() == 0;",
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
+
+    def test_eigen_broadcast_assignment(self):
+        la_str = """A_ij = x_i y_j + B_j,i
+        v_i = sin(x_i) / i
+        u_i = z_i ⋅ y
+        where
+        x: ℝ^3
+        y: ℝ^3
+        B: ℝ^(3×3)
+        z_i: ℝ^3"""
+        content = parse_la(self.import_trig + la_str, ParserTypeEnum.EIGEN)
+        self.assertFalse('for( int i' in content)
+        self.assertTrue('NullaryExpr' in content)
+        func_info = self.gen_func_info(self.import_trig + la_str)
+        x = np.array([1, 2, 3])
+        y = np.array([-1, 0, 2])
+        B = np.array([[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+        z = np.array([[1, 1, 1], [0, 1, 2]])
+        A = np.outer(x, y) + B.T
+        v = np.sin(x) / np.arange(1, 4)
+        u = np.array([1, 4])
+        ret = func_info.numpy_func(x, y, B, z)
+        self.assertDMatrixApproximateEqual(ret.A, A)
+        self.assertDMatrixApproximateEqual(ret.v, v)
+        self.assertDMatrixApproximateEqual(ret.u, u)
+        # eigen test
+        cppyy.include(func_info.eig_file_name)
+        func_list = ["bool {}(){{".format(func_info.eig_test_name),
+                     "    Eigen::Matrix<double, 3, 1> x;",
+                     "    x << 1, 2, 3;",
+                     "    Eigen::Matrix<double, 3, 1> y;",
+                     "    y << -1, 0, 2;",
+                     "    Eigen::Matrix<double, 3, 3> B;",
+                     "    B << 1, 2, 3, 4, 5, 6, 7, 8, 9;",
+                     "    std::vector<Eigen::Matrix<double, 3, 1>> z(2);",
+                     "    z[0] << 1, 1, 1;",
+                     "    z[1] << 0, 1, 2;",
+                     "    Eigen::Matrix<double, 3, 3> A;",
+                     "    A << 0, 4, 9, 0, 5, 12, 0, 6, 15;",
+                     "    Eigen::Matrix<double, 3, 1> v;",
+                     "    v << sin(1), sin(2) / 2, sin(3) / 3;",
+                     "    Eigen::Matrix<double, 2, 1> u;",
+                     "    u << 1, 4;",
+                     "    auto ret = {}(x, y, B, z);".format(func_info.eig_func_name),
+                     "    return ((ret.A - A).norm() == 0) && ((ret.v - v).norm() < 1e-12) && ((ret.u - u).norm() == 0);",
+                     "}"]
+        cppyy.cppdef('\n'.join(func_list))
+        self.assertTrue(getattr(cppyy.gbl, func_info.eig_test_name)())
+
     def test_indexing_type(self):
         la_str = """d = a_b + a_c
                 where